@@ -4,6 +4,97 @@ from torch.nn import functional as F
 import torch
 
 
+def channel_view(statistic, input):
+    # (B, C) or (C,) statistics broadcast over the spatial dimensions of input
+    return statistic.reshape(statistic.shape + (1,) * (input.dim() - 2))
+
+
+class BatchInstanceNormFunction(torch.autograd.Function):
+    """Batch and instance normalization mixed per channel, in one pass over the input.
+
+    The instance statistics come from a single var_mean over the spatial
+    dimensions and the batch statistics follow from them by the law of
+    total variance. Both branches fold into one scale and shift per sample
+    and channel, so no normalized intermediate is materialized and only the
+    input and per-channel statistics are kept for backward.
+    """
+
+    @staticmethod
+    def forward(ctx, input, bn_weight, bias, in_weight, running_mean, running_var, training, momentum, eps):
+        dims = tuple(range(2, input.dim()))
+        instance_var, instance_mean = torch.var_mean(input, dim=dims, unbiased=False)
+        # statistics are kept in at least single precision
+        dtype = torch.promote_types(input.dtype, torch.float32)
+        instance_var, instance_mean = instance_var.to(dtype), instance_mean.to(dtype)
+        # like batch_norm, batch statistics are used without running ones to fall back on
+        batch_statistics = training or running_mean is None
+        if batch_statistics:
+            batch_mean = instance_mean.mean(0)
+            batch_var = instance_var.mean(0) + instance_mean.var(0, unbiased=False)
+            if training and running_mean is not None:
+                count = input.numel() // input.size(1)
+                running_mean.mul_(1 - momentum).add_(batch_mean, alpha=momentum)
+                running_var.mul_(1 - momentum).add_(batch_var * count / max(count - 1, 1), alpha=momentum)
+        else:
+            batch_mean, batch_var = running_mean.to(dtype), running_var.to(dtype)
+        batch_invstd = torch.rsqrt(batch_var + eps)
+        instance_invstd = torch.rsqrt(instance_var + eps)
+
+        bn_scale = bn_weight.to(dtype) * batch_invstd
+        in_scale = in_weight.to(dtype) * instance_invstd
+        scale = bn_scale + in_scale
+        shift = -bn_scale * batch_mean - in_scale * instance_mean
+        if bias is not None:
+            shift = shift + bias.to(dtype)
+
+        ctx.batch_statistics = batch_statistics
+        ctx.save_for_backward(input, bn_weight, in_weight, batch_mean, batch_invstd, instance_mean, instance_invstd)
+        return torch.addcmul(channel_view(shift, input).to(input.dtype), input, channel_view(scale, input).to(input.dtype))
+
+    @staticmethod
+    def backward(ctx, grad_output):
+        input, bn_weight, in_weight, batch_mean, batch_invstd, instance_mean, instance_invstd = ctx.saved_tensors
+        dims = tuple(range(2, input.dim()))
+        dtype = batch_invstd.dtype
+        instance_count = input[0, 0].numel()
+        batch_count = instance_count * input.size(0)
+
+        # sums of grad and grad * input per sample and channel give every reduction below
+        grad_sum = grad_output.sum(dim=dims, dtype=dtype)
+        grad_input_sum = (grad_output * input).sum(dim=dims, dtype=dtype)
+        bn_dot = batch_invstd * (grad_input_sum - batch_mean * grad_sum)
+        in_dot = instance_invstd * (grad_input_sum - instance_mean * grad_sum)
+
+        # grad_input = grad_output * scale + input * slope + offset per sample and channel
+        bn_scale = bn_weight.to(dtype) * batch_invstd
+        in_scale = in_weight.to(dtype) * instance_invstd
+        in_slope = in_scale * instance_invstd * in_dot / instance_count
+        slope = -in_slope
+        offset = in_slope * instance_mean - in_scale * grad_sum / instance_count
+        if ctx.batch_statistics:
+            bn_slope = bn_scale * batch_invstd * bn_dot.sum(0) / batch_count
+            slope = slope - bn_slope
+            offset = offset + bn_slope * batch_mean - bn_scale * grad_sum.sum(0) / batch_count
+
+        grad_input = grad_bn_weight = grad_bias = grad_in_weight = None
+        if ctx.needs_input_grad[0]:
+            grad_input = torch.addcmul(
+                torch.addcmul(channel_view(offset, input).to(input.dtype), input, channel_view(slope, input).to(input.dtype)),
+                grad_output, channel_view(bn_scale + in_scale, input).to(input.dtype))
+        if ctx.needs_input_grad[1]:
+            grad_bn_weight = bn_dot.sum(0).to(bn_weight.dtype)
+        if ctx.needs_input_grad[2]:
+            grad_bias = grad_sum.sum(0).to(bn_weight.dtype)
+        if ctx.needs_input_grad[3]:
+            grad_in_weight = in_dot.sum(0).to(in_weight.dtype)
+        return grad_input, grad_bn_weight, grad_bias, grad_in_weight, None, None, None, None, None
+
+
+def batch_instance_norm(input, bn_weight, bias, in_weight, running_mean, running_var, training, momentum, eps):
+    return BatchInstanceNormFunction.apply(input, bn_weight, bias, in_weight, running_mean, running_var,
+        training, momentum, eps)
+
+
 class _BatchInstanceNorm(_BatchNorm):
     def __init__(self, num_features, eps=1e-5, momentum=0.1, affine=True):
         super(_BatchInstanceNorm, self).__init__(num_features, eps, momentum, affine)
@@ -11,8 +102,20 @@ class _BatchInstanceNorm(_BatchNorm):
         self.gate.data.fill_(1)
         setattr(self.gate, 'bin_gate', True)
 
+    def gate_weights(self):
+        if self.affine:
+            return self.weight * self.gate, self.weight * (1 - self.gate)
+        return self.gate, 1 - self.gate
+
     def forward(self, input):
         self._check_input_dim(input)
+        bn_w, in_w = self.gate_weights()
+        return batch_instance_norm(input, bn_w, self.bias, in_w, self.running_mean, self.running_var,
+            self.training, self.momentum, self.eps)
+
+    def reference_forward(self, input):
+        # the two full batch_norm passes the fused forward replaces, kept to benchmark and check it against
+        self._check_input_dim(input)
 
         # Batch norm
         if self.affine:
@@ -29,11 +132,11 @@ class _BatchInstanceNorm(_BatchNorm):
             in_w = self.weight * (1 - self.gate)
         else:
             in_w = 1 - self.gate
-        input = input.view(1, b * c, *input.size()[2:])
+        input = input.reshape(1, b * c, *input.size()[2:])
         out_in = F.batch_norm(
             input, None, None, None, None,
             True, self.momentum, self.eps)
-        out_in = out_in.view(b, c, *input.size()[2:])
+        out_in = out_in.reshape(b, c, *input.size()[2:])
         out_in.mul_(in_w[None, :, None, None])
 
         return out_bn + out_in
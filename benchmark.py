@@ -0,0 +1,462 @@
+# coding: utf-8
+
+# In[1]: Load Libraries
+
+# native
+import time
+import contextlib
+import argparse
+import tempfile
+
+# modules
+from utils import pathJoin, set_execution_mode, set_activation_checkpointing
+from dataset import DeNormalize
+from betavae import BetaVAE_H
+from vgg19 import create_supported_models, VGG_VANILLA_SIMILARITY
+from taps import SIMILARITY_MODES
+from batchinstancenorm import BatchInstanceNorm2d
+from instancenormbatchswap import InstanceNormBatchSwap
+from weightpool import clear_weight_pool, weight_pool_disabled
+from inference import optimize_for_inference, verify_inference
+
+# pytorch
+import torch
+import torchvision.transforms as transforms
+
+imagenet_normalization_values = {
+    'mean': [0.485, 0.456, 0.406],
+    'std': [0.229, 0.224, 0.225]
+}
+
+# name: (memory format, compile)
+EXECUTION_MODES = {
+    'eager': ('contiguous', False),
+    'channels_last': ('channels_last', False),
+    'compile': ('contiguous', True),
+    'channels_last_compile': ('channels_last', True)
+}
+
+# In[2]: Measurements
+
+def synchronize(device):
+    if device.type == 'cuda':
+        torch.cuda.synchronize(device)
+
+
+def time_iterations(step, iterations, device):
+    synchronize(device)
+    start = time.perf_counter()
+    for _ in range(iterations):
+        step()
+    synchronize(device)
+    return time.perf_counter() - start
+
+
+def first_output(output):
+    # autoencoders return the logits first
+    return output[0] if isinstance(output, tuple) else output
+
+
+def measure_throughput(model, input, iterations, warmup, device):
+    """Images per second of inference and of a training step without the optimizer."""
+    def forward():
+        with torch.no_grad():
+            model(input)
+
+    def forward_backward():
+        model.zero_grad(set_to_none=True)
+        first_output(model(input)).float().sum().backward()
+
+    throughput = {}
+    for name, step, training in [('forward', forward, False), ('forward_backward', forward_backward, True)]:
+        model.train(training)
+        # warmup also triggers compilation
+        time_iterations(step, warmup, device)
+        throughput[name] = input.size(0) * iterations / time_iterations(step, iterations, device)
+    return throughput
+
+
+class SavedTensorBytes(object):
+    """Counts the bytes autograd keeps for backward, over distinct storages."""
+
+    def __init__(self):
+        self.storages = {}
+
+    def pack(self, tensor):
+        storage = tensor.untyped_storage() if hasattr(tensor, 'untyped_storage') else tensor.storage()
+        self.storages[storage.data_ptr()] = storage.nbytes()
+        return tensor
+
+    def unpack(self, tensor):
+        return tensor
+
+    def total(self):
+        return sum(self.storages.values())
+
+
+def measure_training_step(model, input, iterations, warmup, device):
+    """Seconds per forward+backward, bytes saved for backward and, on cuda, peak bytes allocated."""
+    model.train()
+
+    def forward_backward():
+        model.zero_grad(set_to_none=True)
+        first_output(model(input)).float().sum().backward()
+
+    time_iterations(forward_backward, warmup, device)
+
+    saved = SavedTensorBytes()
+    model.zero_grad(set_to_none=True)
+    with torch.autograd.graph.saved_tensors_hooks(saved.pack, saved.unpack):
+        output = first_output(model(input))
+    output.float().sum().backward()
+    del output
+
+    peak = None
+    if device.type == 'cuda':
+        torch.cuda.reset_peak_memory_stats(device)
+        forward_backward()
+        peak = torch.cuda.max_memory_allocated(device)
+
+    return time_iterations(forward_backward, iterations, device) / iterations, saved.total(), peak
+
+
+# In[3]: Throughput
+
+@contextlib.contextmanager
+def benchmark_models(config, device):
+    """The supported models table, with an untrained autoencoder checkpoint to build on."""
+    vae_transforms = transforms.Compose([
+        DeNormalize(**imagenet_normalization_values),
+        transforms.ToPILImage(),
+        transforms.Resize((config.vaeImageSize, config.vaeImageSize)),
+        transforms.ToTensor()
+    ])
+
+    with tempfile.TemporaryDirectory() as directory:
+        # models built on an autoencoder only need a checkpoint to load, not a trained one
+        vae_checkpoint_path = pathJoin(directory, 'vae.ckpt')
+        torch.save({'weights': BetaVAE_H(z_dim=config.zdim, nc=3).state_dict()}, vae_checkpoint_path)
+
+        yield create_supported_models(config.zdim, config.beta, config.gamma,
+            vae_checkpoint_path, device, vae_transforms)
+
+
+def benchmark_throughput(config, device):
+    with benchmark_models(config, device) as supported_models:
+        model_names = config.model if config.model is not None else list(supported_models)
+        modes = config.mode if config.mode is not None else list(EXECUTION_MODES)
+
+        print('{:<48} {:<24} {:>14} {:>20}'.format('model', 'mode', 'forward img/s', 'forward+backward img/s'))
+        for model_name in model_names:
+            image_size = config.vaeImageSize if 'vae' in model_name or 'classifier_z' in model_name else config.inputSize
+            input = torch.randn(config.batchSize, 3, image_size, image_size, device=device)
+            for mode in modes:
+                memory_format, compile = EXECUTION_MODES[mode]
+                try:
+                    model = set_execution_mode(supported_models[model_name]().to(device), memory_format, compile)
+                    throughput = measure_throughput(model, input, config.iterations, config.warmup, device)
+                    print('{:<48} {:<24} {:>14.1f} {:>20.1f}'.format(model_name, mode,
+                        throughput['forward'], throughput['forward_backward']))
+                    del model
+                except Exception as error:
+                    print('{:<48} {:<24} failed: {}'.format(model_name, mode, error))
+                if device.type == 'cuda':
+                    torch.cuda.empty_cache()
+
+
+# In[4]: Activation Checkpointing
+
+FULL_TUNE_MODELS = [
+    'vgg19_in_all_tune_all',
+    'vgg19_in_single_tune_all',
+    'similarity_vgg19_vanilla_tune_all',
+    'similarity_vgg19_in_single_tune_all'
+]
+
+
+def benchmark_checkpointing(config, device):
+    supported_models = create_supported_models(config.zdim, config.beta, config.gamma, None, device, None)
+    model_names = config.model if config.model is not None else FULL_TUNE_MODELS
+    segmentations = config.segments if config.segments is not None else [0, 2, 4, 8]
+
+    input = torch.randn(config.batchSize, 3, config.inputSize, config.inputSize, device=device)
+
+    print('{:<40} {:>8} {:>12} {:>18} {:>14}'.format('model', 'segments', 'step s', 'saved for bwd MB', 'peak MB'))
+    for model_name in model_names:
+        for segments in segmentations:
+            try:
+                model = set_activation_checkpointing(supported_models[model_name]().to(device), segments)
+                step_time, saved_bytes, peak_bytes = measure_training_step(model, input, config.iterations, config.warmup, device)
+                print('{:<40} {:>8} {:>12.3f} {:>18.1f} {:>14}'.format(model_name, segments, step_time, saved_bytes / 2**20,
+                    '{:.1f}'.format(peak_bytes / 2**20) if peak_bytes is not None else '-'))
+                del model
+            except Exception as error:
+                print('{:<40} {:>8} failed: {}'.format(model_name, segments, error))
+            if device.type == 'cuda':
+                torch.cuda.empty_cache()
+
+
+# In[5]: Similarity Scores
+
+def tapped_activations(input):
+    """Activations of a randomly initialized VGG19 at the taps of the similarity models."""
+    model = VGG_VANILLA_SIMILARITY(pretrained=False).to(input.device).eval()
+    with torch.no_grad(), model.taps.collect(reduce=False) as tapped:
+        model(input)
+    return model, list(tapped)
+
+
+def benchmark_similarity(config, device):
+    input = torch.randn(config.batchSize, 3, config.inputSize, config.inputSize, device=device)
+    model, activations = tapped_activations(input)
+    statistic = model.taps.statistic
+    statistic.sketch_size = config.sketchSize
+    modes = config.mode if config.mode is not None else SIMILARITY_MODES
+
+    print('{:<20} {:<10} {:>12} {:>16} {:>16}'.format('layer', 'mode', 'fwd+bwd ms', 'mean rel error', 'std rel error'))
+    for layer_index, activation in zip(model.layer_indices, activations):
+        statistic.mode = 'reference'
+        reference = statistic(activation.double(), training=True).float()
+        for mode in modes:
+            statistic.mode = mode
+            x = activation.clone().requires_grad_(True)
+
+            def forward_backward():
+                statistic(x, training=True).sum().backward()
+
+            time_iterations(forward_backward, config.warmup, device)
+            step_time = time_iterations(forward_backward, config.iterations, device) / config.iterations
+
+            # the sketch is random, its error is measured over repeated draws
+            with torch.no_grad():
+                errors = torch.stack([ ((statistic(activation, training=True) - reference) / reference).mean()
+                    for _ in range(config.repeats if mode == 'sketch' else 1) ])
+            print('{:<20} {:<10} {:>12.3f} {:>16.2e} {:>16.2e}'.format(
+                '{} {}'.format(layer_index, tuple(activation.shape[1:])), mode, step_time * 1000,
+                errors.mean().item(), errors.std().item() if errors.numel() > 1 else 0.0))
+
+
+# In[6]: Normalization Layers
+
+class ReferenceForward(torch.nn.Module):
+    """Runs the unfused reference_forward of a normalization layer."""
+
+    def __init__(self, module):
+        super(ReferenceForward, self).__init__()
+        self.module = module
+
+    def forward(self, input):
+        return self.module.reference_forward(input)
+
+
+def benchmark_normalization(config, device):
+    # gradients and outputs are checked against the reference forwards by tests/test_normalization.py
+    input = torch.randn(config.batchSize, config.channels, config.size, config.size, device=device)
+    layers = {
+        'batch_instance_norm': BatchInstanceNorm2d(config.channels).to(device).train(),
+        'instance_norm_batch_swap': InstanceNormBatchSwap(config.channels).to(device).train()
+    }
+
+    print('{:<28} {:<10} {:>12} {:>18} {:>14}'.format('layer', 'forward', 'step ms', 'saved for bwd MB', 'peak MB'))
+    for name, module in layers.items():
+        for forward_name, forward in [('fused', module), ('reference', ReferenceForward(module))]:
+            step_time, saved_bytes, peak_bytes = measure_training_step(forward, input.clone().requires_grad_(True),
+                config.iterations, config.warmup, device)
+            print('{:<28} {:<10} {:>12.3f} {:>18.1f} {:>14}'.format(name, forward_name, step_time * 1000,
+                saved_bytes / 2**20, '{:.1f}'.format(peak_bytes / 2**20) if peak_bytes is not None else '-'))
+        if device.type == 'cuda':
+            torch.cuda.empty_cache()
+
+
+# In[7]: Model Construction
+
+def time_construction(create_model, repeats):
+    start = time.perf_counter()
+    for _ in range(repeats):
+        create_model()
+    return (time.perf_counter() - start) / repeats
+
+
+def benchmark_construction(config, device):
+    with benchmark_models(config, device) as supported_models:
+        model_names = config.model if config.model is not None else list(supported_models)
+
+        print('{:<48} {:>16} {:>16} {:>16}'.format('model', 'torchvision s', 'pool first s', 'pool s'))
+        for model_name in model_names:
+            try:
+                with weight_pool_disabled():
+                    torchvision_time = time_construction(supported_models[model_name], config.repeats)
+                # the first build after clearing loads the weights into the pool
+                clear_weight_pool()
+                first_time = time_construction(supported_models[model_name], 1)
+                pool_time = time_construction(supported_models[model_name], config.repeats)
+                print('{:<48} {:>16.3f} {:>16.3f} {:>16.3f}'.format(model_name, torchvision_time, first_time, pool_time))
+            except Exception as error:
+                print('{:<48} failed: {}'.format(model_name, error))
+
+
+# In[8]: Inference Optimization
+
+BATCH_NORM_MODELS = [
+    'vgg19_bn_all_tune_fc',
+    'vgg19_bn_in_single_tune_all',
+    'similarity_vgg19_bn_all_tune_fc'
+]
+
+
+def benchmark_inference(config, device):
+    with benchmark_models(config, device) as supported_models:
+        model_names = config.model if config.model is not None else BATCH_NORM_MODELS
+
+        print('{:<48} {:>18} {:>20} {:>16}'.format('model', 'forward img/s', 'optimized img/s', 'max abs diff'))
+        for model_name in model_names:
+            image_size = config.vaeImageSize if 'vae' in model_name or 'classifier_z' in model_name else config.inputSize
+            input = torch.randn(config.batchSize, 3, image_size, image_size, device=device)
+            try:
+                model = supported_models[model_name]().to(device).eval()
+                optimized = optimize_for_inference(model)
+                difference = verify_inference(model, optimized, input)
+                throughput = []
+                for forward_model in [model, optimized]:
+                    def forward():
+                        with torch.no_grad():
+                            forward_model(input)
+                    time_iterations(forward, config.warmup, device)
+                    throughput.append(input.size(0) * config.iterations / time_iterations(forward, config.iterations, device))
+                print('{:<48} {:>18.1f} {:>20.1f} {:>16.2e}'.format(model_name, throughput[0], throughput[1], difference))
+                del model, optimized
+            except Exception as error:
+                print('{:<48} failed: {}'.format(model_name, error))
+            if device.type == 'cuda':
+                torch.cuda.empty_cache()
+
+
+# In[9]: Main
+
+def benchmark_configuration():
+    parser = argparse.ArgumentParser(formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('--disableCuda', action='store_true',
+                        help='disable the use of CUDA')
+    parser.add_argument('--cudaDevice', type=int, default=0,
+                        help='specify which GPU to use')
+    subparsers = parser.add_subparsers(dest='command')
+    subparsers.required = True
+
+    throughput = subparsers.add_parser('throughput', formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+                        help='images/sec of every supported model in every execution mode')
+    throughput.add_argument('--model', action='append', type=str, default=None,
+                        help='name of model(s) in the supported models table (default: all)')
+    throughput.add_argument('--mode', action='append', type=str, default=None, choices=list(EXECUTION_MODES),
+                        help='execution mode(s) (default: all)')
+    throughput.add_argument('--batchSize', type=int, default=16,
+                        help='images per batch')
+    throughput.add_argument('--iterations', type=int, default=10,
+                        help='timed batches per measurement')
+    throughput.add_argument('--warmup', type=int, default=3,
+                        help='untimed batches before each measurement')
+    throughput.add_argument('--inputSize', type=int, default=224,
+                        help='extent of input layer in the network')
+    throughput.add_argument('--vaeImageSize', type=int, default=128,
+                        help='extent of input and target layer in the autoencoder')
+    throughput.add_argument('--zdim', type=int, default=128,
+                        help='latent space dimension size for the betavae')
+    throughput.add_argument('--beta', type=float, default=0.2,
+                        help='beta value in the autoencoder model names')
+    throughput.add_argument('--gamma', type=float, default=0.0,
+                        help='gamma value in the autoencoder model names')
+
+    checkpointing = subparsers.add_parser('checkpointing', formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+                        help='step time against activation memory for each activation checkpointing segmentation')
+    checkpointing.add_argument('--model', action='append', type=str, default=None,
+                        help='name of model(s) in the supported models table (default: the full-tune models)')
+    checkpointing.add_argument('--segments', action='append', type=int, default=None,
+                        help='segmentation(s) to measure, 0 disables checkpointing (default: 0, 2, 4, 8)')
+    checkpointing.add_argument('--batchSize', type=int, default=32,
+                        help='images per batch')
+    checkpointing.add_argument('--iterations', type=int, default=5,
+                        help='timed steps per measurement')
+    checkpointing.add_argument('--warmup', type=int, default=2,
+                        help='untimed steps before each measurement')
+    checkpointing.add_argument('--inputSize', type=int, default=224,
+                        help='extent of input layer in the network')
+    checkpointing.set_defaults(zdim=128, beta=0.2, gamma=0.0)
+
+    similarity = subparsers.add_parser('similarity', formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+                        help='speed and error of the similarity score modes at every tapped layer')
+    similarity.add_argument('--mode', action='append', type=str, default=None, choices=SIMILARITY_MODES,
+                        help='similarity mode(s) (default: all)')
+    similarity.add_argument('--sketchSize', type=int, default=1024,
+                        help='positions sampled per layer in sketch mode')
+    similarity.add_argument('--repeats', type=int, default=20,
+                        help='sketches drawn to measure the error of sketch mode')
+    similarity.add_argument('--batchSize', type=int, default=16,
+                        help='images per batch')
+    similarity.add_argument('--iterations', type=int, default=10,
+                        help='timed steps per measurement')
+    similarity.add_argument('--warmup', type=int, default=3,
+                        help='untimed steps before each measurement')
+    similarity.add_argument('--inputSize', type=int, default=224,
+                        help='extent of input layer in the network')
+
+    normalization = subparsers.add_parser('normalization', formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+                        help='speed and memory of the fused normalization layers against the unfused ones')
+    normalization.add_argument('--batchSize', type=int, default=32,
+                        help='images per batch')
+    normalization.add_argument('--channels', type=int, default=512,
+                        help='channels of the normalized activations, 512 at VGG19 layer 21')
+    normalization.add_argument('--size', type=int, default=28,
+                        help='extent of the normalized activations, 28 at VGG19 layer 21 for 224 inputs')
+    normalization.add_argument('--iterations', type=int, default=20,
+                        help='timed steps per measurement')
+    normalization.add_argument('--warmup', type=int, default=5,
+                        help='untimed steps before each measurement')
+
+    construction = subparsers.add_parser('construction', formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+                        help='seconds to build every supported model with and without the pretrained weight pool')
+    construction.add_argument('--model', action='append', type=str, default=None,
+                        help='name of model(s) in the supported models table (default: all)')
+    construction.add_argument('--repeats', type=int, default=3,
+                        help='builds per measurement')
+    construction.add_argument('--vaeImageSize', type=int, default=128,
+                        help='extent of input and target layer in the autoencoder')
+    construction.set_defaults(zdim=128, beta=0.2, gamma=0.0)
+
+    inference = subparsers.add_parser('inference', formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+                        help='agreement and images/sec of models optimized for inference against the originals')
+    inference.add_argument('--model', action='append', type=str, default=None,
+                        help='name of model(s) in the supported models table (default: the batch norm models)')
+    inference.add_argument('--batchSize', type=int, default=16,
+                        help='images per batch')
+    inference.add_argument('--iterations', type=int, default=10,
+                        help='timed batches per measurement')
+    inference.add_argument('--warmup', type=int, default=3,
+                        help='untimed batches before each measurement')
+    inference.add_argument('--inputSize', type=int, default=224,
+                        help='extent of input layer in the network')
+    inference.add_argument('--vaeImageSize', type=int, default=128,
+                        help='extent of input and target layer in the autoencoder')
+    inference.set_defaults(zdim=128, beta=0.2, gamma=0.0)
+
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    config = benchmark_configuration()
+    if torch.cuda.is_available() and not config.disableCuda:
+        device = torch.device('cuda:{}'.format(config.cudaDevice))
+        torch.backends.cudnn.benchmark = True
+    else:
+        device = torch.device('cpu')
+
+    if config.command == 'throughput':
+        benchmark_throughput(config, device)
+    elif config.command == 'checkpointing':
+        benchmark_checkpointing(config, device)
+    elif config.command == 'similarity':
+        benchmark_similarity(config, device)
+    elif config.command == 'normalization':
+        benchmark_normalization(config, device)
+    elif config.command == 'construction':
+        benchmark_construction(config, device)
+    elif config.command == 'inference':
+        benchmark_inference(config, device)
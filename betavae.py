@@ -2,6 +2,7 @@ import os
 import torch
 import torch.nn as nn
 import torch.nn.init as init
+from checkpoint import load_checkpoint_weights
 
 def kaiming_init(m):
     if isinstance(m, (nn.Linear, nn.Conv2d)):
@@ -24,7 +25,7 @@ class View(nn.Module):
         self.size = size
 
     def forward(self, tensor):
-        return tensor.view(self.size)
+        return tensor.reshape(self.size)
 
 class BetaVAE_H(nn.Module):
     """Model proposed in original beta-VAE paper(Higgins et al, ICLR, 2017)."""
@@ -106,17 +107,22 @@ class BetaVAE_H_CLASSIFIER(BetaVAE_H):
 
         if os.path.isfile(vae_checkpoint_path):
             checkpoint = torch.load(vae_checkpoint_path, map_location=device)
-            self.load_state_dict(checkpoint['weights'])
+            load_checkpoint_weights(self, checkpoint, device)
         else:
             raise ValueError('Checkpoint Not Found: {}'.format(vae_checkpoint_path))
 
         self.classifier = nn.Linear(z_dim, 200)
     
-    def forward(self, x):
+    def forward(self, x, latents=None):
+        if latents is None:
+            latents = self.encode_latents(x)
+        return self.classifier(latents)
+
+    def encode_latents(self, x):
         with torch.no_grad():
             encoded_x = self._encode(x)
             encoded_x = encoded_x[:, :self.z_dim] # take the mean
-        return self.classifier(encoded_x)
+        return encoded_x
 
 
 def create_betavae(z_dim):
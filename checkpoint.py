@@ -0,0 +1,311 @@
+import os
+import copy
+import json
+import fcntl
+import hashlib
+import queue
+import random
+import threading
+import numpy as np
+import torch
+from parallel import is_main_process
+
+
+def snapshot(value):
+    # copy tensors to cpu memory so training can go on while the copy is written
+    if torch.is_tensor(value):
+        return value.detach().to('cpu', copy=True)
+    if isinstance(value, dict):
+        return type(value)((k, snapshot(v)) for k, v in value.items())
+    if isinstance(value, (list, tuple)):
+        return type(value)(snapshot(v) for v in value)
+    return copy.deepcopy(value)
+
+
+def save_atomic(checkpoint, path):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    temporary_path = '{}.{}.tmp'.format(path, os.getpid())
+    with open(temporary_path, 'wb') as checkpoint_file:
+        torch.save(checkpoint, checkpoint_file)
+        checkpoint_file.flush()
+        os.fsync(checkpoint_file.fileno())
+    os.replace(temporary_path, path)
+
+
+class CheckpointWriter(object):
+    """Writes checkpoints from a background thread.
+
+    save() snapshots the checkpoint to cpu memory and returns, the file is
+    written to a temporary path and renamed over the target so a reader never
+    sees a partial checkpoint. At most one snapshot waits behind the one
+    being written, a further save() blocks until it is picked up.
+    """
+
+    def __init__(self):
+        self.queue = queue.Queue(maxsize=1)
+        self.error = None
+        self.thread = threading.Thread(target=self.work, daemon=True)
+        self.thread.start()
+
+    def save(self, checkpoint, path, metadata=None):
+        self.raise_error()
+        if not is_main_process():
+            return
+        self.queue.put((snapshot(checkpoint), path, metadata))
+
+    def work(self):
+        while True:
+            item = self.queue.get()
+            try:
+                if item is None:
+                    return
+                checkpoint, path, metadata = item
+                self.write(checkpoint, path, metadata)
+            except Exception as error:
+                self.error = error
+            finally:
+                self.queue.task_done()
+
+    def write(self, checkpoint, path, metadata=None):
+        save_atomic(checkpoint, path)
+        if metadata is not None:
+            record_checkpoint(path, checkpoint_metadata(metadata['model'], path, checkpoint, metadata.get('config')))
+
+    def wait(self):
+        self.queue.join()
+        self.raise_error()
+
+    def close(self):
+        self.queue.put(None)
+        self.thread.join()
+        self.raise_error()
+
+    def raise_error(self):
+        if self.error is not None:
+            error, self.error = self.error, None
+            raise error
+
+
+def metadata_path(checkpoint_path):
+    return '{}.json'.format(os.path.splitext(checkpoint_path)[0])
+
+
+def index_path(model_directory):
+    return os.path.join(model_directory, 'index.json')
+
+
+def write_json_atomic(value, path):
+    temporary_path = '{}.{}.tmp'.format(path, os.getpid())
+    with open(temporary_path, 'w') as json_file:
+        json.dump(value, json_file, indent=2, sort_keys=True, default=str)
+    os.replace(temporary_path, path)
+
+
+def weights_hash(weights):
+    hashes = { key: tensor_hash(value) for key, value in weights.items() }
+    return keys_hash(hashes, hashes.keys())
+
+
+def checkpoint_metadata(model_name, checkpoint_path, checkpoint, config=None):
+    """Everything perf() prints about a checkpoint, without the weights."""
+    stat = os.stat(checkpoint_path)
+    metrics = { key: value for key, value in checkpoint.items()
+                if isinstance(value, (int, float)) and not isinstance(value, bool) }
+    return {
+        'model': model_name,
+        'checkpoint': os.path.basename(checkpoint_path),
+        'size': stat.st_size,
+        'mtime': stat.st_mtime_ns,
+        'metrics': metrics,
+        'weights_hash': weights_hash(checkpoint['weights']),
+        'delta_base': checkpoint.get('delta_base', {}).get('hash'),
+        'config': config
+    }
+
+
+def record_checkpoint(checkpoint_path, metadata):
+    """Writes the sidecar next to the checkpoint and updates the directory index."""
+    write_json_atomic(metadata, metadata_path(checkpoint_path))
+
+    model_directory = os.path.dirname(checkpoint_path)
+    # several runs share a models directory, the lock serializes index updates
+    with open('{}.lock'.format(index_path(model_directory)), 'w') as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        try:
+            index = read_index(model_directory)
+            index[metadata['model']] = metadata
+            write_json_atomic(index, index_path(model_directory))
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
+def read_index(model_directory):
+    path = index_path(model_directory)
+    if not os.path.isfile(path):
+        return {}
+    with open(path) as json_file:
+        return json.load(json_file)
+
+
+def is_current(metadata, checkpoint_path):
+    if metadata is None or not os.path.isfile(checkpoint_path):
+        return False
+    stat = os.stat(checkpoint_path)
+    return metadata['size'] == stat.st_size and metadata['mtime'] == stat.st_mtime_ns
+
+
+def rng_state():
+    state = {
+        'torch': torch.get_rng_state(),
+        'numpy': np.random.get_state(),
+        'python': random.getstate()
+    }
+    if torch.cuda.is_available():
+        state['cuda'] = torch.cuda.get_rng_state_all()
+    return state
+
+
+def set_rng_state(state):
+    torch.set_rng_state(state['torch'].cpu())
+    np.random.set_state(state['numpy'])
+    random.setstate(state['python'])
+    if 'cuda' in state and torch.cuda.is_available():
+        torch.cuda.set_rng_state_all([ s.cpu() for s in state['cuda'] ])
+
+
+def tensor_hash(tensor):
+    tensor = tensor.detach().to('cpu').contiguous()
+    digest = hashlib.sha1('{}{}'.format(tensor.dtype, tuple(tensor.shape)).encode())
+    digest.update(tensor.reshape(-1).view(torch.uint8).numpy().tobytes())
+    return digest.hexdigest()
+
+
+def keys_hash(hashes, keys):
+    digest = hashlib.sha1()
+    for key in sorted(keys):
+        digest.update(key.encode())
+        digest.update(hashes[key].encode())
+    return digest.hexdigest()
+
+
+def tensor_version(tensor):
+    # in-place updates (optimizer steps, running statistics, load_state_dict)
+    # bump _version, moving the model replaces the storage
+    return tensor.data_ptr(), tensor._version
+
+
+class DeltaState(object):
+    """Remembers the base state of a model so checkpoints only store what changed.
+
+    The base is the model as it is when the DeltaState is created: the
+    freshly constructed model (pretrained torchvision weights, loaded
+    autoencoders) or, when base_checkpoint_path is given, that checkpoint
+    loaded into it. Entries whose tensor was not modified since are left out
+    of the checkpoint and named in 'delta_base' together with a content hash,
+    so load_checkpoint_weights can check it rebuilds the same state.
+    """
+
+    def __init__(self, model, base_checkpoint_path=None):
+        self.base_checkpoint_path = base_checkpoint_path
+        self.versions = {}
+        self.hashes = {}
+        for key, value in model.state_dict(keep_vars=True).items():
+            self.versions[key] = tensor_version(value)
+            # trainable parameters are hashed lazily, they are stored anyway once trained
+            if not value.requires_grad:
+                self.hashes[key] = tensor_hash(value)
+
+    def weights(self, model):
+        weights = {}
+        base_keys = []
+        for key, value in model.state_dict(keep_vars=True).items():
+            if self.versions.get(key) == tensor_version(value):
+                if key not in self.hashes:
+                    self.hashes[key] = tensor_hash(value)
+                base_keys.append(key)
+            elif not value.requires_grad and key in self.hashes and tensor_hash(value) == self.hashes[key]:
+                # rewritten with the same values, e.g. by loading a full checkpoint
+                self.versions[key] = tensor_version(value)
+                base_keys.append(key)
+            else:
+                weights[key] = value.detach()
+        delta_base = {
+            'checkpoint': self.base_checkpoint_path,
+            'keys': base_keys,
+            'hash': keys_hash(self.hashes, base_keys)
+        }
+        return weights, delta_base
+
+
+def checkpoint_weights(model, delta_state=None):
+    if delta_state is None:
+        return {'weights': model.state_dict()}
+    weights, delta_base = delta_state.weights(model)
+    return {'weights': weights, 'delta_base': delta_base}
+
+
+def load_checkpoint_weights(model, checkpoint, device=None):
+    delta_base = checkpoint.get('delta_base')
+    if delta_base is None:
+        model.load_state_dict(checkpoint['weights'])
+        return model
+
+    if delta_base['checkpoint'] is not None:
+        if not os.path.isfile(delta_base['checkpoint']):
+            raise ValueError('Base Checkpoint Not Found: {}'.format(delta_base['checkpoint']))
+        load_checkpoint_weights(model, torch.load(delta_base['checkpoint'], map_location=device), device)
+
+    state = model.state_dict()
+    hashes = { key: tensor_hash(state[key]) for key in delta_base['keys'] if key in state }
+    if len(hashes) != len(delta_base['keys']) or keys_hash(hashes, delta_base['keys']) != delta_base['hash']:
+        raise ValueError('Model does not match the base of the delta checkpoint')
+
+    missing_keys, unexpected_keys = model.load_state_dict(checkpoint['weights'], strict=False)
+    if unexpected_keys or set(missing_keys) != set(delta_base['keys']):
+        raise ValueError('Delta checkpoint does not cover the model: missing {} unexpected {}'.format(
+            sorted(set(missing_keys) - set(delta_base['keys'])), unexpected_keys))
+    return model
+
+
+def resume_checkpoint_path(model_directory, model_name):
+    return os.path.join(model_directory, '{}.resume.ckpt'.format(model_name))
+
+
+def create_resume_checkpoint(epoch, position, sampler, model, optimizer, lr_scheduler=None, delta_state=None, **extra):
+    checkpoint = {
+        'epoch': epoch,
+        'position': position,
+        'sampler': sampler.state_dict(),
+        'rng': rng_state(),
+        'optimizer_weights': optimizer.state_dict()
+    }
+    checkpoint.update(checkpoint_weights(model, delta_state))
+    if lr_scheduler is not None:
+        checkpoint['scheduler'] = lr_scheduler.state_dict()
+    checkpoint.update(extra)
+    return checkpoint
+
+
+class StepCheckpointer(object):
+    """Step callback saving a resume checkpoint every few optimizer steps."""
+
+    def __init__(self, writer, path, every_steps, sampler, batch_size, create_checkpoint):
+        self.writer = writer
+        self.path = path
+        self.every_steps = every_steps
+        self.sampler = sampler
+        self.batch_size = batch_size
+        self.create_checkpoint = create_checkpoint
+        self.epoch = 1
+
+    def start_epoch(self, epoch, position=0):
+        self.epoch = epoch
+        self.sampler.set_epoch(epoch, position)
+
+    def __call__(self, batch_index):
+        if (batch_index + 1) % self.every_steps == 0:
+            position = self.sampler.start_index + (batch_index + 1) * self.batch_size * self.sampler.num_replicas
+            self.save(self.epoch, position)
+
+    def save(self, epoch, position):
+        self.writer.save(self.create_checkpoint(epoch, position), self.path)
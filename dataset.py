@@ -53,6 +53,7 @@ class ImageNet200Dataset(BaseDataset):
         self.INDEX_IMAGE = 1
         self.INDEX_TARGET = 2
         self.INDEX_LABEL = 3
+        self.INDEX_DATAPOINT = 4
 
     def loadDatapoint(self, idx):
         filepath = self.datapoints[idx]
@@ -65,7 +66,7 @@ class ImageNet200Dataset(BaseDataset):
             groundtruth = self.classes.index(filepath.split('/').pop().split('_')[0])
         if self.transforms:
             image = self.transforms(image)
-        return (filepath, image, groundtruth, self.descriptions[groundtruth])
+        return (filepath, image, groundtruth, self.descriptions[groundtruth], idx)
 
     def loadDataset(self):
         datapoints = []
@@ -141,6 +142,7 @@ class ImageNetDataset(BaseDataset):
         self.INDEX_IMAGE = 1
         self.INDEX_TARGET = 2
         self.INDEX_LABEL = 3
+        self.INDEX_DATAPOINT = 4
 
     def loadDatapoint(self, idx):
         filepath = self.datapoints[idx]
@@ -151,7 +153,7 @@ class ImageNetDataset(BaseDataset):
             groundtruth = self.classes.index(filepath.split('/').pop().split('_')[0])
         if self.transforms:
             image = self.transforms(image)
-        return (filepath, image, groundtruth, self.descriptions[groundtruth])
+        return (filepath, image, groundtruth, self.descriptions[groundtruth], idx)
 
     def loadDataset(self):
         datapoints = []
@@ -226,6 +228,7 @@ class ImageNet200PairDataset(BaseDataset):
         self.INDEX_TARGET_IMAGE = 3
         self.INDEX_TARGET = 4
         self.INDEX_LABEL = 5
+        self.INDEX_DATAPOINT = 6
         self.target_transforms = target_transforms
 
     def loadImage(self, filepath):
@@ -258,7 +261,7 @@ class ImageNet200PairDataset(BaseDataset):
         if self.transforms:
             input_image = self.transforms(input_image)
             target_image = self.target_transforms(target_image)
-        return (input_filepath, target_filepath, input_image, target_image, groundtruth, self.descriptions[groundtruth])
+        return (input_filepath, target_filepath, input_image, target_image, groundtruth, self.descriptions[groundtruth], idx)
 
     def loadDataset(self):
         datapoints = []
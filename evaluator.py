@@ -0,0 +1,129 @@
+import sys
+import copy
+import queue
+import logging
+import traceback
+import contextlib
+import torch
+import torch.multiprocessing as multiprocessing
+from torch.utils.data import DataLoader
+
+
+def log_files(logger):
+    return [ (handler.baseFilename, handler.level) for handler in logger.handlers
+        if isinstance(handler, logging.FileHandler) ]
+
+
+def create_worker_logger(files):
+    # appends to the parent's log files, lines of both processes interleave
+    logger = logging.getLogger('validation')
+    logger.propagate = False
+    formatter = logging.Formatter('%(asctime)s %(name)s %(levelname)s %(message)s')
+    for filename, level in files:
+        handler = logging.FileHandler(filename)
+        handler.setFormatter(formatter)
+        handler.setLevel(level)
+        logger.addHandler(handler)
+    logger.setLevel(logging.DEBUG)
+    return logger
+
+
+def validation_worker(snapshot_model, dataset, batch_size, number_of_workers, validate_function, device, files,
+        requests, results):
+    logger = create_worker_logger(files)
+    loader = DataLoader(dataset, batch_size=batch_size, shuffle=False, num_workers=number_of_workers)
+    model = copy.deepcopy(snapshot_model).to(device)
+    while True:
+        request = requests.get()
+        if request is None:
+            break
+        epoch, arguments = request
+        try:
+            model.load_state_dict(snapshot_model.state_dict())
+            results.put((epoch, validate_function(model, loader, logger=logger, device=device, **arguments)))
+        except Exception:
+            results.put((epoch, RuntimeError('Validation of epoch {} failed:\n{}'.format(epoch, traceback.format_exc()))))
+
+
+@contextlib.contextmanager
+def without_main_script():
+    # spawned children run the parent's main script again to rebuild its module,
+    # run.py trains at import time, the worker only needs importable modules
+    main = sys.modules['__main__']
+    main_file = main.__dict__.pop('__file__', None)
+    try:
+        yield
+    finally:
+        if main_file is not None:
+            main.__file__ = main_file
+
+
+class AsyncValidator(object):
+    """Validates weight snapshots in a separate process while training goes on.
+
+    submit() copies the weights into a model in shared memory and returns,
+    the worker scores them with validate_function on its own loader over
+    the same dataset. There is a single snapshot, so collect() has to fetch
+    the scores of a submission before the next one, which bounds the lag of
+    the scores behind training to one epoch. snapshot_model keeps the
+    submitted weights until then.
+
+    Raises on construction when the model or dataset cannot be sent to the
+    worker, e.g. compiled models or transforms with lambdas.
+    """
+
+    def __init__(self, model, val_loader, validate_function, device, logger):
+        self.snapshot_model = copy.deepcopy(model).cpu().share_memory()
+        self.snapshot_model.eval()
+        context = multiprocessing.get_context('spawn')
+        self.requests = context.Queue()
+        self.results = context.Queue()
+        self.process = context.Process(target=validation_worker, daemon=True,
+            args=(self.snapshot_model, val_loader.dataset, val_loader.batch_size, val_loader.num_workers,
+                validate_function, device, log_files(logger), self.requests, self.results))
+        with without_main_script():
+            self.process.start()
+        self.pending = None
+
+    def submit(self, epoch, model, **arguments):
+        assert self.pending is None, 'collect the scores of epoch {} first'.format(self.pending)
+        with torch.no_grad():
+            for snapshot_value, value in zip(self.snapshot_model.state_dict().values(), model.state_dict().values()):
+                snapshot_value.copy_(value)
+        self.requests.put((epoch, arguments))
+        self.pending = epoch
+
+    def collect(self):
+        """(epoch, scores) of the pending submission, waiting for it, or None."""
+        if self.pending is None:
+            return None
+        while True:
+            try:
+                epoch, scores = self.results.get(timeout=60)
+                break
+            except queue.Empty:
+                if not self.process.is_alive():
+                    raise RuntimeError('Validation worker exited with code {}'.format(self.process.exitcode))
+        self.pending = None
+        if isinstance(scores, Exception):
+            raise scores
+        return epoch, scores
+
+    def close(self):
+        if self.process.is_alive():
+            self.requests.put(None)
+            self.process.join()
+
+
+def create_async_validator(model, val_loader, validate_function, device, logger):
+    """AsyncValidator for model, or None when it cannot validate in another process."""
+    if getattr(model, 'input_stores', None):
+        logger.info('Asynchronous Validation False: the model reads on-disk input stores')
+        return None
+    try:
+        validator = AsyncValidator(model, val_loader, validate_function, device, logger)
+    except Exception as error:
+        logger.info('Asynchronous Validation False: {}'.format(error))
+        return None
+    logger.info('Asynchronous Validation True')
+    return validator
@@ -0,0 +1,207 @@
+# coding: utf-8
+
+# In[1]: Load Libraries
+
+# native
+import json
+import argparse
+
+# modules
+from utils import roundUp
+from betavae import BetaVAE_H
+from dataset import DeNormalize
+from vgg19 import create_supported_models
+from checkpoint import load_checkpoint_weights
+from inference import optimize_for_inference, first_output
+
+# pytorch
+import torch
+import torchvision.transforms as transforms
+
+imagenet_normalization_values = {
+    'mean': [0.485, 0.456, 0.406],
+    'std': [0.229, 0.224, 0.225]
+}
+
+EXPORT_FORMATS = ['torchscript', 'onnx']
+
+# models built on a trained autoencoder, they need its checkpoint
+AUTOENCODER_BASED_MODELS = ('classifier_z', 'latent_')
+
+
+# In[2]: Preprocessing
+
+class Preprocess(torch.nn.Module):
+    """The evaluation transforms of run.py on uint8 RGB batches.
+
+    Resizes the smaller edge to resize_size (or both edges when keep_aspect
+    is off), center crops to crop_size when it is positive and normalizes
+    when mean and std are given. The resize is rounded to 8 bits like the
+    PIL images the models were trained on.
+    """
+
+    def __init__(self, resize_size, crop_size=0, mean=None, std=None, keep_aspect=True, antialias=True):
+        super(Preprocess, self).__init__()
+        self.resize_size = resize_size
+        self.crop_size = crop_size
+        self.keep_aspect = keep_aspect
+        self.antialias = antialias
+        self.normalize = mean is not None
+        self.register_buffer('mean', torch.tensor(mean if mean is not None else [0.0, 0.0, 0.0]).view(1, 3, 1, 1))
+        self.register_buffer('std', torch.tensor(std if std is not None else [1.0, 1.0, 1.0]).view(1, 3, 1, 1))
+
+    def forward(self, images):
+        height, width = images.size(2), images.size(3)
+        if not self.keep_aspect:
+            size = [self.resize_size, self.resize_size]
+        elif height <= width:
+            size = [self.resize_size, int(self.resize_size * width / height)]
+        else:
+            size = [int(self.resize_size * height / width), self.resize_size]
+        x = torch.nn.functional.interpolate(images.float(), size=size, mode='bilinear', align_corners=False,
+            antialias=self.antialias)
+        x = x.round().clamp(0, 255) / 255
+        if self.crop_size > 0:
+            top = int(round((x.size(2) - self.crop_size) / 2.0))
+            left = int(round((x.size(3) - self.crop_size) / 2.0))
+            x = x[:, :, top:top + self.crop_size, left:left + self.crop_size]
+        if self.normalize:
+            x = (x - self.mean) / self.std
+        return x
+
+
+class AutoencoderClassifier(torch.nn.Module):
+    """Logits of an autoencoder from the mean of its encoding, its decoder is left out."""
+
+    def __init__(self, autoencoder):
+        super(AutoencoderClassifier, self).__init__()
+        self.encoder = autoencoder.encoder
+        self.classifier = autoencoder.classifier
+        self.z_dim = autoencoder.z_dim
+
+    def forward(self, x):
+        return self.classifier(self.encoder(x)[:, :self.z_dim])
+
+
+class ExportedClassifier(torch.nn.Module):
+    def __init__(self, preprocess, model):
+        super(ExportedClassifier, self).__init__()
+        self.preprocess = preprocess
+        self.model = model
+
+    def forward(self, images):
+        return self.model(self.preprocess(images))
+
+
+def create_preprocess(model_name, config, antialias=True):
+    # autoencoder models see the whole image at the autoencoder size, unnormalized
+    if 'vae' in model_name or 'classifier_z' in model_name:
+        return Preprocess(config.vaeImageSize, keep_aspect=False, antialias=antialias)
+    return Preprocess(roundUp(config.inputSize), config.inputSize,
+        imagenet_normalization_values['mean'], imagenet_normalization_values['std'], antialias=antialias)
+
+
+# In[3]: Export
+
+def load_model(config):
+    vae_transforms = transforms.Compose([
+        DeNormalize(**imagenet_normalization_values),
+        transforms.ToPILImage(),
+        transforms.Resize((config.vaeImageSize, config.vaeImageSize)),
+        transforms.ToTensor()
+    ])
+    device = torch.device('cpu')
+    supported_models = create_supported_models(config.zdim, config.beta, config.gamma,
+        config.vaeCheckpoint, device, vae_transforms)
+    if config.model not in supported_models:
+        raise ValueError('Unknown model {}, expected one of {}'.format(config.model, ', '.join(supported_models)))
+
+    model = supported_models[config.model]()
+    load_checkpoint_weights(model, torch.load(config.checkpoint, map_location=device), device)
+    if isinstance(model, BetaVAE_H):
+        model = AutoencoderClassifier(model)
+    return model.eval()
+
+
+def export(config):
+    model = load_model(config)
+    # ONNX exporters differ in their support of antialiased resizing
+    preprocess = create_preprocess(config.model, config, antialias=config.format != 'onnx').eval()
+    example = torch.randint(0, 256, (2, 3, config.imageSize, config.imageSize), dtype=torch.uint8)
+    model_input = preprocess(example)
+    if config.optimize:
+        model = optimize_for_inference(model, model_input)
+
+    with torch.no_grad():
+        expected = first_output(model(model_input))
+        if config.format == 'torchscript':
+            # the model is traced at its fixed input size, preprocessing is scripted for any image size
+            traced_model = torch.jit.trace(model, model_input)
+            exported = torch.jit.script(ExportedClassifier(torch.jit.script(preprocess), traced_model))
+            torch.jit.save(exported, config.output)
+            actual = torch.jit.load(config.output)(example)
+        else:
+            torch.onnx.export(ExportedClassifier(preprocess, model), (example,), config.output,
+                input_names=['images'], output_names=['logits'],
+                dynamic_axes={ 'images': {0: 'batch'}, 'logits': {0: 'batch'} }, opset_version=config.opset)
+            actual = None
+
+    if actual is not None:
+        difference = (actual - expected).abs().max().item()
+        print('max abs difference to the eager model: {:.3e}'.format(difference))
+
+    metadata = {
+        'model': config.model,
+        'checkpoint': config.checkpoint,
+        'format': config.format,
+        'input': 'uint8 RGB images, NCHW',
+        # ONNX graphs are exported for images of this size only
+        'image_size': config.imageSize if config.format == 'onnx' else None,
+        # images are fitted to image_size like the preprocessing fits them to the model
+        'keep_aspect': preprocess.keep_aspect,
+        'number_of_classes': expected.size(1)
+    }
+    with open(config.output + '.json', 'w') as metadata_file:
+        json.dump(metadata, metadata_file, indent=2)
+    print('Exported {} to {}'.format(config.model, config.output))
+
+
+# In[4]: Main
+
+def export_configuration():
+    parser = argparse.ArgumentParser(formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+        description='export a trained model with its evaluation preprocessing for run-time inference')
+    parser.add_argument('--model', type=str, required=True,
+                        help='name of the model in the supported models table')
+    parser.add_argument('--checkpoint', type=str, required=True,
+                        help='checkpoint of the trained model')
+    parser.add_argument('--output', type=str, required=True,
+                        help='path of the exported artifact, its metadata is written next to it as .json')
+    parser.add_argument('--format', type=str, default='torchscript', choices=EXPORT_FORMATS,
+                        help='artifact format')
+    parser.add_argument('--opset', type=int, default=17,
+                        help='ONNX opset version')
+    parser.add_argument('--imageSize', type=int, default=256,
+                        help='extent of the example images, the only size ONNX artifacts accept')
+    parser.add_argument('--noOptimize', dest='optimize', action='store_false',
+                        help='export the model without optimize_for_inference')
+    parser.add_argument('--inputSize', type=int, default=224,
+                        help='extent of input layer in the network')
+    parser.add_argument('--vaeImageSize', type=int, default=128,
+                        help='extent of input and target layer in the autoencoder')
+    parser.add_argument('--vaeCheckpoint', type=str, default=None,
+                        help='autoencoder checkpoint the latent models are built on')
+    parser.add_argument('--zdim', type=int, default=128,
+                        help='latent space dimension size for the betavae')
+    parser.add_argument('--beta', type=float, default=0.2,
+                        help='beta value in the autoencoder model names')
+    parser.add_argument('--gamma', type=float, default=0.0,
+                        help='gamma value in the autoencoder model names')
+    args = parser.parse_args()
+    if args.model.startswith(AUTOENCODER_BASED_MODELS) and args.vaeCheckpoint is None:
+        parser.error('--vaeCheckpoint is required to export {}'.format(args.model))
+    return args
+
+
+if __name__ == '__main__':
+    export(export_configuration())
@@ -0,0 +1,388 @@
+import os
+import re
+import copy
+import random
+import json
+import hashlib
+import numpy as np
+import torch
+from torch.utils.data import Dataset, DataLoader
+from tqdm import tqdm
+from utils import pathJoin, is_frozen, run_frozen
+from taps import FeatureTaps, model_taps
+
+
+def has_frozen_backbone(model):
+    features = getattr(model, 'features', None)
+    if features is None or not hasattr(model, 'classifier'):
+        return False
+    return all(not parameter.requires_grad for parameter in features.parameters())
+
+
+def extract_backbone(model, x):
+    # run the model with its head removed, the flattened pooled features (and
+    # the similarity scores of similarity models) come out instead of logits
+    taps = model_taps(model)
+    classifier = model.classifier
+    model.classifier = torch.nn.Identity()
+    try:
+        if taps is None:
+            return model(x), None
+        with taps.collect() as tapped:
+            output = model(x)
+        return output, taps.stacked(tapped)
+    finally:
+        model.classifier = classifier
+
+
+class FeatureStore(object):
+    """Memory-mapped fp16 pooled features of a frozen backbone.
+
+    One row per datapoint and view, view 0 holds the deterministic (center
+    crop) view and the remaining views hold precomputed augmentations.
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+        with open(self.path('meta.json'), 'r') as meta_file:
+            self.meta = json.load(meta_file)
+        self.number_of_views = self.meta['views']
+        self.features = np.load(self.path('features.npy'), mmap_mode='r')
+        self.targets = np.load(self.path('targets.npy'), mmap_mode='r')
+        self.similarity = np.load(self.path('similarity.npy'), mmap_mode='r') if self.meta['similarity_size'] else None
+
+    def path(self, filename):
+        return pathJoin(self.directory, filename)
+
+    def __len__(self):
+        return self.features.shape[1]
+
+    @staticmethod
+    def exists(directory, key):
+        # a store built from other inputs, transforms or weights is stale
+        meta_path = pathJoin(directory, 'meta.json')
+        if not os.path.isfile(meta_path):
+            return False
+        with open(meta_path, 'r') as meta_file:
+            meta = json.load(meta_file)
+        return all(meta.get(name) == value for name, value in key.items())
+
+    @staticmethod
+    def build(model, directory, view_datasets, key, batch_size, number_of_workers, device, seed=0):
+        os.makedirs(directory, exist_ok=True)
+        number_of_datapoints = len(view_datasets[0])
+        features, targets, similarity = None, None, None
+
+        model.eval()
+        for view, dataset in enumerate(view_datasets):
+            loader = DataLoader(dataset, batch_size=batch_size, shuffle=False, num_workers=number_of_workers)
+            offset = 0
+            # augmented views are drawn from a fixed seed so a rebuilt store
+            # is identical, without disturbing the training random state
+            with torch.random.fork_rng(devices=[]):
+                torch.manual_seed(seed + view)
+                with torch.no_grad():
+                    for batch in tqdm(loader):
+                        batch_features, batch_similarity = extract_backbone(
+                            model, batch[dataset.INDEX_IMAGE].to(device))
+                        if features is None:
+                            features = np.lib.format.open_memmap(pathJoin(directory, 'features.npy'), mode='w+',
+                                dtype=np.float16, shape=(len(view_datasets), number_of_datapoints, batch_features.size(1)))
+                            targets = np.lib.format.open_memmap(pathJoin(directory, 'targets.npy'), mode='w+',
+                                dtype=np.int64, shape=(number_of_datapoints,))
+                            if batch_similarity is not None:
+                                similarity = np.lib.format.open_memmap(pathJoin(directory, 'similarity.npy'), mode='w+',
+                                    dtype=np.float32, shape=(len(view_datasets), number_of_datapoints, batch_similarity.size(1)))
+                        size = batch_features.size(0)
+                        features[view, offset:offset + size] = batch_features.cpu().numpy().astype(np.float16)
+                        if batch_similarity is not None:
+                            similarity[view, offset:offset + size] = batch_similarity.cpu().numpy()
+                        if view == 0:
+                            targets[offset:offset + size] = batch[dataset.INDEX_TARGET].numpy()
+                        offset += size
+
+        for array in [features, targets, similarity]:
+            if array is not None:
+                array.flush()
+
+        # the meta file is written last, an interrupted build is rebuilt
+        meta = {
+            'views': len(view_datasets),
+            'datapoints': number_of_datapoints,
+            'feature_size': features.shape[2],
+            'similarity_size': similarity.shape[2] if similarity is not None else 0
+        }
+        meta.update(key)
+        with open(pathJoin(directory, 'meta.json'), 'w') as meta_file:
+            json.dump(meta, meta_file)
+
+        return FeatureStore(directory)
+
+
+class CachedFeatureDataset(Dataset):
+
+    def __init__(self, store, views):
+        self.store = store
+        self.views = views
+        self.INDEX_IMAGE = 1
+        self.INDEX_TARGET = 2
+
+    def __len__(self):
+        return len(self.store)
+
+    def __getitem__(self, idx):
+        view = self.views[random.randrange(len(self.views))]
+        features = torch.from_numpy(np.array(self.store.features[view, idx], dtype=np.float32))
+        if self.store.similarity is not None:
+            similarity = torch.from_numpy(np.array(self.store.similarity[view, idx], dtype=np.float32))
+            features = torch.cat([features, similarity])
+        return (idx, features, int(self.store.targets[idx]))
+
+
+class FeatureCacheHead(torch.nn.Module):
+    def __init__(self, classifier, feature_size):
+        super(FeatureCacheHead, self).__init__()
+        self.classifier = classifier
+        self.feature_size = feature_size
+        # the cached similarity scores are collected like those of the backbone taps
+        self.taps = FeatureTaps(self, [])
+
+    def forward(self, x):
+        for similarity in x[:, self.feature_size:].unbind(dim=1):
+            self.taps.record(similarity)
+        return self.classifier(x[:, :self.feature_size])
+
+
+def with_transforms(dataset, transforms):
+    view_dataset = copy.copy(dataset)
+    view_dataset.transforms = transforms
+    return view_dataset
+
+
+def feature_cache_key(model, view_datasets):
+    """What the cached features of view_datasets depend on, written to meta.json."""
+    dataset = view_datasets[0]
+    backbone = { name: value for name, value in model.state_dict().items() if not name.startswith('classifier.') }
+    return {
+        'views': len(view_datasets),
+        'datapoints': len(dataset),
+        'input_size': list(dataset[0][dataset.INDEX_IMAGE].shape),
+        'transforms': [ transforms_key(view_dataset.transforms) for view_dataset in view_datasets ],
+        'backbone': state_hash(backbone)
+    }
+
+
+def create_feature_cache(model, model_name, train_loader, val_loader, cache_directory, number_of_views, device, logger):
+    # view 0 of the training store uses the deterministic validation transforms
+    train_datasets = [ with_transforms(train_loader.dataset, val_loader.dataset.transforms) ] \
+        + [ train_loader.dataset ] * number_of_views
+    stores = {}
+    for split, view_datasets in [('train', train_datasets), ('val', [val_loader.dataset])]:
+        directory = pathJoin(cache_directory, model_name, split)
+        key = feature_cache_key(model, view_datasets)
+        if FeatureStore.exists(directory, key):
+            logger.info('Using feature cache {}'.format(directory))
+            stores[split] = FeatureStore(directory)
+        else:
+            logger.info('Building feature cache {} with {} views'.format(directory, len(view_datasets)))
+            stores[split] = FeatureStore.build(model, directory, view_datasets, key,
+                train_loader.batch_size, train_loader.num_workers, device)
+
+    cached_train_loader = DataLoader(CachedFeatureDataset(stores['train'], list(range(stores['train'].number_of_views))),
+        batch_size=train_loader.batch_size, shuffle=True, num_workers=train_loader.num_workers)
+    cached_val_loader = DataLoader(CachedFeatureDataset(stores['val'], [0]),
+        batch_size=val_loader.batch_size, shuffle=False, num_workers=val_loader.num_workers)
+    head = FeatureCacheHead(model.classifier, stores['train'].meta['feature_size'])
+
+    return head, cached_train_loader, cached_val_loader
+
+
+# In[2]: Per-datapoint stores
+
+def file_hash(path, chunk_size=1 << 20):
+    digest = hashlib.sha1()
+    with open(path, 'rb') as hashed_file:
+        for chunk in iter(lambda: hashed_file.read(chunk_size), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def transforms_key(transforms):
+    # object addresses (lambdas in the bilateral transforms) change between runs
+    return hashlib.sha1(re.sub(r' at 0x[0-9a-f]+', '', repr(transforms)).encode()).hexdigest()[:12]
+
+
+class DatapointStore(object):
+    """Rows computed from single datapoints, memory-mapped and filled lazily.
+
+    Rows are keyed by (store key, dataset, split, transforms, datapoint index),
+    where the store key identifies the weights that produced them. The row
+    shape is taken from the first encoded image when it is not given.
+    """
+
+    def __init__(self, directory, key=None, row_shape=None, dtype=np.float32):
+        self.root_directory = directory
+        self.key = key
+        self.row_shape = tuple(row_shape) if row_shape is not None else None
+        self.dtype = dtype
+        self.arrays = {}
+
+    def encode(self, images):
+        raise NotImplementedError('Function "encode" is not implemented')
+
+    def resolve_key(self):
+        return self.key
+
+    def canonical_transforms(self, dataset, training):
+        return dataset.transforms
+
+    def arrays_for(self, dataset, transforms, images):
+        dataset_key = '{}_{}_{}'.format(os.path.basename(os.path.dirname(dataset.directory)),
+            dataset.split, transforms_key(transforms))
+        if dataset_key not in self.arrays:
+            if self.key is None:
+                self.key = self.resolve_key()
+            if self.row_shape is None:
+                with torch.no_grad():
+                    self.row_shape = tuple(self.encode(images[:1]).shape[1:])
+            directory = pathJoin(self.root_directory, self.key)
+            os.makedirs(directory, exist_ok=True)
+            values_path = pathJoin(directory, '{}.npy'.format(dataset_key))
+            filled_path = pathJoin(directory, '{}.filled.npy'.format(dataset_key))
+            if os.path.isfile(values_path) and os.path.isfile(filled_path):
+                values = np.load(values_path, mmap_mode='r+')
+                filled = np.load(filled_path, mmap_mode='r+')
+            else:
+                values = np.lib.format.open_memmap(values_path, mode='w+', dtype=self.dtype,
+                    shape=(len(dataset),) + self.row_shape)
+                filled = np.lib.format.open_memmap(filled_path, mode='w+', dtype=np.bool_, shape=(len(dataset),))
+            self.arrays[dataset_key] = (values, filled)
+        return self.arrays[dataset_key]
+
+    def lookup(self, dataset, indices, input, training):
+        transforms = self.canonical_transforms(dataset, training)
+        if transforms is None:
+            return None
+        values, filled = self.arrays_for(dataset, transforms, input)
+        indices = np.asarray(indices)
+        missing = ~filled[indices]
+        if missing.any():
+            if transforms is dataset.transforms:
+                # the batch itself is the canonical view of its datapoints
+                images = input[torch.from_numpy(np.nonzero(missing)[0]).to(input.device)]
+            else:
+                canonical_dataset = with_transforms(dataset, transforms)
+                images = torch.stack([ canonical_dataset[i][dataset.INDEX_IMAGE] for i in indices[missing] ]).to(input.device)
+            self.fill(values, filled, indices[missing], images)
+        return torch.from_numpy(np.array(values[indices])).to(input.device)
+
+    def fill(self, values, filled, indices, images):
+        with torch.no_grad():
+            rows = self.encode(images)
+        values[indices] = rows.cpu().numpy().astype(self.dtype)
+        filled[indices] = True
+
+    def build(self, dataset, batch_size, number_of_workers, device, training):
+        transforms = self.canonical_transforms(dataset, training)
+        if transforms is None:
+            return
+        canonical_dataset = with_transforms(dataset, transforms)
+        sample = canonical_dataset[0][dataset.INDEX_IMAGE].unsqueeze(0).to(device)
+        values, filled = self.arrays_for(dataset, transforms, sample)
+        if filled.all():
+            return
+        loader = DataLoader(canonical_dataset, batch_size=batch_size, shuffle=False, num_workers=number_of_workers)
+        for batch in tqdm(loader):
+            indices = batch[dataset.INDEX_DATAPOINT].numpy()
+            self.fill(values, filled, indices, batch[dataset.INDEX_IMAGE].to(device))
+        values.flush()
+        filled.flush()
+
+
+class LatentStore(DatapointStore):
+    """Latent means of a frozen BetaVAE_H encoder, keyed by its checkpoint hash.
+
+    Training batches are augmented, so their latents are taken from the
+    deterministic evaluation view of each datapoint.
+    """
+
+    def __init__(self, directory, model, vae_checkpoint_path, z_dim, transforms):
+        super(LatentStore, self).__init__(directory, file_hash(vae_checkpoint_path), (z_dim,))
+        self.model = model
+        self.transforms = transforms
+
+    def encode(self, images):
+        return self.model.encode_latents(images)
+
+    def canonical_transforms(self, dataset, training):
+        return self.transforms if training else dataset.transforms
+
+
+class PrefixStore(DatapointStore):
+    """Outputs of a frozen VGG_IN prefix (features1) for deterministic inputs.
+
+    Only evaluation batches are served, and only while the prefix stays
+    frozen, so features2 and the classifier are all that is recomputed.
+    """
+
+    def __init__(self, directory, model):
+        super(PrefixStore, self).__init__(directory, dtype=np.float16)
+        self.model = model
+
+    def resolve_key(self):
+        return state_hash(self.model.features1.state_dict())
+
+    def encode(self, images):
+        return run_frozen(self.model.features1, images)
+
+    def canonical_transforms(self, dataset, training):
+        if training or not is_frozen(self.model.features1):
+            return None
+        return dataset.transforms
+
+    def build(self, dataset, batch_size, number_of_workers, device, training):
+        # evaluation batches fill the store lazily
+        pass
+
+
+def state_hash(state_dict):
+    digest = hashlib.sha1()
+    for key, value in state_dict.items():
+        digest.update(key.encode())
+        digest.update(value.detach().cpu().contiguous().numpy().tobytes())
+    return digest.hexdigest()
+
+
+def attach_prefix_store(model, cache_directory):
+    if hasattr(model, 'forward_prefix') and is_frozen(model.features1):
+        if not hasattr(model, 'input_stores'):
+            model.input_stores = {}
+        model.input_stores['prefix'] = PrefixStore(cache_directory, model)
+    return model
+
+
+def with_prefix_store(model_constructor, cache_directory):
+    def assemble_model():
+        return attach_prefix_store(model_constructor(), cache_directory)
+    return assemble_model
+
+
+def attach_latent_store(model, vae_checkpoint_path, cache_directory, transforms):
+    if hasattr(model, 'encode_latents') and os.path.isfile(vae_checkpoint_path):
+        if not hasattr(model, 'input_stores'):
+            model.input_stores = {}
+        model.input_stores['latents'] = LatentStore(cache_directory, model, vae_checkpoint_path,
+            model.z_dim, transforms)
+    return model
+
+
+def with_latent_store(model_constructor, vae_checkpoint_path, cache_directory, transforms):
+    def assemble_model():
+        return attach_latent_store(model_constructor(), vae_checkpoint_path, cache_directory, transforms)
+    return assemble_model
+
+
+def build_input_stores(model, train_loader, val_loader, device):
+    for store in getattr(model, 'input_stores', {}).values():
+        store.build(train_loader.dataset, train_loader.batch_size, train_loader.num_workers, device, training=True)
+        store.build(val_loader.dataset, val_loader.batch_size, val_loader.num_workers, device, training=False)
@@ -0,0 +1,149 @@
+import copy
+import torch
+from batchinstancenorm import _BatchInstanceNorm, channel_view
+from instancenormbatchswap import InstanceNormBatchSwap
+from taps import model_taps
+
+
+class ChannelAffine(torch.nn.Module):
+    """x * scale + shift per channel, what an evaluation-mode batch norm reduces to."""
+
+    def __init__(self, scale, shift):
+        super(ChannelAffine, self).__init__()
+        self.register_buffer('scale', scale)
+        self.register_buffer('shift', shift)
+
+    def forward(self, x):
+        return torch.addcmul(channel_view(self.shift, x), x, channel_view(self.scale, x))
+
+
+class LeanBatchInstanceNorm(torch.nn.Module):
+    """Evaluation-mode batch-instance norm with its batch branch folded into a per-channel affine.
+
+    Only the instance statistics are computed, in one var_mean, and both
+    branches are applied as a single scale and shift per sample and channel.
+    """
+
+    def __init__(self, scale, shift, in_weight, eps):
+        super(LeanBatchInstanceNorm, self).__init__()
+        self.register_buffer('scale', scale)
+        self.register_buffer('shift', shift)
+        self.register_buffer('in_weight', in_weight)
+        self.eps = eps
+
+    def forward(self, x):
+        var, mean = torch.var_mean(x, dim=tuple(range(2, x.dim())), unbiased=False)
+        in_scale = self.in_weight * torch.rsqrt(var + self.eps)
+        return torch.addcmul(channel_view(self.shift - in_scale * mean, x), x, channel_view(self.scale + in_scale, x))
+
+
+def running_affine(layer, weight, bias):
+    # x * scale + shift is the normalization by the running statistics followed by weight and bias
+    scale = torch.rsqrt(layer.running_var + layer.eps)
+    if weight is not None:
+        scale = scale * weight
+    shift = -layer.running_mean * scale
+    if bias is not None:
+        shift = shift + bias
+    return scale, shift
+
+
+def fold_into_conv(conv, scale, shift):
+    folded = copy.deepcopy(conv)
+    folded.weight.copy_(conv.weight * channel_view(scale, conv.weight).to(conv.weight.dtype))
+    bias = conv.bias if conv.bias is not None else torch.zeros_like(shift)
+    folded.bias = torch.nn.Parameter((bias * scale + shift).to(conv.weight.dtype), requires_grad=False)
+    return folded
+
+
+def normalization_affine(layer):
+    """(scale, shift, in_weight) of a normalization layer in evaluation mode, or None."""
+    if isinstance(layer, torch.nn.BatchNorm2d) and layer.running_mean is not None:
+        return running_affine(layer, layer.weight, layer.bias) + (None,)
+    if isinstance(layer, _BatchInstanceNorm) and layer.running_mean is not None:
+        bn_weight, in_weight = layer.gate_weights()
+        return running_affine(layer, bn_weight, layer.bias) + (in_weight,)
+    return None
+
+
+def simplified(layer, previous=None):
+    """(replacement of layer, replacement of the conv before it) for evaluation, or None."""
+    if isinstance(layer, InstanceNormBatchSwap):
+        # the swap only happens in training
+        return torch.nn.Identity(), previous
+    affine = normalization_affine(layer)
+    if affine is None:
+        return None
+    scale, shift, in_weight = affine
+    if in_weight is None or not in_weight.any():
+        if isinstance(previous, torch.nn.Conv2d):
+            return torch.nn.Identity(), fold_into_conv(previous, scale, shift)
+        return ChannelAffine(scale, shift), previous
+    if not scale.any():
+        # saturated to the instance branch, only the batch bias is left of the other one
+        instance_norm = torch.nn.InstanceNorm2d(scale.numel(), eps=layer.eps, affine=True)
+        instance_norm.weight = torch.nn.Parameter(in_weight.clone(), requires_grad=False)
+        instance_norm.bias = torch.nn.Parameter(shift.clone(), requires_grad=False)
+        return instance_norm, previous
+    return LeanBatchInstanceNorm(scale, shift, in_weight, layer.eps), previous
+
+
+def optimize_modules(module):
+    for name, child in list(module.named_children()):
+        if isinstance(child, torch.nn.Sequential):
+            # folding needs the conv before the normalization layer
+            for index in range(len(child)):
+                replacement = simplified(child[index], child[index - 1] if index > 0 else None)
+                if replacement is None:
+                    optimize_modules(child[index])
+                    continue
+                child[index], previous = replacement
+                if index > 0:
+                    child[index - 1] = previous
+            continue
+        replacement = simplified(child)
+        if replacement is None:
+            optimize_modules(child)
+        else:
+            setattr(module, name, replacement[0])
+
+
+def first_output(output):
+    # autoencoders return the logits first
+    return output[0] if isinstance(output, tuple) else output
+
+
+def verify_inference(model, optimized, input, rtol=1e-4, atol=1e-4):
+    """Largest absolute difference of the outputs of both models, raises when they disagree."""
+    training = model.training
+    model.eval()
+    with torch.no_grad():
+        expected = first_output(model(input))
+        actual = first_output(optimized(input))
+    model.train(training)
+    difference = (actual - expected).abs().max().item()
+    if not torch.allclose(actual, expected, rtol=rtol, atol=atol):
+        raise ValueError('Optimized model differs from the original by up to {:.3e}'.format(difference))
+    return difference
+
+
+def optimize_for_inference(model, example_input=None):
+    """Evaluation-only copy of model with its normalization layers simplified.
+
+    Batch norms are folded into the convolution before them, batch-instance
+    norms lose their batch branch to a folded affine and run the instance
+    branch lean, batch swaps are dropped and similarity taps are removed.
+    The copy is checked against model on example_input when one is given.
+    """
+    optimized = copy.deepcopy(model).eval()
+    with torch.no_grad():
+        optimize_modules(optimized)
+    taps = model_taps(optimized)
+    if taps is not None:
+        taps.remove()
+        del optimized.taps
+    for parameter in optimized.parameters():
+        parameter.requires_grad = False
+    if example_input is not None:
+        verify_inference(model, optimized, example_input)
+    return optimized
@@ -1,5 +1,64 @@
 import torch
 
+
+class InstanceNormBatchSwapFunction(torch.autograd.Function):
+    """Instance normalization that restyles sample b with the statistics of sample indices[b].
+
+    Mean and variance come from a single var_mean and the normalization and
+    swapped re-affine fold into one scale and shift per sample and channel.
+    Only the input and those per-channel statistics are kept for backward,
+    which also passes the gradient on to the samples whose statistics were
+    borrowed.
+    """
+
+    @staticmethod
+    def forward(ctx, input, indices, eps):
+        dims = tuple(range(2, input.dim()))
+        var, mean = torch.var_mean(input, dim=dims, unbiased=True)
+        # statistics are kept in at least single precision
+        dtype = torch.promote_types(input.dtype, torch.float32)
+        var, mean = var.to(dtype), mean.to(dtype)
+        scale = var.sqrt().index_select(0, indices) * torch.rsqrt(var + eps)
+        shift = mean.index_select(0, indices) - mean * scale
+
+        ctx.eps = eps
+        ctx.save_for_backward(input, indices, mean, var)
+        view = (input.size(0), input.size(1)) + (1,) * len(dims)
+        return torch.addcmul(shift.view(view).to(input.dtype), input, scale.view(view).to(input.dtype))
+
+    @staticmethod
+    def backward(ctx, grad_output):
+        input, indices, mean, var = ctx.saved_tensors
+        dims = tuple(range(2, input.dim()))
+        count = input[0, 0].numel()
+        std = var.sqrt()
+        den = torch.sqrt(var + ctx.eps)
+        borrowed_std = std.index_select(0, indices)
+        scale = borrowed_std / den
+
+        grad_shift = grad_output.sum(dim=dims, dtype=mean.dtype)
+        grad_scale = (grad_output * input).sum(dim=dims, dtype=mean.dtype) - grad_shift * mean
+
+        # shift = mean[indices] - mean * scale, scale = std[indices] / den
+        grad_mean = (-grad_shift * scale).index_add_(0, indices, grad_shift)
+        grad_std = torch.zeros_like(std).index_add_(0, indices, grad_scale / den)
+        grad_var = -grad_scale * borrowed_std / den ** 3 / 2 \
+            + torch.where(std > 0, grad_std / (2 * std), torch.zeros_like(std))
+
+        # grad_input = grad_output * scale + input * slope + offset per sample and channel
+        slope = 2 * grad_var / (count - 1)
+        offset = grad_mean / count - slope * mean
+        view = (input.size(0), input.size(1)) + (1,) * len(dims)
+        grad_input = torch.addcmul(
+            torch.addcmul(offset.view(view).to(input.dtype), input, slope.view(view).to(input.dtype)),
+            grad_output, scale.view(view).to(input.dtype))
+        return grad_input, None, None
+
+
+def instance_norm_batch_swap(input, indices, eps=1e-5):
+    return InstanceNormBatchSwapFunction.apply(input, indices, eps)
+
+
 class InstanceNormBatchSwap(torch.nn.Module):
     def __init__(self, n_neurons, affine=False, eps=1e-5):
         super(InstanceNormBatchSwap, self).__init__()
@@ -13,12 +72,23 @@ class InstanceNormBatchSwap(torch.nn.Module):
         if not self.training:
             return input
 
-        temp = input.view(input.size(0), input.size(1), -1)
+        indices = torch.randperm(input.size(0), device=input.device)
+        return instance_norm_batch_swap(input, indices, self.eps)
+
+    def reference_forward(self, input, indices=None):
+        # the unfused forward, kept to benchmark and check the fused one against
+        assert input.shape[1] == self.n_neurons, "Input has incorrect shape"
+
+        if not self.training:
+            return input
+
+        temp = input.reshape(input.size(0), input.size(1), -1)
         mean = temp.mean(2, keepdim=True).unsqueeze(-1)
         std = temp.std(2, keepdim=True).unsqueeze(-1)
         den = torch.sqrt(std.pow(2) + self.eps)
         output = (input - mean)/den
-        indices = torch.randperm(input.size(0))
+        if indices is None:
+            indices = torch.randperm(input.size(0), device=input.device)
         output = output * std.index_select(0, indices) + mean.index_select(0, indices)
 
         return output
@@ -40,7 +110,7 @@ class InstanceNormSimilarity(torch.nn.Module):
         torch.set_printoptions(profile='full')
         mean_file = open('{}-mean.csv'.format(self.filename), 'a', input.size(0))
         std_file = open('{}-std.csv'.format(self.filename), 'a', input.size(0))
-        temp = input.view(input.size(0), input.size(1), -1)
+        temp = input.reshape(input.size(0), input.size(1), -1)
         mean = temp.mean(2)
         std = temp.std(2)
         for line in mean.cpu().numpy():
@@ -1,7 +1,8 @@
 import os
+import sys
 import logging
 
-def create_logger(log_directory, filename, stream=False):
+def create_logger(log_directory, filename, stream=False, name=None):
     info_filehandler = logging.FileHandler(os.path.join(log_directory, '{}_info.log'.format(filename)))
     debug_filehandler = logging.FileHandler(os.path.join(log_directory, '{}_debug.log'.format(filename)))
 
@@ -12,7 +13,10 @@ def create_logger(log_directory, filename, stream=False):
     info_filehandler.setLevel(logging.INFO)
     debug_filehandler.setLevel(logging.DEBUG)
 
-    logger = logging.getLogger()
+    # named loggers let several models log side by side, the root logger is reset per model
+    logger = logging.getLogger(name)
+    if name is not None:
+        logger.propagate = False
     for hdlr in logger.handlers[:]:
         logger.removeHandler(hdlr)
 
@@ -0,0 +1,67 @@
+import os
+import torch
+import torch.distributed as dist
+from torch.utils.data import DataLoader
+from torch.utils.data.distributed import DistributedSampler
+from torch.nn.parallel import DistributedDataParallel
+
+
+def init_distributed(backend='gloo'):
+    """Joins the process group described by the environment torchrun sets up
+    (RANK, WORLD_SIZE, MASTER_ADDR, MASTER_PORT).
+    """
+    if not is_distributed():
+        dist.init_process_group(backend)
+        # processes on one node share its cores
+        local_world_size = int(os.environ.get('LOCAL_WORLD_SIZE', 1))
+        torch.set_num_threads(max(1, (os.cpu_count() or 1) // local_world_size))
+    return get_rank(), get_world_size()
+
+
+def is_distributed():
+    return dist.is_available() and dist.is_initialized()
+
+
+def get_rank():
+    return dist.get_rank() if is_distributed() else 0
+
+
+def get_world_size():
+    return dist.get_world_size() if is_distributed() else 1
+
+
+def is_main_process():
+    return get_rank() == 0
+
+
+def all_reduce_sum(tensor):
+    if is_distributed():
+        tensor = tensor.clone()
+        dist.all_reduce(tensor, op=dist.ReduceOp.SUM)
+    return tensor
+
+
+def wrap_model(model):
+    if not is_distributed():
+        return model
+    # classifier-only models and the autoencoder heads leave parts of the graph unused
+    return DistributedDataParallel(model, find_unused_parameters=True)
+
+
+def unwrap_model(model):
+    return model.module if isinstance(model, DistributedDataParallel) else model
+
+
+def distributed_loader(loader, shuffle, seed=0):
+    """Same loader reading only this process' shard of the dataset."""
+    # samplers with num_replicas already shard the dataset themselves
+    if not is_distributed() or hasattr(loader.sampler, 'num_replicas'):
+        return loader
+    sampler = DistributedSampler(loader.dataset, shuffle=shuffle, seed=seed)
+    return DataLoader(loader.dataset, batch_size=loader.batch_size, sampler=sampler,
+        num_workers=loader.num_workers)
+
+
+def set_loader_epoch(loader, epoch):
+    if isinstance(loader.sampler, DistributedSampler):
+        loader.sampler.set_epoch(epoch)
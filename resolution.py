@@ -0,0 +1,76 @@
+import copy
+import torchvision.transforms as transforms
+from torch.utils.data import DataLoader
+
+
+class ResolutionSchedule(object):
+    """Training crop size per epoch, parsed from 'size:last_epoch,...,final_size'.
+
+    '128:10,160:20,224' trains epochs 1-10 at 128, 11-20 at 160 and the rest
+    at 224. The batch size of a stage grows with the pixel count it saves
+    over the final size, so activation memory stays about the same.
+    """
+
+    def __init__(self, specification):
+        self.stages = []
+        for stage in specification.split(','):
+            size, _, last_epoch = stage.partition(':')
+            self.stages.append((int(size), int(last_epoch) if last_epoch else None))
+        if any(last_epoch is None for _, last_epoch in self.stages[:-1]) or self.stages[-1][1] is not None:
+            raise ValueError('every stage but the last needs a last epoch: {}'.format(specification))
+        last_epochs = [ last_epoch for _, last_epoch in self.stages[:-1] ]
+        if last_epochs != sorted(set(last_epochs)):
+            raise ValueError('stages must end at increasing epochs: {}'.format(specification))
+
+    @property
+    def final_size(self):
+        return self.stages[-1][0]
+
+    def size(self, epoch):
+        for size, last_epoch in self.stages:
+            if last_epoch is None or epoch <= last_epoch:
+                return size
+
+    def batch_size(self, epoch, batch_size):
+        return max(1, int(batch_size * (self.final_size / self.size(epoch)) ** 2))
+
+    def __repr__(self):
+        return ','.join('{}:{}'.format(size, last_epoch) if last_epoch is not None else str(size)
+            for size, last_epoch in self.stages)
+
+
+def random_crops(transform):
+    if isinstance(transform, transforms.RandomResizedCrop):
+        yield transform
+    for child in getattr(transform, 'transforms', []):
+        yield from random_crops(child)
+
+
+def set_crop_size(dataset, size):
+    crops = list(random_crops(dataset.transforms))
+    if not crops:
+        raise ValueError('{} has no RandomResizedCrop to schedule'.format(type(dataset).__name__))
+    for crop in crops:
+        crop.size = (size, size)
+
+
+def with_crop_size(dataset, size):
+    # the transforms are shared with the other loaders of the process, the
+    # schedule crops through its own copy of them
+    scheduled_dataset = copy.copy(dataset)
+    scheduled_dataset.transforms = copy.deepcopy(dataset.transforms)
+    set_crop_size(scheduled_dataset, size)
+    return scheduled_dataset
+
+
+def scheduled_loader(loader, schedule, epoch):
+    """The train loader of an epoch, cropping and batching at the scheduled resolution.
+
+    The loader is rebuilt over a copy of the dataset every epoch, loader and
+    its transforms keep the configured size.
+    """
+    if schedule is None:
+        return loader
+    return DataLoader(with_crop_size(loader.dataset, schedule.size(epoch)),
+        batch_size=schedule.batch_size(epoch, loader.batch_size), sampler=loader.sampler,
+        num_workers=loader.num_workers)
@@ -15,6 +15,8 @@ from betavae import *
 from score import *
 from trainer import *
 from logger import *
+from featurecache import with_latent_store, with_prefix_store, has_frozen_backbone
+from parallel import is_main_process, get_rank
 
 # pytorch
 import torch
@@ -28,7 +30,7 @@ import cv2
 # In[2]: Check Requirements
 
 requirements = {
-    torch: '1'
+    torch: '2'
 }
 
 check_requirements(requirements)
@@ -191,56 +193,18 @@ dataset_names = [
 # models directory
 model_directory = pathJoin(config.rootPath, 'models')
 
-vae_model_name = '{}_beta{}_gamma{}'.format(config.zdim, config.beta, config.gamma)
-vae_checkpoint_model_name = 'vae{}'.format(vae_model_name)
-vae_checkpoint_model_name = 'bilateral_{}'.format(vae_checkpoint_model_name) if config.bilateral else vae_checkpoint_model_name
-vae_checkpoint_model_name = '{}_{}'.format(config.dataset, vae_checkpoint_model_name)
+vae_checkpoint_model_name = vae_checkpoint_name(config.zdim, config.beta, config.gamma, config.dataset, config.bilateral)
 vae_model_checkpoint_path = pathJoin(model_directory, '{}.ckpt'.format(vae_checkpoint_model_name))
 
-supported_models = {
-    # baseline
-    'vgg19_vanilla_tune_fc': create_vgg19_vanilla_tune_fc, # Vanilla (No Norm)
-    # normalization
-    'vgg19_bn_all_tune_fc': create_vgg19_bn_all_tune_fc, # Batch Norm
-    'vgg19_bn_in_single_tune_all': create_vgg19_bn_in_single_tune_all, # Batch Norm with Single IN
-    'vgg19_in_all_tune_all': create_vgg19_in_all_tune_all, # Instance Norm
-    'vgg19_in_single_tune_all': create_vgg19_in_single_tune_all, # Single IN
-    'vgg19_in_affine_single_tune_all': create_vgg19_in_affine_single_tune_all, # Single IN with Affine
-    'vgg19_in_sm_all_tune_all': create_vgg19_in_sm_all_tune_all, # IN-SM
-    'vgg19_in_sm_single_tune_all': create_vgg19_in_sm_all_tune_all, # Single IN-SM
-    # similarity
-    'similarity_vgg19_vanilla_tune_all': create_vgg19_vanilla_similarity_tune_all,
-    'similarity_vgg19_in_single_tune_all': create_vgg19_in_single_similarity_tune_all,
-    'similarity_vgg19_bn_all_tune_fc': create_vgg19_bn_all_similarity_tune_fc,
-    # latent representation
-    'vae{}'.format(vae_model_name): create_betavae(config.zdim),
-    'classifier_z{}'.format(vae_model_name): create_betavae_classifier(
-        vae_model_checkpoint_path, config.zdim, config.device),
-    # train with latent
-    'latent_vgg19_in_single_tune_all': create_vgg19_in_single_tune_all_with_latent(
-        vae_model_checkpoint_path, config.zdim, config.device, convert_to_vae_transforms), # Single IN with Latent
-}
+supported_models = create_supported_models(config.zdim, config.beta, config.gamma,
+    vae_model_checkpoint_path, config.device, convert_to_vae_transforms)
 
 selected_models = {}
 
 for model_name, model_constructor in supported_models.items():
-    selected_model_name = model_name
-    if config.dataset != 'nonstylized' and \
-        not (
-            model_name == 'vgg19_vanilla_tune_fc' or \
-            'vae' in model_name or \
-            'classifier' in model_name or \
-            'latent' in model_name
-        ):
+    selected_model_name = trained_model_name(model_name, config.dataset, config.bilateral)
+    if selected_model_name is None:
         continue
-    if config.bilateral:
-        selected_model_name = 'bilateral_{}'.format(model_name)
-        if 'similarity' in model_name or \
-            'vae' in model_name or \
-            'classifier' in model_name or \
-            'latent' in model_name:
-            continue
-    selected_model_name = '{}_{}'.format(config.dataset, selected_model_name)
     selected_models[selected_model_name] = model_constructor
 
 supported_models = selected_models
@@ -251,7 +215,25 @@ models = {k:v for (k,v) in supported_models.items()
             if k in (config.model if config.model is not None else supported_models)}
 assert len(models.keys()) > 0, 'Please specify a model'
 
-sanity(models, original_train_loader, nonstylized_nonstylized_loader, config.device)
+# memory format, compilation and activation checkpointing apply to every constructed model
+models = {k: with_execution_mode(with_similarity_mode(v, config.similarityMode, config.similaritySketchSize),
+            config.memoryFormat, config.compile, config.activationCheckpointSegments)
+            for (k, v) in models.items()}
+
+# frozen autoencoder latents are read from a per-datapoint store
+if config.latentCache:
+    latent_cache_directory = pathJoin(config.rootPath, 'latents')
+    models = {k: with_latent_store(v, vae_model_checkpoint_path, latent_cache_directory, test_transforms)
+                for (k, v) in models.items()}
+
+# frozen prefixes of evaluation images are read from disk
+if config.prefixCache:
+    prefix_cache_directory = pathJoin(config.rootPath, 'prefixes')
+    models = {k: with_prefix_store(v, prefix_cache_directory) for (k, v) in models.items()}
+
+# --exists only reads the checkpoint index, the models are never built
+if not config.exists:
+    sanity(models, IMAGE_SIZE, VAE_IMAGE_SIZE)
 
 # In[6]: Train Models
 
@@ -263,12 +245,41 @@ if config.train:
     log_directory = pathJoin('run_logs')
     os.makedirs(log_directory, exist_ok=True)
 
+    # classifiers on the same loaders share one data stream with --sharedStream
+    shared_runs = {}
+
     for model_name in models:
-        logger = create_logger(log_directory, model_name)
+        # every process of a distributed run logs to its own files
+        log_name = model_name if is_main_process() else '{}_rank{}'.format(model_name, get_rank())
+        logger = create_logger(log_directory, log_name, name=model_name if config.sharedStream else None)
         logger.info(' '.join(sys.argv))
         logger.info('Model Name {}'.format(model_name))
         model = models[model_name]()
-        if 'vae' in model_name:
+        if config.distillStudent is not None:
+            if 'vae' in model_name or 'classifier_z' in model_name:
+                raise ValueError('{} takes autoencoder inputs and cannot teach an image classifier'.format(model_name))
+            student_models = create_student_models()
+            student = with_execution_mode(student_models[config.distillStudent], config.memoryFormat, config.compile,
+                config.activationCheckpointSegments)()
+            run_distillation(
+                config.distillStudent, student,
+                model_name, model,
+                model_directory,
+                config.numberOfEpochs,
+                config.learningRate,
+                logger,
+                [original_train_loader, stylized_train_loader],
+                original_val_loader,
+                config.device,
+                temperature=config.distillTemperature,
+                alpha=config.distillAlpha,
+                dataset_names=dataset_names,
+                load_data=load_data,
+                delta_checkpoints=config.deltaCheckpoints,
+                delta_base=config.deltaBase,
+                run_config=vars(config)
+            )
+        elif 'vae' in model_name:
             target_type = model_name.split('_')[0]
             _, pair_train_loader = load_pair_data(['stylized-imagenet200-0.0', 'stylized-imagenet200-1.0'],
                                         'train', target_type)
@@ -288,7 +299,16 @@ if config.train:
                 config.vaeImageSize,
                 config.gamma,
                 load_data=load_data,
-                vae_transforms=convert_to_vae_transforms
+                vae_transforms=convert_to_vae_transforms,
+                checkpoint_every_steps=config.checkpointEverySteps,
+                seed=config.torchSeed,
+                delta_checkpoints=config.deltaCheckpoints,
+                delta_base=config.deltaBase,
+                run_config=vars(config),
+                importance_sampling=config.importanceSampling,
+                importance_uniform_fraction=config.importanceUniformFraction,
+                importance_epoch_fraction=config.importanceEpochFraction,
+                async_validation=config.asyncValidation
             )
         else:
             train_loader = original_train_loader
@@ -299,6 +319,19 @@ if config.train:
             elif config.dataset == 'stylized':
                 train_loader = stylized_train_loader
                 val_loader = stylized_val_loader
+            if config.sharedStream and not (config.featureCache and has_frozen_backbone(model)):
+                shared_runs.setdefault((train_loader, val_loader), []).append(TrainingRun(
+                    model_name, model,
+                    model_directory,
+                    config.learningRate,
+                    logger,
+                    config.device,
+                    similarity_weight=similarity_weight if 'similarity' in model_name else None,
+                    delta_checkpoints=config.deltaCheckpoints,
+                    delta_base=config.deltaBase,
+                    run_config=vars(config)
+                ))
+                continue
             run(
                 model_name, model,
                 model_directory,
@@ -309,12 +342,36 @@ if config.train:
                 val_loader,
                 config.device,
                 similarity_weight=similarity_weight if 'similarity' in model_name else None,
-                load_data=load_data
+                load_data=load_data,
+                feature_cache_directory=pathJoin(config.rootPath, 'features') if config.featureCache else None,
+                feature_cache_views=config.featureCacheViews,
+                checkpoint_every_steps=config.checkpointEverySteps,
+                seed=config.torchSeed,
+                delta_checkpoints=config.deltaCheckpoints,
+                delta_base=config.deltaBase,
+                run_config=vars(config),
+                importance_sampling=config.importanceSampling,
+                importance_uniform_fraction=config.importanceUniformFraction,
+                importance_epoch_fraction=config.importanceEpochFraction,
+                resolution_schedule=config.resolutionSchedule,
+                async_validation=config.asyncValidation,
+                fast_validation_per_class=config.fastValidation
             )
 
         del model
         torch.cuda.empty_cache()
 
+    for (train_loader, val_loader), training_runs in shared_runs.items():
+        run_shared(
+            training_runs,
+            config.numberOfEpochs,
+            train_loader,
+            val_loader,
+            config.device,
+            load_data=load_data,
+            resolution_schedule=config.resolutionSchedule
+        )
+
 # In[6]: Check Performance
 
 perf(models, model_directory, dataset_names, config.device, load_data=load_data, load_bilateral_data=load_bilateral_data, only_exists=config.exists, vae_transforms=convert_to_vae_transforms)
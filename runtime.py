@@ -0,0 +1,93 @@
+"""Classifies images with an artifact written by export.py.
+
+Only numpy is imported up front. torch is imported for TorchScript
+artifacts and onnxruntime for ONNX ones, PIL only to read image files.
+
+    python runtime.py model.pt image.jpg [image.jpg ...]
+"""
+import sys
+import json
+import numpy as np
+
+
+def read_metadata(path):
+    with open(path + '.json', 'r') as metadata_file:
+        return json.load(metadata_file)
+
+
+def read_image(path, size=None, keep_aspect=True):
+    """uint8 RGB image of a file as a 1x3xHxW array, size x size when size is given.
+
+    With keep_aspect the smaller edge is resized to size and the center is
+    cropped, otherwise both edges are resized.
+    """
+    from PIL import Image
+    image = Image.open(path).convert('RGB')
+    if size is None:
+        pass
+    elif keep_aspect:
+        width, height = image.size
+        scale = size / min(width, height)
+        width, height = max(size, int(round(width * scale))), max(size, int(round(height * scale)))
+        image = image.resize((width, height), Image.BILINEAR)
+        left, top = (width - size) // 2, (height - size) // 2
+        image = image.crop((left, top, left + size, top + size))
+    else:
+        image = image.resize((size, size), Image.BILINEAR)
+    return np.asarray(image, dtype=np.uint8).transpose(2, 0, 1)[None]
+
+
+def softmax(logits):
+    exponentials = np.exp(logits - logits.max(axis=1, keepdims=True))
+    return exponentials / exponentials.sum(axis=1, keepdims=True)
+
+
+class Classifier(object):
+    """Logits and top-k classes of uint8 RGB batches (N, 3, H, W), preprocessing included."""
+
+    def __init__(self, path, threads=None):
+        self.metadata = read_metadata(path)
+        if self.metadata['format'] == 'onnx':
+            import onnxruntime
+            options = onnxruntime.SessionOptions()
+            if threads:
+                options.intra_op_num_threads = threads
+            self.session = onnxruntime.InferenceSession(path, options, providers=['CPUExecutionProvider'])
+            self.run = self.run_onnx
+        else:
+            import torch
+            if threads:
+                torch.set_num_threads(threads)
+            self.torch = torch
+            self.module = torch.jit.load(path, map_location='cpu').eval()
+            self.run = self.run_torchscript
+
+    def run_onnx(self, images):
+        return self.session.run(None, { 'images': np.ascontiguousarray(images, dtype=np.uint8) })[0]
+
+    def run_torchscript(self, images):
+        with self.torch.inference_mode():
+            return self.module(self.torch.from_numpy(np.ascontiguousarray(images, dtype=np.uint8))).numpy()
+
+    def logits(self, images):
+        return self.run(images)
+
+    def classify(self, images, k=5):
+        """(classes, probabilities) of the k most probable classes per image, most probable first."""
+        probabilities = softmax(self.logits(images))
+        classes = np.argsort(-probabilities, axis=1)[:, :k]
+        return classes, np.take_along_axis(probabilities, classes, axis=1)
+
+    def classify_files(self, paths, k=5):
+        # images of different sizes cannot share a batch, ONNX graphs take a single square size
+        size = self.metadata.get('image_size')
+        keep_aspect = self.metadata.get('keep_aspect', True)
+        return [ self.classify(read_image(path, size, keep_aspect), k) for path in paths ]
+
+
+if __name__ == '__main__':
+    if len(sys.argv) < 3:
+        sys.exit(__doc__)
+    classifier = Classifier(sys.argv[1])
+    for path, (classes, probabilities) in zip(sys.argv[2:], classifier.classify_files(sys.argv[2:])):
+        print('{}: {}'.format(path, ', '.join('{} ({:.4f})'.format(c, p) for c, p in zip(classes[0], probabilities[0]))))
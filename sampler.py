@@ -0,0 +1,182 @@
+import math
+import torch
+from torch.utils.data import Sampler, DataLoader
+from parallel import all_reduce_sum
+
+
+class ResumableRandomSampler(Sampler):
+    """Shuffles like RandomSampler, but the order is a function of (seed, epoch).
+
+    An epoch can be restarted part way through by skipping the first
+    start_index positions of its order. With several replicas each process
+    takes every num_replicas-th position of the remaining order.
+    """
+
+    def __init__(self, data_source, seed=0, num_replicas=1, rank=0):
+        self.data_source = data_source
+        self.seed = seed
+        self.num_replicas = num_replicas
+        self.rank = rank
+        self.epoch = 0
+        self.start_index = 0
+
+    def set_epoch(self, epoch, start_index=0):
+        self.epoch = epoch
+        self.start_index = start_index
+
+    def generator(self):
+        generator = torch.Generator()
+        generator.manual_seed((self.seed + self.epoch) % (2 ** 63))
+        return generator
+
+    def epoch_length(self):
+        return len(self.data_source)
+
+    def order(self):
+        return torch.randperm(len(self.data_source), generator=self.generator(), device='cpu').tolist()
+
+    def __iter__(self):
+        order = self.order()[self.start_index:]
+        if self.num_replicas > 1:
+            # pad so that every process sees the same number of batches
+            order += order[:(-len(order)) % self.num_replicas]
+            order = order[self.rank::self.num_replicas]
+        return iter(order)
+
+    def __len__(self):
+        remaining = max(self.epoch_length() - self.start_index, 0)
+        return (remaining + self.num_replicas - 1) // self.num_replicas
+
+    def state_dict(self):
+        return {'seed': self.seed, 'epoch': self.epoch, 'start_index': self.start_index}
+
+    def load_state_dict(self, state):
+        self.seed = state['seed']
+        self.set_epoch(state['epoch'], state['start_index'])
+
+
+class ImportanceSampler(ResumableRandomSampler):
+    """Draws samples in proportion to their recent training loss.
+
+    Every sample keeps a running loss. An epoch draws epoch_fraction of the
+    dataset with replacement from a mixture of the loss distribution and a
+    uniform one, and weights(indices) returns 1 / (N p) for the drawn
+    samples so that the weighted mean loss stays an unbiased estimate of the
+    uniform one. The uniform share bounds the weights by 1 / uniform_fraction.
+
+    record() collects the per-sample losses of an epoch, end_epoch() folds
+    them into the table (summed over all processes when distributed), so the
+    probabilities stay fixed within an epoch and a resumed epoch replays the
+    same draws.
+    """
+
+    def __init__(self, data_source, seed=0, num_replicas=1, rank=0, uniform_fraction=0.2, epoch_fraction=1.0,
+            loss_decay=0.5):
+        super(ImportanceSampler, self).__init__(data_source, seed, num_replicas, rank)
+        assert 0 < uniform_fraction <= 1, 'uniform fraction must be in (0, 1]'
+        self.uniform_fraction = uniform_fraction
+        self.epoch_fraction = epoch_fraction
+        self.loss_decay = loss_decay
+        number_of_samples = len(data_source)
+        self.losses = torch.zeros(number_of_samples, dtype=torch.float64)
+        self.seen = torch.zeros(number_of_samples, dtype=torch.bool)
+        self.loss_sums = torch.zeros(number_of_samples, dtype=torch.float64)
+        self.loss_counts = torch.zeros(number_of_samples, dtype=torch.float64)
+
+    def epoch_length(self):
+        return int(math.ceil(self.epoch_fraction * len(self.data_source)))
+
+    def probabilities(self):
+        number_of_samples = len(self.data_source)
+        uniform = torch.full((number_of_samples,), 1.0 / number_of_samples, dtype=torch.float64)
+        if not self.seen.any():
+            return uniform
+        # samples not trained on yet count as the hardest seen so far
+        losses = torch.where(self.seen, self.losses, self.losses[self.seen].max()).clamp(min=0)
+        if losses.sum() <= 0:
+            return uniform
+        return (1 - self.uniform_fraction) * losses / losses.sum() + self.uniform_fraction * uniform
+
+    def order(self):
+        self.sample_probabilities = self.probabilities()
+        return torch.multinomial(self.sample_probabilities, self.epoch_length(), replacement=True,
+            generator=self.generator()).tolist()
+
+    def move_tables(self, device):
+        # the per-batch tables live on the device of the losses, so that
+        # recording and weighting a batch never waits for the device
+        for name in ['loss_sums', 'loss_counts', 'sample_probabilities']:
+            table = getattr(self, name)
+            if table.device != device:
+                setattr(self, name, table.to(device))
+
+    def weights(self, indices):
+        probabilities = self.sample_probabilities
+        return 1.0 / (len(self.data_source) * probabilities[indices.to(probabilities.device, non_blocking=True)])
+
+    def record(self, indices, losses):
+        self.move_tables(losses.device)
+        indices = indices.to(losses.device, non_blocking=True)
+        self.loss_sums.index_add_(0, indices, losses.detach().double())
+        self.loss_counts.index_add_(0, indices, torch.ones(indices.size(0), dtype=torch.float64, device=losses.device))
+
+    def end_epoch(self):
+        # the only copy of the recorded losses to the cpu
+        loss_sums = all_reduce_sum(self.loss_sums.cpu())
+        loss_counts = all_reduce_sum(self.loss_counts.cpu())
+        recorded = loss_counts > 0
+        means = loss_sums[recorded] / loss_counts[recorded]
+        previous = torch.where(self.seen[recorded], self.losses[recorded], means)
+        self.losses[recorded] = self.loss_decay * previous + (1 - self.loss_decay) * means
+        self.seen |= recorded
+        self.loss_sums.zero_()
+        self.loss_counts.zero_()
+
+    def state_dict(self):
+        state = super(ImportanceSampler, self).state_dict()
+        state.update(losses=self.losses, seen=self.seen, loss_sums=self.loss_sums.cpu(), loss_counts=self.loss_counts.cpu())
+        return state
+
+    def load_state_dict(self, state):
+        super(ImportanceSampler, self).load_state_dict(state)
+        for name in ['losses', 'seen', 'loss_sums', 'loss_counts']:
+            getattr(self, name).copy_(state[name])
+
+
+def stratified_subset(targets, per_class, seed=0):
+    """Sorted indices of per_class samples of every class, the same for a given seed."""
+    generator = torch.Generator()
+    generator.manual_seed(seed)
+    indices_by_class = {}
+    for index, target in enumerate(targets):
+        indices_by_class.setdefault(target, []).append(index)
+    subset = []
+    for target in sorted(indices_by_class):
+        indices = indices_by_class[target]
+        order = torch.randperm(len(indices), generator=generator).tolist()
+        subset += [ indices[i] for i in order[:per_class] ]
+    return sorted(subset)
+
+
+class SubsetSampler(Sampler):
+    """Iterates a fixed list of indices in order, every num_replicas-th one per process."""
+
+    def __init__(self, indices, num_replicas=1, rank=0):
+        self.indices = list(indices)
+        self.num_replicas = num_replicas
+        self.rank = rank
+
+    def __iter__(self):
+        indices = self.indices
+        if self.num_replicas > 1:
+            # pad so that every process sees the same number of batches
+            indices = indices + indices[:(-len(indices)) % self.num_replicas]
+        return iter(indices[self.rank::self.num_replicas])
+
+    def __len__(self):
+        return (len(self.indices) + self.num_replicas - 1) // self.num_replicas
+
+
+def with_sampler(loader, sampler):
+    return DataLoader(loader.dataset, batch_size=loader.batch_size, sampler=sampler,
+        num_workers=loader.num_workers)
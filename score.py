@@ -2,17 +2,32 @@ import datetime
 import torch
 from tqdm import tqdm
 from utils import convert_input
+from parallel import is_distributed, is_main_process, all_reduce_sum, unwrap_model, distributed_loader
 
 
-def score(prediction, target):
+def count_correct(prediction, target):
     total = prediction.size(0)
     prediction = prediction.t()
     correct = prediction.eq(target.view(1, -1).expand_as(prediction))
-    top1 = correct[:1].view(-1).float().sum(0).item()
-    top5 = correct[:5].view(-1).float().sum(0).item()
+    top1 = correct[:1].view(-1).float().sum(0)
+    top5 = correct[:5].view(-1).float().sum(0)
     return top1, top5, total
 
 
+def score(prediction, target):
+    top1, top5, total = count_correct(prediction, target)
+    return top1.item(), top5.item(), total
+
+
+def proportion_interval(proportion, total, z=1.96):
+    """Wilson score interval of a proportion measured on total samples (95% for z=1.96)."""
+    if total == 0:
+        return 0.0, 1.0
+    center = (proportion + z**2 / (2 * total)) / (1 + z**2 / total)
+    half_width = z * (proportion * (1 - proportion) / total + z**2 / (4 * total**2)) ** 0.5 / (1 + z**2 / total)
+    return center - half_width, center + half_width
+
+
 def score_value(score, total):
     if total > 0:
         return score/total
@@ -20,11 +35,82 @@ def score_value(score, total):
         return 0
 
 
-def score_model(model, dataloader, device, similarity_model=False, vae_transforms=None):
+class RunningMetrics(object):
+    """Running sums of loss components and top-k hits kept on the device.
+
+    Values are only copied to the host when a mean or score is read, so the
+    training loop does not synchronize on every batch. With all_reduce the
+    values read are summed over all processes, every process has to read
+    them at the same point.
+    """
+
+    def __init__(self, device, names=('loss',), all_reduce=False):
+        self.device = device
+        self.names = list(names)
+        self.all_reduce = all_reduce
+        self.reset()
+
+    def reset(self):
+        self.sums = { name: torch.zeros((), device=self.device) for name in self.names }
+        self.batches = 0
+        self.top1 = torch.zeros((), device=self.device)
+        self.top5 = torch.zeros((), device=self.device)
+        self.total = 0
+
+    def update(self, **values):
+        for name, value in values.items():
+            self.sums[name] += value.detach().sum()
+        self.batches += 1
+
+    def update_accuracy(self, output, target):
+        _, predicted_class = output.topk(5, 1, True, True)
+        top1, top5, total = count_correct(predicted_class, target)
+        self.top1 += top1
+        self.top5 += top5
+        self.total += total
+
+    def totals(self, values):
+        values = torch.stack([ value.double() for value in values ])
+        if self.all_reduce:
+            values = all_reduce_sum(values)
+        return values.tolist()
+
+    def means(self):
+        if not self.names:
+            return {}
+        *sums, batches = self.totals([ self.sums[name] for name in self.names ]
+            + [ torch.tensor(float(self.batches), device=self.device) ])
+        if batches == 0:
+            return { name: 0.0 for name in self.names }
+        return { name: value / batches for name, value in zip(self.names, sums) }
+
+    def mean(self, name='loss'):
+        return self.means()[name]
+
+    def scores(self):
+        top1, top5, total = self.totals([self.top1, self.top5, torch.tensor(float(self.total), device=self.device)])
+        return score_value(top1, total), score_value(top5, total)
+
+
+def forward_batch(model, batch, dataset, device, input=None):
+    if input is None:
+        input = batch[dataset.INDEX_IMAGE].to(device)
+    stores = getattr(unwrap_model(model), 'input_stores', None)
+    if not stores:
+        return model(input)
+    inputs = {}
+    for name, store in stores.items():
+        value = store.lookup(dataset, batch[dataset.INDEX_DATAPOINT], input, model.training)
+        if value is not None:
+            inputs[name] = value
+    return model(input, **inputs)
+
+
+def score_model(model, dataloader, device, vae_transforms=None):
     model.eval()
-    total_top1 = 0
-    total_top5 = 0
-    total_ = 0
+    # distributed runs score a shard per process
+    dataloader = distributed_loader(dataloader, shuffle=False)
+    metrics = RunningMetrics(device, names=(), all_reduce=is_distributed())
 
     transform = convert_input(vae_transforms)
 
@@ -34,19 +120,12 @@ def score_model(model, dataloader, device, similarity_model=False, vae_transform
             input = batch[dataloader.dataset.INDEX_IMAGE].to(device)
             if vae_transforms:
                 input = transform(input)
-            if similarity_model:
-                output, _ = model(input)
-            else:
-                output = model(input)
-            _, predicted_classes = output.topk(5, 1, True, True)
-            top1, top5, total = score(predicted_classes, target)
-            total_top1 += top1
-            total_top5 += top5
-            total_ += total
-    return total_top1/total_, total_top5/total_
+            output = forward_batch(model, batch, dataloader.dataset, device, input)
+            metrics.update_accuracy(output, target)
+    return metrics.scores()
 
 
-def evaluate_model(model_name, model, load_data, dataset_names, print_function, similarity_model, device, vae_transforms):
+def evaluate_model(model_name, model, load_data, dataset_names, print_function, device, vae_transforms=None):
 
     model.eval()
     if hasattr(model, 'set_classification_mode') and callable(getattr(model, 'set_classification_mode')):
@@ -59,12 +138,14 @@ def evaluate_model(model_name, model, load_data, dataset_names, print_function,
 
     for dataset_name in dataset_names:
         _, loader = load_data(dataset_name, split='val')
-        top1, top5 = score_model(model, loader, device, similarity_model, vae_transforms)
+        top1, top5 = score_model(model, loader, device, vae_transforms)
         print_function('{}: Top1: {:.4f} Top5: {:.4f}'.format(dataset_name, top1, top5))
         scores['top5'].append(top5)
         scores['top1'].append(top1)
 
     for metric in scores:
+        if not is_main_process():
+            break
         logfile = open('{}.log'.format(metric), 'a')
         formatted_scores = [ '{:.4f}'.format(x) for x in scores[metric] ]
         formatted_scores.insert(0, model_name) # append model name
@@ -74,3 +155,5 @@ def evaluate_model(model_name, model, load_data, dataset_names, print_function,
         logfile.close()
         print('{} ({}) => {}'.format(model_name, metric, ', '.join([ '{:.4f}'.format(x) for x in scores[metric] ])))
 
+    return scores
+
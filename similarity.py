@@ -12,6 +12,7 @@ import pandas as pd
 from utils import *
 from dataset import *
 from vgg19 import *
+from checkpoint import load_checkpoint_weights
 
 # pytorch
 import torch
@@ -23,7 +24,7 @@ import torchvision.transforms as transforms
 np.set_printoptions(threshold=sys.maxsize)
 
 requirements = {
-    torch: '1'
+    torch: '2'
 }
 
 check_requirements(requirements)
@@ -114,7 +115,7 @@ checkpoint_map = {
 def load_model(model, model_name):
     checkpoint_path = os.path.join('space', 'models', '{}.ckpt'.format(checkpoint_map[model_name]))
     checkpoint = torch.load(checkpoint_path, map_location=config.device)
-    model.load_state_dict(checkpoint['weights'])
+    load_checkpoint_weights(model, checkpoint, config.device)
     model.eval()
 
 def load_run_model_epoch(model_name, loader, dataset_name):
@@ -0,0 +1,276 @@
+# coding: utf-8
+
+# In[1]: Load Libraries
+
+# native
+import os
+import sys
+import json
+import time
+import argparse
+import itertools
+import subprocess
+
+# modules
+from utils import pathJoin, DEFAULT_ROOT_PATH, vae_model_suffix, vae_checkpoint_name, trained_model_name
+
+# In[2]: Sweep Specification
+
+# supported models named after the autoencoder hyperparameters
+VAE_MODELS = ['vae', 'classifier_z']
+
+# supported models loading the autoencoder checkpoint of their hyperparameters
+VAE_DEPENDENT_MODELS = ['classifier_z', 'latent_vgg19_in_single_tune_all']
+
+SWEEP_DEFAULTS = {
+    'dataset': ['nonstylized'],
+    'bilateral': [False],
+    'zdim': [128],
+    'beta': [0.2],
+    'gamma': [0.0]
+}
+
+DEFAULT_RESOURCES = {'cpus': 1, 'memory': 4}
+
+
+class Job(object):
+    """One run.py invocation of the sweep."""
+
+    def __init__(self, name, model, arguments, dependencies, resources, checkpoint_path=None):
+        self.name = name
+        self.model = model
+        self.arguments = arguments
+        self.dependencies = dependencies
+        self.resources = resources
+        self.checkpoint_path = checkpoint_path
+
+    def command(self):
+        return [sys.executable, 'run.py'] + self.arguments
+
+
+def expand_sweep(spec, root_path):
+    """Jobs of a sweep spec keyed by name, in dependency order.
+
+    spec is a dictionary with
+        models: supported model names, 'vae' and 'classifier_z' stand for
+            the models named after zdim, beta and gamma
+        dataset, bilateral, zdim, beta, gamma: values to sweep over
+        arguments: extra run.py arguments for every job
+        resources: {model or 'default': {'cpus': n, 'memory': gigabytes}}
+
+    Models that load an autoencoder depend on the job training it, which
+    is added when the spec does not list 'vae'. A model ignoring an axis is
+    trained once for all its values. Training jobs evaluate their model
+    when they finish, there are no separate evaluation jobs.
+    """
+    model_directory = pathJoin(root_path, 'models')
+    axes = [ spec.get(axis, SWEEP_DEFAULTS[axis]) for axis in ['dataset', 'bilateral', 'zdim', 'beta', 'gamma'] ]
+    resources = spec.get('resources', {})
+    extra_arguments = [ str(argument) for argument in spec.get('arguments', []) ]
+
+    jobs = {}
+
+    def add_job(model, dataset, bilateral, zdim, beta, gamma):
+        suffix = vae_model_suffix(zdim, beta, gamma)
+        supported_name = '{}{}'.format(model, suffix) if model in VAE_MODELS else model
+        name = trained_model_name(supported_name, dataset, bilateral)
+        if name is None:
+            return None
+
+        dependencies = []
+        if model in VAE_DEPENDENT_MODELS:
+            dependencies.append(add_job('vae', dataset, bilateral, zdim, beta, gamma)
+                or vae_checkpoint_name(zdim, beta, gamma, dataset, bilateral))
+
+        arguments = ['--rootPath', root_path, '--dataset', dataset,
+            '--zdim', str(zdim), '--beta', str(float(beta)), '--gamma', str(float(gamma))]
+        if bilateral:
+            arguments.append('--bilateral')
+        arguments += ['--model', name] + extra_arguments
+
+        if name in jobs:
+            if jobs[name].dependencies != dependencies:
+                raise ValueError('{} would be trained from {} and {} into the same checkpoint'.format(
+                    name, jobs[name].dependencies, dependencies))
+            return name
+
+        jobs[name] = Job(name, model, ['--train'] + arguments, dependencies,
+            dict(DEFAULT_RESOURCES, **resources.get(model, resources.get('default', {}))),
+            pathJoin(model_directory, '{}.ckpt'.format(name)))
+        return name
+
+    for model in spec['models']:
+        for dataset, bilateral, zdim, beta, gamma in itertools.product(*axes):
+            add_job(model, dataset, bilateral, zdim, beta, gamma)
+
+    for job in jobs.values():
+        for dependency in job.dependencies:
+            if dependency not in jobs:
+                raise ValueError('{} depends on {} which the sweep does not train'.format(job.name, dependency))
+
+    return jobs
+
+
+# In[3]: Up To Date Checks
+
+def fingerprint(path):
+    if path is None or not os.path.isfile(path):
+        return None
+    stat = os.stat(path)
+    return [stat.st_size, stat.st_mtime_ns]
+
+
+def stamp_path(state_directory, job):
+    return pathJoin(state_directory, '{}.json'.format(job.name))
+
+
+def job_stamp(jobs, job):
+    return {
+        'command': job.command()[1:],
+        'dependencies': { dependency: fingerprint(jobs[dependency].checkpoint_path) for dependency in job.dependencies },
+        'checkpoint': fingerprint(job.checkpoint_path)
+    }
+
+
+def is_up_to_date(jobs, job, state_directory):
+    """A job is up to date when it last succeeded with the same command, on the
+    same dependency checkpoints, and its own checkpoint was not touched since.
+    """
+    path = stamp_path(state_directory, job)
+    if not os.path.isfile(path):
+        return False
+    with open(path) as stamp_file:
+        stamp = json.load(stamp_file)
+    return stamp == job_stamp(jobs, job)
+
+
+def write_stamp(jobs, job, state_directory):
+    os.makedirs(state_directory, exist_ok=True)
+    with open(stamp_path(state_directory, job), 'w') as stamp_file:
+        json.dump(job_stamp(jobs, job), stamp_file, indent=2)
+
+
+# In[4]: Scheduler
+
+def available_memory():
+    return os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES') / 2**30
+
+
+class Scheduler(object):
+    """Runs the jobs of a sweep as subprocesses, dependencies first.
+
+    Jobs whose dependencies are done start as long as their cpus and
+    memory fit into the budget next to the running ones; a job larger than
+    the budget runs alone. Dependents of a failed job are skipped.
+    """
+
+    def __init__(self, jobs, cpus, memory, state_directory, log_directory, poll_interval=5):
+        self.jobs = jobs
+        self.cpus = cpus
+        self.memory = memory
+        self.state_directory = state_directory
+        self.log_directory = log_directory
+        self.poll_interval = poll_interval
+
+    def plan(self):
+        # a job is stale when any of its dependencies is
+        stale = set()
+        for name, job in self.jobs.items():
+            if any(dependency in stale for dependency in job.dependencies) or \
+                not is_up_to_date(self.jobs, job, self.state_directory):
+                stale.add(name)
+        return [ name for name in self.jobs if name in stale ]
+
+    def fits(self, job, running):
+        if not running:
+            return True
+        cpus = sum(self.jobs[name].resources['cpus'] for name in running) + job.resources['cpus']
+        memory = sum(self.jobs[name].resources['memory'] for name in running) + job.resources['memory']
+        return cpus <= self.cpus and memory <= self.memory
+
+    def start(self, job):
+        os.makedirs(self.log_directory, exist_ok=True)
+        log_file = open(pathJoin(self.log_directory, '{}.log'.format(job.name)), 'w')
+        environment = dict(os.environ, OMP_NUM_THREADS=str(job.resources['cpus']))
+        print('Starting {}: {}'.format(job.name, ' '.join(job.command())))
+        process = subprocess.Popen(job.command(), stdout=log_file, stderr=subprocess.STDOUT, env=environment)
+        return process, log_file
+
+    def run(self):
+        pending = self.plan()
+        done = set(self.jobs) - set(pending)
+        for name in self.jobs:
+            if name in done:
+                print('Up to date {}'.format(name))
+        failed = set()
+        running = {}
+
+        while pending or running:
+            for name, (process, log_file) in list(running.items()):
+                return_code = process.poll()
+                if return_code is None:
+                    continue
+                log_file.close()
+                del running[name]
+                if return_code == 0:
+                    write_stamp(self.jobs, self.jobs[name], self.state_directory)
+                    done.add(name)
+                    print('Finished {}'.format(name))
+                else:
+                    failed.add(name)
+                    print('Failed {} with exit code {}'.format(name, return_code))
+
+            for name in list(pending):
+                if any(dependency in failed for dependency in self.jobs[name].dependencies):
+                    pending.remove(name)
+                    failed.add(name)
+                    print('Skipped {}: a dependency failed'.format(name))
+
+            for name in list(pending):
+                job = self.jobs[name]
+                if all(dependency in done for dependency in job.dependencies) and self.fits(job, running):
+                    pending.remove(name)
+                    running[name] = self.start(job)
+
+            if pending or running:
+                time.sleep(self.poll_interval)
+
+        return failed
+
+
+# In[5]: Main
+
+def sweep_configuration():
+    parser = argparse.ArgumentParser(formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('spec', type=str,
+                        help='json sweep specification')
+    parser.add_argument('--rootPath', type=str, default=DEFAULT_ROOT_PATH,
+                        help='output path')
+    parser.add_argument('--cpus', type=int, default=os.cpu_count(),
+                        help='cpus shared by the concurrent jobs')
+    parser.add_argument('--memory', type=float, default=available_memory(),
+                        help='memory in gigabytes shared by the concurrent jobs')
+    parser.add_argument('--pollInterval', type=float, default=5,
+                        help='seconds between checks of the running jobs')
+    parser.add_argument('--dryRun', action='store_true', default=False,
+                        help='only print the jobs that would run')
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    config = sweep_configuration()
+    with open(config.spec) as spec_file:
+        spec = json.load(spec_file)
+
+    jobs = expand_sweep(spec, config.rootPath)
+    scheduler = Scheduler(jobs, config.cpus, config.memory,
+        pathJoin(config.rootPath, 'sweeps'), pathJoin('sweep_logs'), config.pollInterval)
+
+    if config.dryRun:
+        for name in scheduler.plan():
+            job = jobs[name]
+            print('{} (after {}): {}'.format(name, ', '.join(job.dependencies) or '-', ' '.join(job.command())))
+        sys.exit(0)
+
+    failed = scheduler.run()
+    sys.exit(1 if failed else 0)
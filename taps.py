@@ -0,0 +1,203 @@
+import math
+import contextlib
+import torch
+
+
+# In[1]: Statistics
+
+STATISTICS = {}
+
+
+def register_statistic(name):
+    def register(create_statistic):
+        STATISTICS[name] = create_statistic
+        return create_statistic
+    return register
+
+
+def create_statistic(name, **options):
+    if name not in STATISTICS:
+        raise ValueError('Unknown statistic {}, expected one of {}'.format(name, ', '.join(sorted(STATISTICS))))
+    return STATISTICS[name](**options)
+
+
+SIMILARITY_MODES = ['reference', 'exact', 'sketch']
+
+
+def squared_gram_norm(u):
+    # ||U U^T||_F^2 == ||U^T U||_F^2, the gram matrix is built on the smaller side
+    if u.size(1) <= u.size(2):
+        gram = torch.matmul(u, u.transpose(1, 2))
+    else:
+        gram = torch.matmul(u.transpose(1, 2), u)
+    return gram.pow(2).sum(dim=(1, 2))
+
+
+def sketched_squared_gram_norm(u, sketch_size):
+    """Unbiased estimate of ||U U^T||_F^2 from two independent samples of sketch_size columns.
+
+    Each rescaled sample gram is an unbiased estimate of U U^T and their
+    inner product is one of the squared norm, because the samples are
+    independent. The gradient is unbiased the same way.
+    """
+    number_of_columns = u.size(2)
+    scale = number_of_columns / sketch_size
+    grams = []
+    for _ in range(2):
+        columns = torch.randperm(number_of_columns, device=u.device)[:sketch_size]
+        sample = u[:, :, columns]
+        grams.append(torch.matmul(sample, sample.transpose(1, 2)) * scale)
+    return (grams[0] * grams[1]).sum(dim=(1, 2))
+
+
+def cosine_similarity_matrix(x, eps):
+    # https://pytorch.org/docs/stable/nn.html#cosine_similarity
+    x_norm = torch.norm(x, dim=2, keepdim=True)
+    norm_prod = torch.matmul(x_norm, x_norm.transpose(1, 2))
+    return torch.matmul(x, x.transpose(1, 2)) / norm_prod.clamp_min(eps)
+
+
+@register_statistic('similarity')
+class SimilarityStatistic(object):
+    """Sum of squared cosine similarities between the channels of x, less the diagonal.
+
+    'exact' normalizes the channels once and takes the squared norm of
+    their gram matrix on the cheaper of the CxC and HWxHW sides.
+    'sketch' estimates it without bias from sampled positions on layers
+    with more than sketch_size positions while training. 'reference' is
+    the original CxC cosine matrix.
+    """
+
+    def __init__(self, mode='exact', sketch_size=1024, eps=1e-08):
+        if mode not in SIMILARITY_MODES:
+            raise ValueError('Unknown similarity mode {}'.format(mode))
+        self.mode = mode
+        self.sketch_size = sketch_size
+        self.eps = float(eps)
+
+    def __call__(self, x, training=False):
+        flat_x = x.reshape(x.size(0), x.size(1), -1)
+        if self.mode == 'reference':
+            similarity_matrix = cosine_similarity_matrix(flat_x, self.eps) ** 2
+            return similarity_matrix.sum(dim=(1, 2)) - similarity_matrix.size(1)
+        u = self.normalize_channels(flat_x)
+        if self.mode == 'sketch' and training and u.size(2) > self.sketch_size:
+            squared_norm = sketched_squared_gram_norm(u, self.sketch_size)
+        else:
+            squared_norm = squared_gram_norm(u)
+        return squared_norm - u.size(1)
+
+    def normalize_channels(self, x):
+        # cos = x_i.x_j / max(|x_i| |x_j|, eps) agrees with the normalized rows whenever
+        # both norms reach sqrt(eps), all-zero channels contribute 0 either way
+        norm = torch.norm(x, dim=2, keepdim=True)
+        return x / norm.clamp_min(math.sqrt(self.eps))
+
+
+@register_statistic('channel_moments')
+class ChannelMoments(object):
+    """Per channel mean and standard deviation over the positions, the statistics instance normalization removes."""
+
+    def __call__(self, x, training=False):
+        flat_x = x.reshape(x.size(0), x.size(1), -1)
+        return torch.cat([flat_x.mean(dim=2), flat_x.std(dim=2)], dim=1)
+
+
+@register_statistic('gram')
+class Gram(object):
+    """Channel gram matrix averaged over the positions, as in style losses."""
+
+    def __call__(self, x, training=False):
+        flat_x = x.reshape(x.size(0), x.size(1), -1)
+        return torch.matmul(flat_x, flat_x.transpose(1, 2)) / flat_x.size(2)
+
+
+# In[2]: Taps
+
+# taps collecting right now, see checkpoint_contexts
+collecting_taps = []
+
+
+class FeatureTaps(object):
+    """Statistics of the outputs of named layers of a model.
+
+    Forward hooks only act inside collect(), otherwise the model runs as it
+    would without them. The statistic is computed in the hook, so a tapped
+    output is not referenced beyond its layer and, inside an activation
+    checkpointed block, the statistic is recomputed in backward along with
+    the block instead of keeping the block's activations alive. Blocks have
+    to be checkpointed with checkpoint_contexts for that.
+    """
+
+    def __init__(self, model, layer_names, statistic=None):
+        self.layer_names = list(layer_names)
+        self.statistic = statistic
+        self.outputs = None
+        self.collect_statistic = None
+        self.replay_statistic = None
+        self.handles = [ model.get_submodule(name).register_forward_hook(self.hook) for name in self.layer_names ]
+
+    def hook(self, module, input, output):
+        if self.outputs is not None:
+            self.record(output, module.training)
+        elif self.replay_statistic is not None:
+            # a checkpointed block recomputed in backward, its value was collected in the forward
+            self.replay_statistic(output, module.training)
+
+    def record(self, output, training=False):
+        if self.outputs is not None:
+            statistic = self.collect_statistic
+            self.outputs.append(statistic(output, training) if statistic is not None else output)
+
+    @contextlib.contextmanager
+    def collect(self, reduce=True):
+        """Collects the statistics of the tapped outputs of the forwards run inside, in call order.
+
+        Without reduce, or without a statistic, the outputs themselves are collected.
+        """
+        assert self.outputs is None, 'taps are already collecting'
+        self.outputs = []
+        self.collect_statistic = self.statistic if reduce else None
+        collecting_taps.append(self)
+        try:
+            yield self.outputs
+        finally:
+            collecting_taps.remove(self)
+            self.outputs = None
+            self.collect_statistic = None
+
+    def stacked(self, collected):
+        """Per sample values of all taps, one column per tap for scalar statistics."""
+        return torch.stack(collected, dim=1)
+
+    def remove(self):
+        for handle in self.handles:
+            handle.remove()
+        self.handles = []
+
+
+@contextlib.contextmanager
+def replaying(statistics):
+    for taps, statistic in statistics:
+        taps.replay_statistic = statistic
+    try:
+        yield
+    finally:
+        for taps, _ in statistics:
+            taps.replay_statistic = None
+
+
+def checkpoint_contexts():
+    """context_fn of torch.utils.checkpoint for blocks that may hold taps.
+
+    The recomputation of a block has to save the same tensors as its
+    forward did, so the taps collecting during the forward compute their
+    statistics again while it is recomputed.
+    """
+    statistics = [ (taps, taps.collect_statistic) for taps in collecting_taps if taps.collect_statistic is not None ]
+    return contextlib.nullcontext(), replaying(statistics)
+
+
+def model_taps(model):
+    # DistributedDataParallel keeps the model in module
+    return getattr(getattr(model, 'module', model), 'taps', None)
@@ -0,0 +1,90 @@
+import copy
+import pytest
+import torch
+from batchinstancenorm import BatchInstanceNorm2d, batch_instance_norm
+from instancenormbatchswap import InstanceNormBatchSwap, instance_norm_batch_swap
+
+
+@pytest.fixture(autouse=True)
+def seed():
+    torch.manual_seed(0)
+
+
+def double_input(requires_grad=True):
+    return torch.randn(3, 4, 5, 5, dtype=torch.double, requires_grad=requires_grad)
+
+
+def running_statistics():
+    return torch.randn(4, dtype=torch.double), torch.rand(4, dtype=torch.double) + 0.5
+
+
+@pytest.mark.parametrize('training', [True, False])
+def test_batch_instance_norm_gradcheck(training):
+    input = double_input()
+    bn_weight, bias, in_weight = [ torch.randn(4, dtype=torch.double, requires_grad=True) for _ in range(3) ]
+    running_mean, running_var = running_statistics()
+    # running statistics are copied so the repeated forwards of gradcheck do not move them
+    assert torch.autograd.gradcheck(
+        lambda *inputs: batch_instance_norm(*inputs, running_mean.clone(), running_var.clone(), training, 0.1, 1e-5),
+        (input, bn_weight, bias, in_weight))
+
+
+def test_batch_instance_norm_gradcheck_without_bias_and_running_statistics():
+    input = double_input()
+    bn_weight, in_weight = [ torch.randn(4, dtype=torch.double, requires_grad=True) for _ in range(2) ]
+    assert torch.autograd.gradcheck(
+        lambda input, bn_weight, in_weight: batch_instance_norm(input, bn_weight, None, in_weight, None, None,
+            True, 0.1, 1e-5),
+        (input, bn_weight, in_weight))
+
+
+def test_instance_norm_batch_swap_gradcheck():
+    indices = torch.tensor([2, 0, 1])
+    assert torch.autograd.gradcheck(lambda input: instance_norm_batch_swap(input, indices), (double_input(),))
+
+
+def forward_backward(forward, input):
+    x = input.clone().requires_grad_(True)
+    output = forward(x)
+    output.pow(2).sum().backward()
+    return output.detach(), x.grad
+
+
+@pytest.mark.parametrize('training', [True, False])
+def test_batch_instance_norm_matches_reference(training):
+    fused = BatchInstanceNorm2d(4).double().train(training)
+    with torch.no_grad():
+        fused.gate.uniform_()
+        fused.weight.normal_()
+        fused.bias.normal_()
+        fused.running_mean.normal_()
+        fused.running_var.uniform_(0.5, 1.5)
+    reference = copy.deepcopy(fused)
+    input = double_input(requires_grad=False)
+
+    output, grad = forward_backward(fused, input)
+    reference_output, reference_grad = forward_backward(reference.reference_forward, input)
+
+    torch.testing.assert_close(output, reference_output)
+    torch.testing.assert_close(grad, reference_grad)
+    for name in ['running_mean', 'running_var', 'num_batches_tracked']:
+        torch.testing.assert_close(getattr(fused, name), getattr(reference, name))
+    for (name, parameter), reference_parameter in zip(fused.named_parameters(), reference.parameters()):
+        torch.testing.assert_close(parameter.grad, reference_parameter.grad, msg='gradient of {}'.format(name))
+
+
+def test_instance_norm_batch_swap_matches_reference():
+    layer = InstanceNormBatchSwap(4).train()
+    indices = torch.tensor([2, 0, 1])
+    input = double_input(requires_grad=False)
+
+    output, grad = forward_backward(lambda x: instance_norm_batch_swap(x, indices, layer.eps), input)
+    reference_output, reference_grad = forward_backward(lambda x: layer.reference_forward(x, indices), input)
+
+    torch.testing.assert_close(output, reference_output)
+    torch.testing.assert_close(grad, reference_grad)
+
+
+def test_instance_norm_batch_swap_is_identity_in_evaluation():
+    input = double_input(requires_grad=False)
+    assert torch.equal(InstanceNormBatchSwap(4).eval()(input), input)
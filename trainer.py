@@ -1,10 +1,19 @@
 # In[1]: Load Libraries
 
 import os
+import itertools
 import torch
 import numpy as np
 from score import *
 from utils import *
+from featurecache import has_frozen_backbone, create_feature_cache, build_input_stores
+from checkpoint import snapshot, CheckpointWriter, StepCheckpointer, create_resume_checkpoint, resume_checkpoint_path, set_rng_state, \
+    DeltaState, checkpoint_weights, load_checkpoint_weights, checkpoint_metadata, record_checkpoint, read_index, is_current
+from sampler import ResumableRandomSampler, ImportanceSampler, SubsetSampler, stratified_subset, with_sampler
+from resolution import scheduled_loader
+from evaluator import create_async_validator
+from taps import model_taps
+from parallel import is_distributed, is_main_process, get_rank, get_world_size, wrap_model, distributed_loader, set_loader_epoch
 from torchvision.utils import save_image
 from sklearn.manifold import TSNE
 import matplotlib.pyplot as plt
@@ -41,6 +50,30 @@ def calculate_reconstruction_loss(x, x_recon, distribution):
     return recon_loss
 
 
+def calculate_sample_reconstruction_loss(x, x_recon, distribution):
+    if distribution == 'bernoulli':
+        recon_loss = torch.nn.functional.binary_cross_entropy_with_logits(x_recon, x, reduction='none')
+    elif distribution == 'gaussian':
+        recon_loss = torch.nn.functional.mse_loss(x_recon, x, reduction='none')
+    else:
+        return None
+
+    return recon_loss.reshape(x.size(0), -1).sum(1)
+
+
+def calculate_sample_kl_divergence(mu, logvar):
+    mu = mu.reshape(mu.size(0), -1)
+    logvar = logvar.reshape(logvar.size(0), -1)
+    return (-0.5*(1 + logvar - mu.pow(2) - logvar.exp())).sum(1)
+
+
+def importance_weighted_loss(sample_losses, indices, importance_sampler):
+    """Records the per-sample losses and weights them back to the uniform expectation."""
+    importance_sampler.record(indices, sample_losses)
+    weights = importance_sampler.weights(indices).to(sample_losses.device, sample_losses.dtype)
+    return (weights * sample_losses).mean()
+
+
 def calculate_kl_divergence(mu, logvar):
     batch_size = mu.size(0)
     assert batch_size != 0
@@ -91,190 +124,279 @@ def calculate_kl_divergence(mu, logvar):
 
 # In[3]: Classifier
 
-def validate(model, dataloader, criterion, logger, device, similarity_weight=None):
-    logger.debug('Validation Start')
-    model.eval()
-    
-    total_top1, total_top5, total_, top1_score, top5_score = 0, 0, 0, 0, 0
-    loss = []
-    if similarity_weight is not None:
-        classification_loss = []
-        similarity_loss = []
+def classifier_metrics(device, similarity_weight=None):
+    names = ['loss', 'classification_loss', 'similarity_loss'] if similarity_weight is not None else ['loss']
+    return RunningMetrics(device, names, all_reduce=is_distributed())
 
-    for batch_index, batch in enumerate(dataloader):
-        if similarity_weight is not None:
-            output, batch_similarity = model(batch[dataloader.dataset.INDEX_IMAGE].to(device))
-        else:
-            output = model(batch[dataloader.dataset.INDEX_IMAGE].to(device))
-        target = batch[dataloader.dataset.INDEX_TARGET].to(device)
 
-        _, predicted_class = output.topk(5, 1, True, True)
-        top1, top5, total = score(predicted_class, target)
+def classification_loss(criterion, output, target, batch, dataset, importance_sampler=None):
+    if importance_sampler is None:
+        return criterion(output, target)
+    sample_losses = torch.nn.functional.cross_entropy(output, target, reduction='none')
+    return importance_weighted_loss(sample_losses, batch[dataset.INDEX_DATAPOINT], importance_sampler)
 
-        total_top1 += top1
-        total_top5 += top5
-        total_ += total
 
-        # loss
-        if similarity_weight is not None:
-            batch_classification_loss = criterion(output, target)
-            batch_similarity_loss = calculate_similarity_loss(batch_similarity)
-        
-            batch_loss = batch_classification_loss + (similarity_weight * batch_similarity_loss)
-        else:
-            batch_loss = criterion(output, target)
-
-        loss.append(batch_loss.item())
-        mean_loss = np.mean(loss)
-
-        if similarity_weight is not None:
-            classification_loss.append(batch_classification_loss.item())
-            similarity_loss.append(batch_similarity_loss.item())
-            mean_classification_loss = np.mean(classification_loss)
-            mean_similarity_loss = np.mean(similarity_loss)
-
-        top1_score = score_value(total_top1, total_)
-        top5_score = score_value(total_top5, total_)
-        if (batch_index + 1) % 10 == 0:
-            if similarity_weight is not None:
-                logger.debug('Validation Batch {}/{}: Top1 Accuracy {:.4f} Top5 Accuracy {:.4f}'.format(
-                    batch_index + 1, len(dataloader), top1_score, top5_score) \
-                    + ' Loss {:.4f} Classification Loss {:.4f} Similarity Loss {:.4f} Similarity Weight {:.2f}'.format(
-                        mean_loss, mean_classification_loss, mean_similarity_loss, similarity_weight))
-            else:
-                logger.debug('Validation Batch {}/{}: Top1 Accuracy {:.4f} Top5 Accuracy {:.4f} Loss {:.4f}'.format(
-                    batch_index + 1, len(dataloader), top1_score, top5_score, mean_loss))
-            if DEBUG:
-                break
+def classifier_loss(model, batch, dataset, criterion, metrics, device, similarity_weight=None, input=None,
+        importance_sampler=None):
+    if similarity_weight is not None:
+        taps = model_taps(model)
+        with taps.collect() as tapped:
+            output = forward_batch(model, batch, dataset, device, input)
+        batch_similarity = taps.stacked(tapped)
+    else:
+        output = forward_batch(model, batch, dataset, device, input)
+    target = batch[dataset.INDEX_TARGET].to(device)
 
-    logger.debug('Validation End')
-    return top1_score, top5_score, mean_loss
+    # accuracy
+    metrics.update_accuracy(output, target)
 
+    # loss
+    if similarity_weight is not None:
+        batch_similarity_loss = calculate_similarity_loss(batch_similarity)
+        batch_classification_loss = classification_loss(criterion, output, target, batch, dataset, importance_sampler)
 
-def train(model, dataloader, criterion, optimizer, logger, device, similarity_weight=None, grad_clip_norm_value=50):
-    logger.debug('Training Start')
-    model.train()
+        batch_loss = batch_classification_loss + (similarity_weight * batch_similarity_loss)
+        metrics.update(loss=batch_loss, classification_loss=batch_classification_loss,
+            similarity_loss=batch_similarity_loss)
+    else:
+        batch_loss = classification_loss(criterion, output, target, batch, dataset, importance_sampler)
+        metrics.update(loss=batch_loss)
 
-    total_top1, total_top5, total_, top1_score, top5_score = 0, 0, 0, 0, 0
-    loss = []
-    if similarity_weight is not None:
-        classification_loss = []
-        similarity_loss = []
+    return batch_loss
 
-    for batch_index, batch in enumerate(dataloader):
-        optimizer.zero_grad()
-        if similarity_weight is not None:
-            output, batch_similarity = model(batch[dataloader.dataset.INDEX_IMAGE].to(device))
-        else:
-            output = model(batch[dataloader.dataset.INDEX_IMAGE].to(device))
-        target = batch[dataloader.dataset.INDEX_TARGET].to(device)
 
-        # accuracy
-        _, predicted_class = output.topk(5, 1, True, True)
-        top1, top5, total = score(predicted_class, target)
+def validate_batch(model, batch, dataset, criterion, metrics, device, similarity_weight=None, input=None):
+    with torch.no_grad():
+        classifier_loss(model, batch, dataset, criterion, metrics, device, similarity_weight, input)
 
-        total_top1 += top1
-        total_top5 += top5
-        total_ += total
 
-        # loss
-        if similarity_weight is not None:
-            batch_similarity_loss = calculate_similarity_loss(batch_similarity)
-            batch_classification_loss = criterion(output, target)
+def train_batch(model, batch, dataset, criterion, optimizer, metrics, device, similarity_weight=None, grad_clip_norm_value=50,
+        input=None, importance_sampler=None):
+    optimizer.zero_grad()
+    batch_loss = classifier_loss(model, batch, dataset, criterion, metrics, device, similarity_weight, input,
+        importance_sampler)
 
-            batch_loss = batch_classification_loss + (similarity_weight * batch_similarity_loss)
-        else:
-            batch_loss = criterion(output, target)
+    # backprop
+    batch_loss.backward()
+    torch.nn.utils.clip_grad_norm_(model.parameters(), grad_clip_norm_value)
+    optimizer.step()
 
-        loss.append(batch_loss.item())
 
-        # backprop
-        batch_loss.backward()
-        torch.nn.utils.clip_grad_norm_(model.parameters(), grad_clip_norm_value)
-        optimizer.step()
-        
-        # use mean metrics
-        mean_loss = np.mean(loss)
-
-        if similarity_weight is not None:
-            classification_loss.append(batch_classification_loss.item())
-            similarity_loss.append(batch_similarity_loss.item())
-            mean_classification_loss = np.mean(classification_loss)
-            mean_similarity_loss = np.mean(similarity_loss)
-
-        top1_score = score_value(total_top1, total_)
-        top5_score = score_value(total_top5, total_)
-            
-        if (batch_index + 1) % 10 == 0:
-            if similarity_weight is not None:
-                logger.debug('Training Batch {}/{}: Top1 Accuracy {:.4f} Top5 Accuracy {:.4f}'.format(
-                    batch_index + 1, len(dataloader), top1_score, top5_score) \
-                    + 'Loss {:.4f} Classification Loss {:.4f} Similarity Loss {:.4f} Similarity Weight {:.2f}'.format(
-                        mean_loss, mean_classification_loss, mean_similarity_loss, similarity_weight))
-            else:
-                logger.debug('Training Batch {}/{}: Top1 Accuracy {:.4f} Top5 Accuracy {:.4f} Loss {:.4f}'.format(
-                    batch_index + 1, len(dataloader), top1_score, top5_score, mean_loss))
+def validate(model, dataloader, criterion, logger, device, similarity_weight=None, log_interval=10):
+    logger.debug('Validation Start')
+    model.eval()
+
+    metrics = classifier_metrics(device, similarity_weight)
+
+    for batch_index, batch in enumerate(dataloader):
+        validate_batch(model, batch, dataloader.dataset, criterion, metrics, device, similarity_weight)
+
+        if (batch_index + 1) % log_interval == 0:
+            log_classifier_metrics(logger, 'Validation', batch_index, len(dataloader), metrics, similarity_weight)
             if DEBUG:
                 break
 
-    logger.debug('Training End')
-    return top1_score, top5_score, mean_loss
+    logger.debug('Validation End')
+    top1_score, top5_score = metrics.scores()
+    return top1_score, top5_score, metrics.mean('loss')
 
 
-def run(model_name, model, model_directory, number_of_epochs, learning_rate, logger,
-        train_loader, val_loader, device, similarity_weight=None,
-        dataset_names=['stylized-imagenet200-0.0', 'stylized-imagenet200-1.0'], load_data=None):
-    checkpoint_path = pathJoin(model_directory, '{}.ckpt'.format(model_name))
-    print(checkpoint_path)
-
-    parameters = model.parameters()
-    if 'classifier' in model_name:
-        parameters = model.classifier.parameters()
+def train(model, dataloader, criterion, optimizer, logger, device, similarity_weight=None, grad_clip_norm_value=50, log_interval=10,
+        step_callback=None, importance_sampler=None):
+    logger.debug('Training Start')
+    model.train()
 
-    optimizer = torch.optim.SGD(parameters, lr=learning_rate, momentum=0.9)
+    metrics = classifier_metrics(device, similarity_weight)
 
-    lr_scheduler = torch.optim.lr_scheduler.ReduceLROnPlateau(optimizer, factor=0.2, patience=5, min_lr=1e-5)
-    
-    last_epoch = 0
-    best_validation_accuracy = -1.0
+    for batch_index, batch in enumerate(dataloader):
+        train_batch(model, batch, dataloader.dataset, criterion, optimizer, metrics, device, similarity_weight,
+            grad_clip_norm_value, importance_sampler=importance_sampler)
 
-    if os.path.isfile(checkpoint_path):
-        checkpoint = torch.load(checkpoint_path, map_location=device)
-        last_epoch = checkpoint['epoch']
-        best_validation_accuracy = checkpoint['validation_top5_accuracy']
-        model.load_state_dict(checkpoint['weights'])
-        optimizer.load_state_dict(checkpoint['optimizer_weights'])
+        if step_callback is not None:
+            step_callback(batch_index)
 
-    last_epoch += 1
-    logger.info('Training model {} from epoch {}'.format(checkpoint_path, last_epoch))
+        if (batch_index + 1) % log_interval == 0:
+            log_classifier_metrics(logger, 'Training', batch_index, len(dataloader), metrics, similarity_weight)
+            if DEBUG:
+                break
 
-    logger.info('Epochs {}'.format(number_of_epochs))
-    logger.info('Batch Size {}'.format(train_loader.batch_size))
-    logger.info('Number of Workers {}'.format(train_loader.num_workers))
-    logger.info('Optimizer {}'.format(optimizer))
-    logger.info('Learning Rate {}'.format(learning_rate))
-    logger.info('Similarity Weight {}'.format(similarity_weight))
-    logger.info('Device {}'.format(device))
+    logger.debug('Training End')
+    top1_score, top5_score = metrics.scores()
+    return top1_score, top5_score, metrics.mean('loss')
 
-    criterion = torch.nn.CrossEntropyLoss()
 
-    for epoch in range(last_epoch, number_of_epochs + 1):
-        train_top1_accuracy, train_top5_accuracy, train_loss = train(
-            model, train_loader, criterion, optimizer,
-            logger, device, similarity_weight)
-        validation_top1_accuracy, validation_top5_accuracy, validation_loss = validate(
-            model, val_loader, criterion,
-            logger, device, similarity_weight)
-        logger.info('Epoch {}: Train: Loss: {:.4f} Top1 Accuracy: {:.4f} Top5 Accuracy: {:.4f}'.format(
+def log_classifier_metrics(logger, stage, batch_index, number_of_batches, metrics, similarity_weight=None):
+    top1_score, top5_score = metrics.scores()
+    means = metrics.means()
+    if similarity_weight is not None:
+        logger.debug('{} Batch {}/{}: Top1 Accuracy {:.4f} Top5 Accuracy {:.4f}'.format(
+            stage, batch_index + 1, number_of_batches, top1_score, top5_score) \
+            + ' Loss {:.4f} Classification Loss {:.4f} Similarity Loss {:.4f} Similarity Weight {:.2f}'.format(
+                means['loss'], means['classification_loss'], means['similarity_loss'], similarity_weight))
+    else:
+        logger.debug('{} Batch {}/{}: Top1 Accuracy {:.4f} Top5 Accuracy {:.4f} Loss {:.4f}'.format(
+            stage, batch_index + 1, number_of_batches, top1_score, top5_score, means['loss']))
+
+
+def fast_validation_loader(val_loader, per_class, seed=0):
+    """Loader over a fixed class-stratified subset of the validation set."""
+    indices = stratified_subset(val_loader.dataset.groundtruths, per_class, seed)
+    return with_sampler(val_loader, SubsetSampler(indices, get_world_size(), get_rank()))
+
+
+def lagged_weights(model, delta_state, snapshot_model):
+    """Checkpoint weights taken from the snapshot a validator scores.
+
+    Which entries changed is decided on the live model, an entry untouched
+    now was untouched when the snapshot was taken.
+    """
+    weights = checkpoint_weights(model, delta_state)
+    snapshot_state = snapshot_model.state_dict()
+    weights['weights'] = { key: snapshot_state[key] for key in weights['weights'] }
+    return weights
+
+
+def create_train_sampler(dataset, seed, checkpoint_every_steps=None, importance_sampling=False,
+        importance_uniform_fraction=0.2, importance_epoch_fraction=1.0):
+    """Sampler replacing the shuffling of the train loader, None when the loader's own will do."""
+    if importance_sampling:
+        return ImportanceSampler(dataset, seed, get_world_size(), get_rank(),
+            importance_uniform_fraction, importance_epoch_fraction)
+    if checkpoint_every_steps:
+        return ResumableRandomSampler(dataset, seed, get_world_size(), get_rank())
+    return None
+
+
+class TrainingRun(object):
+    """Optimizer, scheduler, checkpoints and logger of one classifier being trained.
+
+    run() drives a single TrainingRun, run_shared() several of them from
+    one data stream.
+    """
+
+    def __init__(self, model_name, model, model_directory, learning_rate, logger, device, similarity_weight=None,
+            delta_checkpoints=False, delta_base=None, run_config=None):
+        self.model_name = model_name
+        self.model = model
+        self.training_model = model
+        self.model_directory = model_directory
+        self.learning_rate = learning_rate
+        self.logger = logger
+        self.device = device
+        self.similarity_weight = similarity_weight
+        self.run_config = run_config
+        self.checkpoint_path = pathJoin(model_directory, '{}.ckpt'.format(model_name))
+        print(self.checkpoint_path)
+
+        parameters = model.parameters()
+        if 'classifier' in model_name:
+            parameters = model.classifier.parameters()
+
+        self.optimizer = torch.optim.SGD(parameters, lr=learning_rate, momentum=0.9)
+
+        self.lr_scheduler = torch.optim.lr_scheduler.ReduceLROnPlateau(self.optimizer, factor=0.2, patience=5, min_lr=1e-5)
+
+        self.criterion = torch.nn.CrossEntropyLoss()
+
+        self.last_epoch = 0
+        self.best_validation_accuracy = -1.0
+        self.checkpoint = None
+
+        self.delta_state = None
+        if delta_checkpoints:
+            if delta_base is not None:
+                load_checkpoint_weights(model, torch.load(delta_base, map_location=device), device)
+            self.delta_state = DeltaState(model, delta_base)
+        self.delta_checkpoints = delta_checkpoints
+        self.delta_base = delta_base
+
+        if os.path.isfile(self.checkpoint_path):
+            checkpoint = torch.load(self.checkpoint_path, map_location=device)
+            self.last_epoch = checkpoint['epoch']
+            self.best_validation_accuracy = checkpoint['validation_top5_accuracy']
+            load_checkpoint_weights(model, checkpoint, device)
+            self.optimizer.load_state_dict(checkpoint['optimizer_weights'])
+            if 'scheduler' in checkpoint:
+                self.lr_scheduler.load_state_dict(checkpoint['scheduler'])
+            self.checkpoint = checkpoint
+
+        self.last_epoch += 1
+
+        # checkpoints keep the plain model, training goes through the wrapper
+        self.training_model = wrap_model(model)
+
+        self.writer = CheckpointWriter()
+
+    def resume(self, resume):
+        load_checkpoint_weights(self.model, resume, self.device)
+        self.optimizer.load_state_dict(resume['optimizer_weights'])
+        self.lr_scheduler.load_state_dict(resume['scheduler'])
+        self.best_validation_accuracy = resume['best_validation_accuracy']
+        self.last_epoch = resume['epoch']
+
+    def create_resume_checkpoint(self, epoch, position, sampler):
+        return create_resume_checkpoint(epoch, position, sampler, self.model, self.optimizer, self.lr_scheduler,
+            delta_state=self.delta_state, best_validation_accuracy=self.best_validation_accuracy)
+
+    def log_setup(self, number_of_epochs, train_loader):
+        self.logger.info('Epochs {}'.format(number_of_epochs))
+        self.logger.info('Batch Size {}'.format(train_loader.batch_size))
+        self.logger.info('Number of Workers {}'.format(train_loader.num_workers))
+        self.logger.info('Optimizer {}'.format(self.optimizer))
+        self.logger.info('Learning Rate {}'.format(self.learning_rate))
+        self.logger.info('Similarity Weight {}'.format(self.similarity_weight))
+        self.logger.info('Device {}'.format(self.device))
+        self.logger.info('Delta Checkpoints {} Base {}'.format(self.delta_checkpoints, self.delta_base))
+        self.logger.info('Processes {} Rank {}'.format(get_world_size(), get_rank()))
+
+    def submit_validation(self, validator, epoch, train_scores):
+        """Hands the weights of epoch to validator, returns what end_lagged_epoch needs to finish it."""
+        validator.submit(epoch, self.model, criterion=self.criterion, similarity_weight=self.similarity_weight)
+        return epoch, train_scores, lagged_weights(self.model, self.delta_state, validator.snapshot_model), \
+            snapshot(self.optimizer.state_dict())
+
+    def end_lagged_epoch(self, validator, lagged):
+        if lagged is None:
+            return
+        epoch, train_scores, weights, optimizer_state = lagged
+        _, validation_scores = validator.collect()
+        self.end_epoch(epoch, train_scores, validation_scores, weights, optimizer_state)
+
+    def log_subset_validation(self, epoch, validation_scores, subset_size):
+        top1_accuracy, top5_accuracy, loss = validation_scores
+        top1_low, top1_high = proportion_interval(top1_accuracy, subset_size)
+        top5_low, top5_high = proportion_interval(top5_accuracy, subset_size)
+        self.logger.info('Epoch {}: Subset Validation ({} images): Loss: {:.4f}'.format(epoch, subset_size, loss) \
+            + ' Top1 Accuracy: {:.4f} [{:.4f}, {:.4f}] Top5 Accuracy: {:.4f} [{:.4f}, {:.4f}]'.format(
+                top1_accuracy, top1_low, top1_high, top5_accuracy, top5_low, top5_high))
+
+    def end_epoch(self, epoch, train_scores, validation_scores, weights=None, optimizer_state=None,
+            full_validation=None, subset_size=None, final=False):
+        """With full_validation, validation_scores are estimated on a subset of subset_size
+        images and full_validation() scores the whole set before a new best checkpoint
+        can replace the old one, and on the final epoch.
+        """
+        # the plateau scheduler only ever compares losses of the same estimator,
+        # the subset one whenever the subset is validated
+        plateau_loss = validation_scores[2]
+        if full_validation is not None:
+            self.log_subset_validation(epoch, validation_scores, subset_size)
+            if final or validation_scores[1] > self.best_validation_accuracy:
+                self.logger.debug('Improved Subset Validation Score or Final Epoch, validating on the full set')
+                validation_scores = full_validation()
+
+        train_top1_accuracy, train_top5_accuracy, train_loss = train_scores
+        validation_top1_accuracy, validation_top5_accuracy, validation_loss = validation_scores
+        self.logger.info('Epoch {}: Train: Loss: {:.4f} Top1 Accuracy: {:.4f} Top5 Accuracy: {:.4f}'.format(
             epoch, train_loss, train_top1_accuracy, train_top5_accuracy) \
             + ' Validation: Loss: {:.4f} Top1 Accuracy: {:.4f} Top5 Accuracy: {:.4f}'.format(
                 validation_loss, validation_top1_accuracy, validation_top5_accuracy))
 
-        lr_scheduler.step(validation_loss)
+        self.lr_scheduler.step(plateau_loss)
 
-        if validation_top5_accuracy > best_validation_accuracy:
-            logger.debug('Improved Validation Score, saving new weights')
-            os.makedirs(model_directory, exist_ok=True)
+        if validation_top5_accuracy > self.best_validation_accuracy:
+            self.logger.debug('Improved Validation Score, saving new weights')
+            os.makedirs(self.model_directory, exist_ok=True)
             checkpoint = {
                 'epoch': epoch,
                 'train_top1_accuracy': train_top1_accuracy,
@@ -283,23 +405,350 @@ def run(model_name, model, model_directory, number_of_epochs, learning_rate, log
                 'validation_top1_accuracy': validation_top1_accuracy,
                 'validation_top5_accuracy': validation_top5_accuracy,
                 'validation_loss': validation_loss,
-                'weights': model.state_dict(),
-                'optimizer_weights': optimizer.state_dict()
+                'optimizer_weights': optimizer_state if optimizer_state is not None else self.optimizer.state_dict(),
+                'scheduler': self.lr_scheduler.state_dict()
             }
-            torch.save(checkpoint, pathJoin(model_directory, '{}.ckpt'.format(model_name)))
-            best_validation_accuracy = validation_top5_accuracy
+            checkpoint.update(weights if weights is not None else checkpoint_weights(self.model, self.delta_state))
+            self.writer.save(checkpoint, self.checkpoint_path, {'model': self.model_name, 'config': self.run_config})
+            self.best_validation_accuracy = validation_top5_accuracy
+            self.checkpoint = checkpoint
 
-    logger.info('Epoch {}'.format(checkpoint['epoch']))
+    def finish(self, load_data, dataset_names):
+        self.writer.close()
+
+        checkpoint = self.checkpoint
+        self.logger.info('Epoch {}'.format(checkpoint['epoch']))
+
+        scores = evaluate_model(self.model_name, self.model, load_data, dataset_names,
+            self.logger.info, self.device)
+        self.logger.info('Train: Loss: {:.4f} Top1 Accuracy: {:.4f} Top5 Accuracy: {:.4f}'.format(
+            checkpoint['train_loss'], checkpoint['train_top1_accuracy'], checkpoint['train_top5_accuracy']))
+        self.logger.info('Validation: Loss: {:.4f} Top1 Accuracy: {:.4f} Top5 Accuracy: {:.4f}'.format(
+            checkpoint['validation_loss'], checkpoint['validation_top1_accuracy'], checkpoint['validation_top5_accuracy']))
+        return scores
+
+
+def run(model_name, model, model_directory, number_of_epochs, learning_rate, logger,
+        train_loader, val_loader, device, similarity_weight=None,
+        dataset_names=['stylized-imagenet200-0.0', 'stylized-imagenet200-1.0'], load_data=None,
+        feature_cache_directory=None, feature_cache_views=0, checkpoint_every_steps=None, seed=0,
+        delta_checkpoints=False, delta_base=None, run_config=None, importance_sampling=False,
+        importance_uniform_fraction=0.2, importance_epoch_fraction=1.0, resolution_schedule=None,
+        async_validation=False, fast_validation_per_class=None):
+    training_run = TrainingRun(model_name, model, model_directory, learning_rate, logger, device, similarity_weight,
+        delta_checkpoints, delta_base, run_config)
+
+    last_epoch = training_run.last_epoch
+    start_position = 0
+
+    # cached features are read per view, not per image, so they keep uniform sampling
+    # and the resolution they were extracted at
+    use_feature_cache = feature_cache_directory is not None and has_frozen_backbone(model)
+    importance_sampling = importance_sampling and not use_feature_cache
+    resolution_schedule = resolution_schedule if not use_feature_cache else None
+
+    sampler = create_train_sampler(train_loader.dataset, seed, checkpoint_every_steps, importance_sampling,
+        importance_uniform_fraction, importance_epoch_fraction)
+    if sampler is not None:
+        train_loader = with_sampler(train_loader, sampler)
+    importance_sampler = sampler if importance_sampling else None
+
+    step_checkpointer = None
+    if checkpoint_every_steps:
+        resume_path = resume_checkpoint_path(model_directory, model_name)
+        step_checkpointer = StepCheckpointer(training_run.writer, resume_path, checkpoint_every_steps, sampler, train_loader.batch_size,
+            lambda epoch, position: training_run.create_resume_checkpoint(epoch, position, sampler))
+        if os.path.isfile(resume_path):
+            resume = torch.load(resume_path, map_location=device)
+            if resume['epoch'] >= last_epoch:
+                training_run.resume(resume)
+                sampler.load_state_dict(resume['sampler'])
+                set_rng_state(resume['rng'])
+                last_epoch, start_position = resume['epoch'], resume['position']
+
+    logger.info('Training model {} from epoch {} datapoint {}'.format(training_run.checkpoint_path, last_epoch, start_position))
+
+    # cached validation features are cheap to score in full
+    fast_val_loader = None
+    if fast_validation_per_class and not use_feature_cache:
+        fast_val_loader = fast_validation_loader(val_loader, fast_validation_per_class, seed)
+        logger.info('Fast Validation {} per class, {} of {} images'.format(fast_validation_per_class,
+            len(fast_val_loader.sampler.indices), len(val_loader.dataset)))
+
+    # each process reads its own shard when distributed
+    train_loader = distributed_loader(train_loader, shuffle=True, seed=seed)
+    val_loader = distributed_loader(val_loader, shuffle=False)
+
+    training_run.log_setup(number_of_epochs, train_loader)
+    logger.info('Checkpoint Every Steps {}'.format(checkpoint_every_steps))
+    log_importance_sampling(logger, importance_sampler)
+    logger.info('Resolution Schedule {}'.format(resolution_schedule))
+
+    # classifier-only models train their head on cached backbone features
+    if use_feature_cache:
+        training_run.training_model, train_loader, val_loader = create_feature_cache(model, model_name,
+            train_loader, val_loader, feature_cache_directory, feature_cache_views, device, logger)
+        logger.info('Feature Cache {} Views {}'.format(feature_cache_directory, feature_cache_views))
+    build_input_stores(model, train_loader, val_loader, device)
+
+    # the scores of an epoch come back while the next one trains, the scheduler and
+    # the best checkpoint act on them one epoch late
+    validator = None
+    if async_validation and not use_feature_cache:
+        validator = create_async_validator(model, val_loader, validate, device, logger)
+    lagged = None
+
+    for epoch in range(last_epoch, number_of_epochs + 1):
+        set_loader_epoch(train_loader, epoch)
+        if step_checkpointer is not None:
+            step_checkpointer.start_epoch(epoch, start_position if epoch == last_epoch else 0)
+        elif sampler is not None:
+            sampler.set_epoch(epoch)
+        epoch_train_loader = scheduled_loader(train_loader, resolution_schedule, epoch)
+        if step_checkpointer is not None:
+            step_checkpointer.batch_size = epoch_train_loader.batch_size
+        train_scores = train(
+            training_run.training_model, epoch_train_loader, training_run.criterion, training_run.optimizer,
+            logger, device, similarity_weight, step_callback=step_checkpointer, importance_sampler=importance_sampler)
+        if importance_sampler is not None:
+            importance_sampler.end_epoch()
+        if fast_val_loader is not None:
+            validation_scores = validate(
+                training_run.training_model, fast_val_loader, training_run.criterion,
+                logger, device, similarity_weight)
+            training_run.end_epoch(epoch, train_scores, validation_scores,
+                full_validation=lambda: validate(training_run.training_model, val_loader, training_run.criterion,
+                    logger, device, similarity_weight),
+                subset_size=len(fast_val_loader.sampler.indices), final=epoch == number_of_epochs)
+        elif validator is None:
+            validation_scores = validate(
+                training_run.training_model, val_loader, training_run.criterion,
+                logger, device, similarity_weight)
+            training_run.end_epoch(epoch, train_scores, validation_scores)
+        else:
+            training_run.end_lagged_epoch(validator, lagged)
+            lagged = training_run.submit_validation(validator, epoch, train_scores)
+
+        if step_checkpointer is not None:
+            step_checkpointer.save(epoch + 1, 0)
+
+    if validator is not None:
+        training_run.end_lagged_epoch(validator, lagged)
+        validator.close()
+
+    training_run.finish(load_data, dataset_names)
+
+
+def log_importance_sampling(logger, importance_sampler):
+    if importance_sampler is None:
+        logger.info('Importance Sampling False')
+        return
+    logger.info('Importance Sampling True Uniform Fraction {} Epoch Fraction {} Images per Epoch {}'.format(
+        importance_sampler.uniform_fraction, importance_sampler.epoch_fraction, importance_sampler.epoch_length()))
+
+
+def run_shared(training_runs, number_of_epochs, train_loader, val_loader, device,
+        dataset_names=['stylized-imagenet200-0.0', 'stylized-imagenet200-1.0'], load_data=None, log_interval=10,
+        resolution_schedule=None):
+    """Trains several classifiers on one data stream, every batch is loaded once.
+
+    Each TrainingRun keeps its own optimizer, scheduler, checkpoint and
+    logger and reports the same metrics as train()/validate(). A run that
+    resumed from a later epoch than the others joins when the stream
+    reaches that epoch.
+    """
+    train_loader = distributed_loader(train_loader, shuffle=True)
+    val_loader = distributed_loader(val_loader, shuffle=False)
+
+    dataset = train_loader.dataset
+    for training_run in training_runs:
+        training_run.logger.info('Training model {} from epoch {} on a stream shared by {} models'.format(
+            training_run.checkpoint_path, training_run.last_epoch, len(training_runs)))
+        training_run.log_setup(number_of_epochs, train_loader)
+        training_run.logger.info('Resolution Schedule {}'.format(resolution_schedule))
+        build_input_stores(training_run.model, train_loader, val_loader, device)
+
+    first_epoch = min(training_run.last_epoch for training_run in training_runs)
+    for epoch in range(first_epoch, number_of_epochs + 1):
+        active_runs = [ training_run for training_run in training_runs if training_run.last_epoch <= epoch ]
+        set_loader_epoch(train_loader, epoch)
+
+        # training
+        for training_run in active_runs:
+            training_run.logger.debug('Training Start')
+            training_run.training_model.train()
+            training_run.metrics = classifier_metrics(device, training_run.similarity_weight)
+
+        epoch_train_loader = scheduled_loader(train_loader, resolution_schedule, epoch)
+        for batch_index, batch in enumerate(epoch_train_loader):
+            input = batch[dataset.INDEX_IMAGE].to(device)
+            for training_run in active_runs:
+                train_batch(training_run.training_model, batch, dataset, training_run.criterion, training_run.optimizer,
+                    training_run.metrics, device, training_run.similarity_weight, input=input)
+                if (batch_index + 1) % log_interval == 0:
+                    log_classifier_metrics(training_run.logger, 'Training', batch_index, len(epoch_train_loader),
+                        training_run.metrics, training_run.similarity_weight)
+            if DEBUG and (batch_index + 1) % log_interval == 0:
+                break
+
+        train_scores = {}
+        for training_run in active_runs:
+            training_run.logger.debug('Training End')
+            top1_score, top5_score = training_run.metrics.scores()
+            train_scores[training_run.model_name] = top1_score, top5_score, training_run.metrics.mean('loss')
+
+        # validation
+        for training_run in active_runs:
+            training_run.logger.debug('Validation Start')
+            training_run.training_model.eval()
+            training_run.metrics = classifier_metrics(device, training_run.similarity_weight)
+
+        for batch_index, batch in enumerate(val_loader):
+            input = batch[val_loader.dataset.INDEX_IMAGE].to(device)
+            for training_run in active_runs:
+                validate_batch(training_run.training_model, batch, val_loader.dataset, training_run.criterion,
+                    training_run.metrics, device, training_run.similarity_weight, input=input)
+                if (batch_index + 1) % log_interval == 0:
+                    log_classifier_metrics(training_run.logger, 'Validation', batch_index, len(val_loader),
+                        training_run.metrics, training_run.similarity_weight)
+            if DEBUG and (batch_index + 1) % log_interval == 0:
+                break
+
+        for training_run in active_runs:
+            training_run.logger.debug('Validation End')
+            top1_score, top5_score = training_run.metrics.scores()
+            validation_scores = top1_score, top5_score, training_run.metrics.mean('loss')
+            training_run.end_epoch(epoch, train_scores[training_run.model_name], validation_scores)
+
+    for training_run in training_runs:
+        training_run.finish(load_data, dataset_names)
 
-    evaluate_model(model_name, model, load_data, dataset_names,
-        logger.info, similarity_weight is not None, device)
-    logger.info('Train: Loss: {:.4f} Top1 Accuracy: {:.4f} Top5 Accuracy: {:.4f}'.format(
-        checkpoint['train_loss'], checkpoint['train_top1_accuracy'], checkpoint['train_top5_accuracy']))
-    logger.info('Validation: Loss: {:.4f} Top1 Accuracy: {:.4f} Top5 Accuracy: {:.4f}'.format(
-        checkpoint['validation_loss'], checkpoint['validation_top1_accuracy'], checkpoint['validation_top5_accuracy']))
 
+# In[4]: Distillation
 
-# In[4]: Autoencoder
+DISTILLATION_METRICS = ['loss', 'distillation_loss', 'classification_loss']
+
+
+def distilled_model_name(student_name, teacher_name):
+    return 'distilled_{}_from_{}'.format(student_name, teacher_name)
+
+
+def calculate_distillation_loss(output, teacher_output, temperature):
+    # the temperature squared keeps the gradient scale independent of the temperature
+    return torch.nn.functional.kl_div(torch.nn.functional.log_softmax(output / temperature, dim=1),
+        torch.nn.functional.softmax(teacher_output / temperature, dim=1), reduction='batchmean') * temperature ** 2
+
+
+def train_distillation_batch(student, teacher, batch, dataset, criterion, optimizer, metrics, device, temperature, alpha,
+        grad_clip_norm_value=50):
+    input = batch[dataset.INDEX_IMAGE].to(device)
+    target = batch[dataset.INDEX_TARGET].to(device)
+    with torch.no_grad():
+        teacher_output = forward_batch(teacher, batch, dataset, device, input)
+
+    optimizer.zero_grad()
+    output = forward_batch(student, batch, dataset, device, input)
+
+    # accuracy
+    metrics.update_accuracy(output, target)
+
+    # loss
+    distillation_loss = calculate_distillation_loss(output, teacher_output, temperature)
+    classification_loss = criterion(output, target)
+    batch_loss = alpha * distillation_loss + (1 - alpha) * classification_loss
+    metrics.update(loss=batch_loss, distillation_loss=distillation_loss, classification_loss=classification_loss)
+
+    # backprop
+    batch_loss.backward()
+    torch.nn.utils.clip_grad_norm_(student.parameters(), grad_clip_norm_value)
+    optimizer.step()
+
+
+def train_distillation(student, teacher, loaders, criterion, optimizer, logger, device, temperature, alpha, log_interval=10):
+    """One epoch over the loaders, taking a batch from each in turn."""
+    logger.debug('Training Start')
+    student.train()
+    teacher.eval()
+
+    metrics = RunningMetrics(device, DISTILLATION_METRICS, all_reduce=is_distributed())
+    number_of_batches = min(len(loader) for loader in loaders) * len(loaders)
+
+    batches = itertools.chain.from_iterable(zip(*loaders))
+    for batch_index, (batch, loader) in enumerate(zip(batches, itertools.cycle(loaders))):
+        train_distillation_batch(student, teacher, batch, loader.dataset, criterion, optimizer, metrics, device,
+            temperature, alpha)
+
+        if (batch_index + 1) % log_interval == 0:
+            top1_score, top5_score = metrics.scores()
+            means = metrics.means()
+            logger.debug('Training Batch {}/{}: Top1 Accuracy {:.4f} Top5 Accuracy {:.4f}'.format(
+                batch_index + 1, number_of_batches, top1_score, top5_score) \
+                + ' Loss {:.4f} Distillation Loss {:.4f} Classification Loss {:.4f}'.format(
+                    means['loss'], means['distillation_loss'], means['classification_loss']))
+            if DEBUG:
+                break
+
+    logger.debug('Training End')
+    top1_score, top5_score = metrics.scores()
+    return top1_score, top5_score, metrics.mean('loss')
+
+
+def load_teacher(teacher_name, teacher, model_directory, device):
+    teacher_checkpoint_path = pathJoin(model_directory, '{}.ckpt'.format(teacher_name))
+    if not os.path.isfile(teacher_checkpoint_path):
+        raise ValueError('Teacher Model not found at: {}'.format(teacher_checkpoint_path))
+    load_checkpoint_weights(teacher, torch.load(teacher_checkpoint_path, map_location=device), device)
+    teacher.eval()
+    for param in teacher.parameters():
+        param.requires_grad = False
+    return teacher
+
+
+def run_distillation(student_name, student, teacher_name, teacher, model_directory, number_of_epochs, learning_rate,
+        logger, train_loaders, val_loader, device, temperature=4.0, alpha=0.9,
+        dataset_names=['stylized-imagenet200-0.0', 'stylized-imagenet200-1.0'], load_data=None,
+        delta_checkpoints=False, delta_base=None, run_config=None):
+    """Trains student on the logits of a trained teacher, a batch from each of train_loaders in turn.
+
+    The loss is alpha times the temperature-softened KL divergence to the
+    teacher plus (1 - alpha) times the cross entropy to the labels. The
+    student is checkpointed on its validation top-5 like run() and both
+    models are scored on dataset_names at the end.
+    """
+    model_name = distilled_model_name(student_name, teacher_name)
+    load_teacher(teacher_name, teacher, model_directory, device)
+    training_run = TrainingRun(model_name, student, model_directory, learning_rate, logger, device,
+        delta_checkpoints=delta_checkpoints, delta_base=delta_base, run_config=run_config)
+
+    logger.info('Distilling teacher {} into {} from epoch {}'.format(teacher_name, training_run.checkpoint_path,
+        training_run.last_epoch))
+    train_loaders = [ distributed_loader(train_loader, shuffle=True) for train_loader in train_loaders ]
+    val_loader = distributed_loader(val_loader, shuffle=False)
+    training_run.log_setup(number_of_epochs, train_loaders[0])
+    logger.info('Temperature {} Alpha {}'.format(temperature, alpha))
+    logger.info('Train Datasets {}'.format(', '.join(loader.dataset.directory for loader in train_loaders)))
+    build_input_stores(teacher, train_loaders[0], val_loader, device)
+
+    for epoch in range(training_run.last_epoch, number_of_epochs + 1):
+        for train_loader in train_loaders:
+            set_loader_epoch(train_loader, epoch)
+        train_scores = train_distillation(
+            training_run.training_model, teacher, train_loaders, training_run.criterion, training_run.optimizer,
+            logger, device, temperature, alpha)
+        validation_scores = validate(training_run.training_model, val_loader, training_run.criterion, logger, device)
+        training_run.end_epoch(epoch, train_scores, validation_scores)
+
+    student_scores = training_run.finish(load_data, dataset_names)
+    teacher_scores = evaluate_model(teacher_name, teacher, load_data, dataset_names, logger.info, device)
+
+    logger.info('Student {} Teacher {}'.format(model_name, teacher_name))
+    for index, dataset_name in enumerate(dataset_names):
+        logger.info('{}: Student Top1: {:.4f} Top5: {:.4f} Teacher Top1: {:.4f} Top5: {:.4f}'.format(dataset_name,
+            student_scores['top1'][index], student_scores['top5'][index],
+            teacher_scores['top1'][index], teacher_scores['top5'][index]))
+
+
+# In[5]: Autoencoder
 
 def plot_manifold(all_mu, all_class, manifold_filename):
     tsne = TSNE(n_components=2, perplexity=40, n_iter=300)
@@ -310,12 +759,28 @@ def plot_manifold(all_mu, all_class, manifold_filename):
     plt.scatter(x, y, color=[ colors[i] for i in all_class ])
     plt.savefig(manifold_filename, bbox_inches='tight')
 
-def validate_autoencoder(model, loader, logger, device, reconstruction_grid_filename, manifold_filename, beta, gamma, criterion, save_reconstruction, distribution):
+AUTOENCODER_METRICS = ['loss', 'reconstruction_loss', 'effective_kl', 'effective_classification_loss',
+    'classification_loss', 'total_kld', 'mean_kld']
+
+
+def log_autoencoder_metrics(logger, stage, batch_index, number_of_batches, metrics):
+    top1_score, top5_score = metrics.scores()
+    means = metrics.means()
+    logger.debug('{} Batch {}/{}: Loss {:.4f}'.format(stage, batch_index + 1, number_of_batches, means['loss']) \
+        + ' Top1 Accuracy {:.4f} Top5 Accuracy {:.4f}'.format(top1_score, top5_score) \
+        + ' Reconstruction Loss: {:.4f}'.format(means['reconstruction_loss']) \
+        + ' Effective-KL {:.4f}'.format(means['effective_kl']) \
+        + ' Effective-CE {:.4f}'.format(means['effective_classification_loss']) \
+        + ' Cross-Entropy {:.4f}'.format(means['classification_loss']) \
+        + ' KL-Divergence: {:.4f}'.format(means['total_kld']) \
+        + ' Mean-KLD: {:.4f}'.format(means['mean_kld']))
+
+
+def validate_autoencoder(model, loader, logger, device, reconstruction_grid_filename, manifold_filename, beta, gamma, criterion, save_reconstruction, distribution, log_interval=10):
     logger.debug('Validation Start')
     model.eval()
 
-    total_top1, total_top5, total_, top1_score, top5_score = 0, 0, 0, 0, 0
-    loss = []
+    metrics = RunningMetrics(device, AUTOENCODER_METRICS, all_reduce=is_distributed())
     all_mu = []
     all_class = []
 
@@ -323,15 +788,11 @@ def validate_autoencoder(model, loader, logger, device, reconstruction_grid_file
         batch_input = batch[loader.dataset.INDEX_IMAGE].to(device)
         batch_classification_target = batch[loader.dataset.INDEX_TARGET].to(device)
         batch_reconstruction_target = batch[loader.dataset.INDEX_TARGET_IMAGE].to(device)
-        batch_class_prediction, batch_reconstruction, mu, logvar = model(batch_input)
+        with torch.no_grad():
+            batch_class_prediction, batch_reconstruction, mu, logvar = model(batch_input)
 
         # accuracy
-        _, predicted_class = batch_class_prediction.topk(5, 1, True, True)
-        top1, top5, total = score(predicted_class, batch_classification_target)
-
-        total_top1 += top1
-        total_top5 += top5
-        total_ += total
+        metrics.update_accuracy(batch_class_prediction, batch_classification_target)
 
         # loss
         classification_loss = criterion(batch_class_prediction, batch_classification_target)
@@ -341,20 +802,9 @@ def validate_autoencoder(model, loader, logger, device, reconstruction_grid_file
         effective_classification_loss = gamma * classification_loss
         batch_loss = reconstruction_loss + effective_kl + effective_classification_loss
 
-        logger.debug('Batch Loss: {}'.format(batch_loss.item()) \
-            + ' Reconstruction Loss: {:.4f}'.format(reconstruction_loss.item()) \
-            + ' Effective-KL {:.4f}'.format(effective_kl.item()) \
-            + ' Effective-CE {:.4f}'.format(effective_classification_loss.item()) \
-            + ' Cross-Entropy {:.4f}'.format(classification_loss.item()) \
-            + ' KL-Divergence: {:.4f}'.format(total_kld.item()) \
-            + ' Mean-KLD: {:.4f}'.format(mean_kld.item()))
-
-        loss.append(batch_loss.item())
-
-        mean_loss = np.mean(loss)
-
-        top1_score = score_value(total_top1, total_)
-        top5_score = score_value(total_top5, total_)
+        metrics.update(loss=batch_loss, reconstruction_loss=reconstruction_loss, effective_kl=effective_kl,
+            effective_classification_loss=effective_classification_loss, classification_loss=classification_loss,
+            total_kld=total_kld, mean_kld=mean_kld)
 
         if save_reconstruction:
             if batch_index == 0:
@@ -363,12 +813,11 @@ def validate_autoencoder(model, loader, logger, device, reconstruction_grid_file
                     batch_reconstruction.view(*batch_reconstruction_target.shape)[:n]])
                 save_image(comparison.cpu(), reconstruction_grid_filename, nrow=n, normalize=False)
             
-            all_mu.append(mu)
+            all_mu.append(mu.detach())
             all_class.append(batch_classification_target)
 
-        if (batch_index + 1) % 10 == 0:
-            logger.debug('Validation Batch {}/{}: Loss {:.4f}'.format(batch_index + 1, len(loader), mean_loss) \
-                + ' Top1 Accuracy {:.4f} Top5 Accuracy {:.4f}'.format(top1_score, top5_score))
+        if (batch_index + 1) % log_interval == 0:
+            log_autoencoder_metrics(logger, 'Validation', batch_index, len(loader), metrics)
             if DEBUG:
                 break
 
@@ -377,14 +826,15 @@ def validate_autoencoder(model, loader, logger, device, reconstruction_grid_file
         all_class = torch.cat(all_class, dim=0).detach().cpu().numpy()
         plot_manifold(all_mu, all_class, manifold_filename)
     logger.debug('Validation End')
-    return top1_score, top5_score, mean_loss
+    top1_score, top5_score = metrics.scores()
+    return top1_score, top5_score, metrics.mean('loss')
 
-def train_autoencoder(model, loader, optimizer, logger, device, beta, gamma, criterion, distribution, grad_clip_norm_value=50):
+def train_autoencoder(model, loader, optimizer, logger, device, beta, gamma, criterion, distribution, grad_clip_norm_value=50, log_interval=10,
+        step_callback=None, importance_sampler=None):
     logger.debug('Training Start')
     model.train()
 
-    total_top1, total_top5, total_, top1_score, top5_score = 0, 0, 0, 0, 0
-    loss = []
+    metrics = RunningMetrics(device, AUTOENCODER_METRICS, all_reduce=is_distributed())
 
     for batch_index, batch in enumerate(loader):
         optimizer.zero_grad()
@@ -394,12 +844,7 @@ def train_autoencoder(model, loader, optimizer, logger, device, beta, gamma, cri
         batch_class_prediction, batch_reconstruction, mu, logvar = model(batch_input)
 
         # accuracy
-        _, predicted_class = batch_class_prediction.topk(5, 1, True, True)
-        top1, top5, total = score(predicted_class, batch_classification_target)
-
-        total_top1 += top1
-        total_top5 += top5
-        total_ += total
+        metrics.update_accuracy(batch_class_prediction, batch_classification_target)
 
         # loss
         classification_loss = criterion(batch_class_prediction, batch_classification_target)
@@ -407,65 +852,115 @@ def train_autoencoder(model, loader, optimizer, logger, device, beta, gamma, cri
         total_kld, dim_wise_kld, mean_kld = calculate_kl_divergence(mu, logvar)
         effective_kl = beta * total_kld
         effective_classification_loss = gamma * classification_loss
-        batch_loss = reconstruction_loss + effective_kl + effective_classification_loss
-
-        logger.debug('Batch Loss: {}'.format(batch_loss.item()) \
-            + ' Reconstruction Loss: {:.4f}'.format(reconstruction_loss.item()) \
-            + ' Effective-KL {:.4f}'.format(effective_kl.item()) \
-            + ' Effective-CE {:.4f}'.format(effective_classification_loss.item()) \
-            + ' Cross-Entropy {:.4f}'.format(classification_loss.item()) \
-            + ' KL-Divergence: {:.4f}'.format(total_kld.item()) \
-            + ' Mean-KLD: {:.4f}'.format(mean_kld.item()))
+        if importance_sampler is None:
+            batch_loss = reconstruction_loss + effective_kl + effective_classification_loss
+        else:
+            sample_losses = calculate_sample_reconstruction_loss(batch_reconstruction_target, batch_reconstruction, distribution) \
+                + beta * calculate_sample_kl_divergence(mu, logvar) \
+                + gamma * torch.nn.functional.cross_entropy(batch_class_prediction, batch_classification_target, reduction='none')
+            batch_loss = importance_weighted_loss(sample_losses, batch[loader.dataset.INDEX_DATAPOINT], importance_sampler)
 
-        loss.append(batch_loss.item())
+        metrics.update(loss=batch_loss, reconstruction_loss=reconstruction_loss, effective_kl=effective_kl,
+            effective_classification_loss=effective_classification_loss, classification_loss=classification_loss,
+            total_kld=total_kld, mean_kld=mean_kld)
 
         # backprop
         batch_loss.backward()
         torch.nn.utils.clip_grad_norm_(model.parameters(), grad_clip_norm_value)
         optimizer.step()
-        
-        # use mean metrics
-        mean_loss = np.mean(loss)
 
-        top1_score = score_value(total_top1, total_)
-        top5_score = score_value(total_top5, total_)
-            
-        if (batch_index + 1) % 10 == 0:
-            logger.debug('Training Batch {}/{}: Loss {:.4f}'.format(batch_index + 1, len(loader), mean_loss) \
-                + ' Top1 Accuracy {:.4f} Top5 Accuracy {:.4f}'.format(top1_score, top5_score))
+        if step_callback is not None:
+            step_callback(batch_index)
+
+        if (batch_index + 1) % log_interval == 0:
+            log_autoencoder_metrics(logger, 'Training', batch_index, len(loader), metrics)
             if DEBUG:
                 break
 
     logger.debug('Training End')
-    return top1_score, top5_score, mean_loss
+    top1_score, top5_score = metrics.scores()
+    return top1_score, top5_score, metrics.mean('loss')
 
 
 def run_autoencoder(model_name, model, model_directory, number_of_epochs,
     learning_rate, logger, train_loader, val_loader, device, beta, image_size,
     gamma, image_directory=pathJoin('betavaeresults'), load_data=None,
-    dataset_names=['stylized-imagenet200-0.0', 'stylized-imagenet200-1.0'], vae_transforms=None):
+    dataset_names=['stylized-imagenet200-0.0', 'stylized-imagenet200-1.0'], vae_transforms=None,
+    checkpoint_every_steps=None, seed=0, delta_checkpoints=False, delta_base=None, run_config=None,
+    importance_sampling=False, importance_uniform_fraction=0.2, importance_epoch_fraction=1.0,
+    async_validation=False):
     checkpoint_path = pathJoin(model_directory, '{}.ckpt'.format(model_name))
     print(checkpoint_path)
 
     optimizer = torch.optim.Adam(model.parameters(), lr=learning_rate)
 
+    anneal_start = 30
+    anneal_width = number_of_epochs - anneal_start
+
+    max_beta = beta
+    min_beta = 0.0
+
+    current_beta = min_beta
+
     last_epoch = 0
+    start_position = 0
+
+    delta_state = None
+    if delta_checkpoints:
+        if delta_base is not None:
+            load_checkpoint_weights(model, torch.load(delta_base, map_location=device), device)
+        delta_state = DeltaState(model, delta_base)
 
+    # a finished run trains no further epochs and reports this checkpoint
+    checkpoint = None
     if os.path.isfile(checkpoint_path):
         checkpoint = torch.load(checkpoint_path, map_location=device)
         last_epoch = checkpoint['epoch']
-        model.load_state_dict(checkpoint['weights'])
+        load_checkpoint_weights(model, checkpoint, device)
         optimizer.load_state_dict(checkpoint['optimizer_weights'])
+        current_beta = checkpoint.get('beta', current_beta)
 
     last_epoch += 1
 
-    logger.info('Training model {} from epoch {}'.format(checkpoint_path, last_epoch))
+    training_model = wrap_model(model)
+
+    writer = CheckpointWriter()
+    sampler = create_train_sampler(train_loader.dataset, seed, checkpoint_every_steps, importance_sampling,
+        importance_uniform_fraction, importance_epoch_fraction)
+    if sampler is not None:
+        train_loader = with_sampler(train_loader, sampler)
+    importance_sampler = sampler if importance_sampling else None
+
+    step_checkpointer = None
+    if checkpoint_every_steps:
+        resume_path = resume_checkpoint_path(model_directory, model_name)
+        step_checkpointer = StepCheckpointer(writer, resume_path, checkpoint_every_steps, sampler, train_loader.batch_size,
+            lambda epoch, position: create_resume_checkpoint(epoch, position, sampler, model, optimizer,
+                delta_state=delta_state, beta=current_beta))
+        if os.path.isfile(resume_path):
+            resume = torch.load(resume_path, map_location=device)
+            if resume['epoch'] >= last_epoch:
+                load_checkpoint_weights(model, resume, device)
+                optimizer.load_state_dict(resume['optimizer_weights'])
+                sampler.load_state_dict(resume['sampler'])
+                set_rng_state(resume['rng'])
+                current_beta = resume['beta']
+                last_epoch, start_position = resume['epoch'], resume['position']
+
+    logger.info('Training model {} from epoch {} datapoint {}'.format(checkpoint_path, last_epoch, start_position))
     logger.info('Epochs {}'.format(number_of_epochs))
     logger.info('Batch Size {}'.format(train_loader.batch_size))
     logger.info('Number of Workers {}'.format(train_loader.num_workers))
     logger.info('Optimizer {}'.format(optimizer))
     logger.info('Learning Rate {}'.format(learning_rate))
     logger.info('Device {}'.format(device))
+    logger.info('Checkpoint Every Steps {}'.format(checkpoint_every_steps))
+    logger.info('Delta Checkpoints {} Base {}'.format(delta_checkpoints, delta_base))
+    logger.info('Processes {} Rank {}'.format(get_world_size(), get_rank()))
+    log_importance_sampling(logger, importance_sampler)
+
+    train_loader = distributed_loader(train_loader, shuffle=True, seed=seed)
+    val_loader = distributed_loader(val_loader, shuffle=False)
 
     image_directory = pathJoin(image_directory, model_name)
     os.makedirs(image_directory, exist_ok=True)
@@ -473,33 +968,78 @@ def run_autoencoder(model_name, model, model_directory, number_of_epochs,
     criterion = torch.nn.CrossEntropyLoss()
     distribution = 'bernoulli' if 'highpass' in model_name else 'gaussian'
 
-    anneal_start = 30
-    anneal_width = number_of_epochs - anneal_start
-
-    max_beta = beta
-    min_beta = 0.0
+    def end_epoch(epoch, train_scores, validation_scores, beta, weights=None, optimizer_state=None):
+        train_top1_accuracy, train_top5_accuracy, train_loss = train_scores
+        validation_top1_accuracy, validation_top5_accuracy, validation_loss = validation_scores
+        logger.info('Epoch {}: Train: Loss: {:.4f} Top1 Accuracy: {:.4f} Top5 Accuracy: {:.4f}'.format(
+            epoch, train_loss, train_top1_accuracy, train_top5_accuracy) \
+            + ' Validation: Loss: {:.4f} Top1 Accuracy: {:.4f} Top5 Accuracy: {:.4f}'.format(
+                validation_loss, validation_top1_accuracy, validation_top5_accuracy))
 
-    current_beta = min_beta
+        logger.debug('Saving new weights')
+        os.makedirs(model_directory, exist_ok=True)
+        checkpoint = {
+            'epoch': epoch,
+            'train_top1_accuracy': train_top1_accuracy,
+            'train_top5_accuracy': train_top5_accuracy,
+            'train_loss': train_loss,
+            'validation_top1_accuracy': validation_top1_accuracy,
+            'validation_top5_accuracy': validation_top5_accuracy,
+            'validation_loss': validation_loss,
+            'optimizer_weights': optimizer_state if optimizer_state is not None else optimizer.state_dict(),
+            'beta': beta
+        }
+        checkpoint.update(weights if weights is not None else checkpoint_weights(model, delta_state))
+        writer.save(checkpoint, checkpoint_path, {'model': model_name, 'config': run_config})
+        return checkpoint
+
+    def end_lagged_epoch(lagged):
+        if lagged is None:
+            return None
+        _, validation_scores = validator.collect()
+        return end_epoch(*lagged[:2], validation_scores, *lagged[2:])
+
+    # reconstruction grids and manifold plots are drawn by the validation process too
+    validator = None
+    if async_validation:
+        validator = create_async_validator(model, val_loader, validate_autoencoder, device, logger)
+    lagged = None
 
     for epoch in range(last_epoch, number_of_epochs + 1):
-        train_top1_accuracy, train_top5_accuracy, train_loss = train_autoencoder(
-            model, train_loader, optimizer, logger, device, current_beta, gamma, criterion, distribution)
+        set_loader_epoch(train_loader, epoch)
+        if step_checkpointer is not None:
+            step_checkpointer.start_epoch(epoch, start_position if epoch == last_epoch else 0)
+        elif sampler is not None:
+            sampler.set_epoch(epoch)
+        train_scores = train_autoencoder(
+            training_model, train_loader, optimizer, logger, device, current_beta, gamma, criterion, distribution,
+            step_callback=step_checkpointer, importance_sampler=importance_sampler)
+        if importance_sampler is not None:
+            importance_sampler.end_epoch()
 
         reconstruction_grid_filename = pathJoin(image_directory, 'reconstructed_epoch_{}.png'.format(epoch))
         manifold_filename = pathJoin(image_directory, 'manifold_epoch_{}.png'.format(epoch))
 
-        validation_top1_accuracy, validation_top5_accuracy, validation_loss = validate_autoencoder(
-            model, val_loader, logger, device, reconstruction_grid_filename, manifold_filename, current_beta, gamma, criterion, ((epoch % 10) == 0), distribution)
+        validation_arguments = dict(reconstruction_grid_filename=reconstruction_grid_filename,
+            manifold_filename=manifold_filename, beta=current_beta, gamma=gamma, criterion=criterion,
+            save_reconstruction=((epoch % 10) == 0) and is_main_process(), distribution=distribution)
+        if validator is None:
+            validation_scores = validate_autoencoder(training_model, val_loader, logger=logger, device=device,
+                **validation_arguments)
+        else:
+            checkpoint = end_lagged_epoch(lagged) or checkpoint
+            validator.submit(epoch, model, **validation_arguments)
 
         if epoch > anneal_start:
             current_beta += (max_beta - current_beta) / (anneal_width * 0.3)
 
-        logger.info('Epoch {}: Train: Loss: {:.4f} Top1 Accuracy: {:.4f} Top5 Accuracy: {:.4f}'.format(
-            epoch, train_loss, train_top1_accuracy, train_top5_accuracy) \
-            + ' Validation: Loss: {:.4f} Top1 Accuracy: {:.4f} Top5 Accuracy: {:.4f}'.format(
-                validation_loss, validation_top1_accuracy, validation_top5_accuracy))
+        if validator is None:
+            checkpoint = end_epoch(epoch, train_scores, validation_scores, current_beta)
+        else:
+            lagged = epoch, train_scores, current_beta, lagged_weights(model, delta_state, validator.snapshot_model), \
+                snapshot(optimizer.state_dict())
 
-        if epoch % 10 == 0:
+        if epoch % 10 == 0 and is_main_process():
             with torch.no_grad():
                 z = torch.randn(64, model.z_dim).to(device)
                 sample = model._decode(z).cpu()
@@ -508,24 +1048,18 @@ def run_autoencoder(model_name, model, model_directory, number_of_epochs,
 
             # explore_betavae(model_name, model, image_directory, epoch, val_loader, device)
 
-        logger.debug('Saving new weights')
-        os.makedirs(model_directory, exist_ok=True)
-        checkpoint = {
-            'epoch': epoch,
-            'train_top1_accuracy': train_top1_accuracy,
-            'train_top5_accuracy': train_top5_accuracy,
-            'train_loss': train_loss,
-            'validation_top1_accuracy': validation_top1_accuracy,
-            'validation_top5_accuracy': validation_top5_accuracy,
-            'validation_loss': validation_loss,
-            'weights': model.state_dict(),
-            'optimizer_weights': optimizer.state_dict()
-        }
-        torch.save(checkpoint, pathJoin(model_directory, '{}.ckpt'.format(model_name)))
+        if step_checkpointer is not None:
+            step_checkpointer.save(epoch + 1, 0)
+
+    if validator is not None:
+        checkpoint = end_lagged_epoch(lagged) or checkpoint
+        validator.close()
+
+    writer.close()
 
     logger.info('Epoch {}'.format(checkpoint['epoch']))
 
-    evaluate_model(model_name, model, load_data, dataset_names, logger.info, False, device, vae_transforms)
+    evaluate_model(model_name, model, load_data, dataset_names, logger.info, device, vae_transforms)
     logger.info('Train: Loss: {:.4f} Top1 Accuracy: {:.4f} Top5 Accuracy: {:.4f}'.format(
         checkpoint['train_loss'], checkpoint['train_top1_accuracy'], checkpoint['train_top5_accuracy']))
     logger.info('Validation: Loss: {:.4f} Top1 Accuracy: {:.4f} Top5 Accuracy: {:.4f}'.format(
@@ -534,53 +1068,104 @@ def run_autoencoder(model_name, model, model_directory, number_of_epochs,
     logger.info('Validation: Loss: {:.4f}'.format(checkpoint['validation_loss']))
 
 
-# In[5]: Non-Training
+# In[6]: Non-Training
 
-def sanity(model_list, loader, pair_loader, device):
+def shape_check_mode():
+    # fake tensors need torch 2.1, older versions check on a real batch without autograd
+    try:
+        from torch._subclasses.fake_tensor import FakeTensorMode
+    except ImportError:
+        return torch.no_grad()
+    return FakeTensorMode(allow_non_fake_inputs=True)
+
+
+def sanity_forward(model, input):
+    # fake tensors only carry shapes, compiled models run eagerly on them
+    forward = torch.compiler.disable(model) if hasattr(torch, 'compiler') else model
+    taps = model_taps(model)
+    if taps is None:
+        return forward(input), None
+    with taps.collect() as tapped:
+        output = forward(input)
+    return output, taps.stacked(tapped)
+
+
+def sanity(model_list, image_size, vae_image_size, batch_size=2, number_of_classes=200):
+    """Builds every model and checks the shapes of a train-mode forward on fake tensors.
+
+    The forward propagates shapes through the features, normalization layers
+    and classifier without loading data or computing activations. Without
+    fake tensor support it runs on a random batch instead.
+    """
     for model_name in model_list:
         print(model_name)
         model = model_list[model_name]()
         model.train()
-        dataloader = pair_loader if 'vae' in model_name else loader
-        for batch in dataloader:
-            index_image = dataloader.dataset.INDEX_IMAGE
-            model(batch[index_image].to(device))
-            break
-        del model
+        size = vae_image_size if 'vae' in model_name or 'classifier_z' in model_name else image_size
+        with shape_check_mode():
+            input = torch.rand(batch_size, 3, *size)
+            output, similarity = sanity_forward(model, input)
+
+        # autoencoders return the reconstruction after the logits
+        logits = output[0] if isinstance(output, tuple) else output
+        assert tuple(logits.shape) == (batch_size, number_of_classes), \
+            '{}: logits of shape {}, expected {}'.format(model_name, tuple(logits.shape), (batch_size, number_of_classes))
+        if isinstance(output, tuple):
+            assert output[1].shape == input.shape, \
+                '{}: reconstruction of shape {}, expected {}'.format(model_name, tuple(output[1].shape), tuple(input.shape))
+        if similarity is not None:
+            expected_shape = (batch_size, len(model_taps(model).layer_names))
+            assert tuple(similarity.shape) == expected_shape, \
+                '{}: similarity scores of shape {}, expected {}'.format(model_name, tuple(similarity.shape), expected_shape)
+        del model, output, similarity
         torch.cuda.empty_cache()
 
 
 def perf(model_list, model_directory, dataset_names, device, load_data=None, load_bilateral_data=None, only_exists=None, vae_transforms=None):
+    # metrics come from the checkpoint index, weights are only loaded to evaluate
+    index = read_index(model_directory)
     for model_name in model_list:
         print(model_name)
-        model = model_list[model_name]()
 
         checkpoint_path = pathJoin(model_directory, '{}.ckpt'.format(model_name))
         print(checkpoint_path)
-        
-        if os.path.isfile(checkpoint_path):
-            checkpoint = torch.load(checkpoint_path, map_location=device)
 
-            epoch = checkpoint['epoch']
-            train_loss = checkpoint['train_loss']
-            validation_loss = checkpoint['validation_loss']
-            train_top1_accuracy = checkpoint['train_top1_accuracy'] if 'train_top1_accuracy' in checkpoint else 0.0
-            train_top5_accuracy = checkpoint['train_top5_accuracy'] if 'train_top5_accuracy' in checkpoint else 0.0
-            validation_top1_accuracy = checkpoint['validation_top1_accuracy'] if 'validation_top1_accuracy' in checkpoint else 0.0
-            validation_top5_accuracy = checkpoint['validation_top5_accuracy'] if 'validation_top5_accuracy' in checkpoint else 0.0
-            model.load_state_dict(checkpoint['weights'])
-
-            print('Epoch: {} Validation: Loss: {:.4f} Top1 Accuracy: {:.4f} Top5 Accuracy: {:.4f}'.format(
-                epoch, validation_loss, validation_top1_accuracy, validation_top5_accuracy) \
-                + ' Train: Loss: {:.4f} Top1 Accuracy: {:.4f} Top5 Accuracy: {:.4f}'.format(
-                    train_loss, train_top1_accuracy, train_top5_accuracy))
-
-            if not only_exists:
-                eval_transforms = vae_transforms if 'vae' in model_name else None
-                evaluate_model(model_name, model, load_data, dataset_names, print, 'similarity' in model_name, device, eval_transforms)
-                evaluate_model(model_name + '_eval_on_bilateral_images', model, load_bilateral_data, dataset_names, print, 'similarity' in model_name, device, eval_transforms)
-        else:
+        if not os.path.isfile(checkpoint_path):
             print('Checkpoint not available for model {}'.format(model_name))
-        del model
-        torch.cuda.empty_cache()
+            continue
+
+        checkpoint = None
+        metadata = index.get(model_name)
+        if not is_current(metadata, checkpoint_path):
+            # written before sidecars existed or by another writer
+            checkpoint = torch.load(checkpoint_path, map_location=device)
+            metadata = checkpoint_metadata(model_name, checkpoint_path, checkpoint,
+                metadata['config'] if metadata is not None else None)
+            if is_main_process():
+                record_checkpoint(checkpoint_path, metadata)
+
+        metrics = metadata['metrics']
+        epoch = metrics['epoch']
+        train_loss = metrics['train_loss']
+        validation_loss = metrics['validation_loss']
+        train_top1_accuracy = metrics.get('train_top1_accuracy', 0.0)
+        train_top5_accuracy = metrics.get('train_top5_accuracy', 0.0)
+        validation_top1_accuracy = metrics.get('validation_top1_accuracy', 0.0)
+        validation_top5_accuracy = metrics.get('validation_top5_accuracy', 0.0)
+
+        print('Epoch: {} Validation: Loss: {:.4f} Top1 Accuracy: {:.4f} Top5 Accuracy: {:.4f}'.format(
+            epoch, validation_loss, validation_top1_accuracy, validation_top5_accuracy) \
+            + ' Train: Loss: {:.4f} Top1 Accuracy: {:.4f} Top5 Accuracy: {:.4f}'.format(
+                train_loss, train_top1_accuracy, train_top5_accuracy))
+
+        if not only_exists:
+            model = model_list[model_name]()
+            if checkpoint is None:
+                checkpoint = torch.load(checkpoint_path, map_location=device)
+            load_checkpoint_weights(model, checkpoint, device)
+            eval_transforms = vae_transforms if 'vae' in model_name else None
+            evaluate_model(model_name, model, load_data, dataset_names, print, device, eval_transforms)
+            evaluate_model(model_name + '_eval_on_bilateral_images', model, load_bilateral_data, dataset_names, print, device, eval_transforms)
+            del model
+            torch.cuda.empty_cache()
 
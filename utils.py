@@ -1,10 +1,16 @@
 import math
 import os
 import argparse
+import contextlib
 import subprocess
 import torch
+from torch.utils.checkpoint import checkpoint
+from torch.nn.modules.batchnorm import _NormBase
 import torchvision.transforms as transforms
 from torchvision.utils import save_image
+from parallel import init_distributed
+from resolution import ResolutionSchedule
+from taps import checkpoint_contexts
 
 def check_requirements(requirements):
     for requirement in requirements:
@@ -39,14 +45,197 @@ def init_weights(m):
             torch.nn.init.zeros_(m.bias)
 
 
+def is_frozen(module):
+    return all(not parameter.requires_grad for parameter in module.parameters())
+
+
+def run_frozen(module, x):
+    # a frozen prefix does not need its activations kept for backward
+    if not torch.is_grad_enabled():
+        return module(x)
+    if hasattr(torch, 'inference_mode'):
+        with torch.inference_mode():
+            x = module(x)
+        # inference tensors cannot be saved for backward by later layers
+        return x.clone()
+    with torch.no_grad():
+        return module(x)
+
+
+def needs_backward(module, x):
+    return x.requires_grad or any(parameter.requires_grad for parameter in module.parameters())
+
+
+class CheckpointedSequential(torch.nn.Sequential):
+    """Sequential that recomputes its activations during backward instead of keeping them.
+
+    It runs as checkpoint_segments blocks and only keeps the block inputs.
+    Existing Sequentials are converted in place, so parameter names and
+    checkpoints stay the same.
+    """
+    checkpoint_segments = 1
+
+    def forward(self, x):
+        if self.checkpoint_segments > 1 and torch.is_grad_enabled() and needs_backward(self, x):
+            return self.checkpointed_forward(x, min(self.checkpoint_segments, len(self)))
+        return super(CheckpointedSequential, self).forward(x)
+
+    def checkpointed_forward(self, x, segments):
+        # the blocks of checkpoint_sequential, with tap statistics recomputed along with them
+        layers = list(self)
+        segment_size = len(layers) // segments
+        end = 0
+        for start in range(0, segment_size * (segments - 1), segment_size):
+            end = start + segment_size
+            x = checkpoint(run_layers(layers[start:end]), x, use_reentrant=False, context_fn=block_contexts(layers[start:end]))
+        return run_layers(layers[end:])(x)
+
+
+def run_layers(layers):
+    def run(x):
+        for layer in layers:
+            x = layer(x)
+        return x
+    return run
+
+
+@contextlib.contextmanager
+def preserved_running_statistics(layers):
+    # a block recomputed in training mode would update the running statistics of its
+    # normalization layers a second time, they are put back as the forward left them
+    buffers = [ (buffer, buffer.clone()) for layer in layers for module in layer.modules()
+        if isinstance(module, _NormBase) and module.track_running_stats
+        for buffer in [module.running_mean, module.running_var, module.num_batches_tracked] if buffer is not None ]
+    try:
+        yield
+    finally:
+        with torch.no_grad():
+            for buffer, saved in buffers:
+                buffer.copy_(saved)
+
+
+@contextlib.contextmanager
+def recomputing(layers, taps_context):
+    with taps_context, preserved_running_statistics(layers):
+        yield
+
+
+def block_contexts(layers):
+    """context_fn of torch.utils.checkpoint for a block of layers.
+
+    The recomputation replays the tap statistics of the forward and leaves
+    the running statistics of normalization layers untouched.
+    """
+    def contexts():
+        forward_context, taps_context = checkpoint_contexts()
+        return forward_context, recomputing(layers, taps_context)
+    return contexts
+
+
+def set_activation_checkpointing(model, segments):
+    for name in ['features', 'features1', 'features2']:
+        features = getattr(model, name, None)
+        if isinstance(features, torch.nn.Sequential):
+            features.__class__ = CheckpointedSequential
+            features.checkpoint_segments = segments
+    return model
+
+
+def to_channels_last(module, args):
+    return tuple(arg.contiguous(memory_format=torch.channels_last) if torch.is_tensor(arg) and arg.dim() == 4 else arg
+        for arg in args)
+
+
+def set_execution_mode(model, memory_format='contiguous', compile=False, checkpoint_segments=0):
+    if checkpoint_segments:
+        model = set_activation_checkpointing(model, checkpoint_segments)
+    if memory_format == 'channels_last':
+        model = model.to(memory_format=torch.channels_last)
+        # inputs follow the weights so convolutions do not convert back and forth
+        model.register_forward_pre_hook(to_channels_last)
+    if compile:
+        if not hasattr(model, 'compile'):
+            raise ValueError('Compiling models needs torch 2.2 or newer')
+        # compiles in place, the checkpoint keys stay those of the model
+        model.compile()
+    return model
+
+
+def with_execution_mode(create_model, memory_format='contiguous', compile=False, checkpoint_segments=0):
+    def create_model_in_execution_mode():
+        return set_execution_mode(create_model(), memory_format, compile, checkpoint_segments)
+    return create_model_in_execution_mode
+
+
 def cuda(tensor, uses_cuda):
     return tensor.cuda() if uses_cuda else tensor
 
 
-def convert_input(transforms):    
-    def converter(x):
-        return torch.stack([ transforms(_) for _ in x.cpu() ], dim=0).cuda()
-    return converter
+# PIL filters by their torchvision names and codes, as F.interpolate modes
+INTERPOLATION_MODES = { 'nearest': 'nearest', 'bilinear': 'bilinear', 'bicubic': 'bicubic', 0: 'nearest', 2: 'bilinear', 3: 'bicubic' }
+
+
+def resized_shape(height, width, size):
+    # an int resizes the smaller edge and keeps the aspect ratio, like transforms.Resize
+    if not isinstance(size, int):
+        return tuple(size) if len(size) == 2 else (size[0], size[0])
+    if height <= width:
+        return size, int(size * width / height)
+    return int(size * height / width), size
+
+
+class BatchedInputConverter(object):
+    """DeNormalize -> ToPILImage -> Resize -> ToTensor on whole batches, on their device.
+
+    The 8-bit rounding of the PIL round trip is kept, so the autoencoder
+    gets the images it was trained on up to the resampling of the resize.
+    """
+
+    def __init__(self, mean, std, size, interpolation='bilinear'):
+        self.mean = list(mean)
+        self.std = list(std)
+        self.size = size
+        self.mode = interpolation
+
+    @classmethod
+    def from_transforms(cls, pipeline):
+        """The converter of a Compose of exactly those four steps, or None."""
+        steps = getattr(pipeline, 'transforms', None)
+        if steps is None or len(steps) != 4:
+            return None
+        denormalize, to_image, resize, to_tensor = steps
+        if not (hasattr(denormalize, 'mean') and hasattr(denormalize, 'std')
+                and not isinstance(denormalize, transforms.Normalize)
+                and isinstance(to_image, transforms.ToPILImage) and isinstance(resize, transforms.Resize)
+                and isinstance(to_tensor, transforms.ToTensor)):
+            return None
+        interpolation = getattr(resize.interpolation, 'value', resize.interpolation)
+        if interpolation not in INTERPOLATION_MODES:
+            return None
+        return cls(denormalize.mean, denormalize.std, resize.size, INTERPOLATION_MODES[interpolation])
+
+    def __call__(self, x):
+        mean = torch.tensor(self.mean, dtype=x.dtype, device=x.device).view(1, -1, 1, 1)
+        std = torch.tensor(self.std, dtype=x.dtype, device=x.device).view(1, -1, 1, 1)
+        # ToPILImage truncates to 8 bits
+        x = torch.addcmul(mean, x, std).mul(255).clamp(0, 255).floor()
+        size = resized_shape(x.size(2), x.size(3), self.size)
+        if self.mode == 'nearest':
+            x = torch.nn.functional.interpolate(x, size=size, mode='nearest-exact')
+        else:
+            x = torch.nn.functional.interpolate(x, size=size, mode=self.mode, align_corners=False, antialias=True)
+        return x.round().clamp(0, 255).div(255)
+
+
+def convert_input(transforms):
+    converter = BatchedInputConverter.from_transforms(transforms)
+    if converter is not None:
+        return converter
+
+    # other transforms still run image by image
+    def image_converter(x):
+        return torch.stack([ transforms(_) for _ in x.cpu() ], dim=0).to(x.device)
+    return image_converter
 
 
 def grid2gif(image_str, output_gif, delay=100):
@@ -122,11 +311,44 @@ toPILImage = transforms.ToPILImage()
 softmax = torch.nn.Softmax(dim=1)
 
 
+DEFAULT_ROOT_PATH = pathJoin(os.sep, 'var', 'node433', 'local', 'gulfaraz')
+
+
+def vae_model_suffix(zdim, beta, gamma):
+    return '{}_beta{}_gamma{}'.format(zdim, float(beta), float(gamma))
+
+
+def vae_checkpoint_name(zdim, beta, gamma, dataset, bilateral=False):
+    vae_model_name = 'vae{}'.format(vae_model_suffix(zdim, beta, gamma))
+    vae_model_name = 'bilateral_{}'.format(vae_model_name) if bilateral else vae_model_name
+    return '{}_{}'.format(dataset, vae_model_name)
+
+
+def trained_model_name(model_name, dataset, bilateral=False):
+    # name a supported model is trained under, None if it is not trained on this dataset
+    if dataset != 'nonstylized' and \
+        not (
+            model_name == 'vgg19_vanilla_tune_fc' or \
+            'vae' in model_name or \
+            'classifier' in model_name or \
+            'latent' in model_name
+        ):
+        return None
+    if bilateral:
+        if 'similarity' in model_name or \
+            'vae' in model_name or \
+            'classifier' in model_name or \
+            'latent' in model_name:
+            return None
+        model_name = 'bilateral_{}'.format(model_name)
+    return '{}_{}'.format(dataset, model_name)
+
+
 def configuration():
     parser = argparse.ArgumentParser(formatter_class=argparse.ArgumentDefaultsHelpFormatter)
 
     # General arguments
-    parser.add_argument('--rootPath', type=str, default=pathJoin(os.sep, 'var', 'node433', 'local', 'gulfaraz'),
+    parser.add_argument('--rootPath', type=str, default=DEFAULT_ROOT_PATH,
                         help='output path')
     parser.add_argument('--numberOfWorkers', type=int, default=8,
                         help='number of threads used by data loader')
@@ -170,12 +392,77 @@ def configuration():
     parser.add_argument('--exists', action='store_true', default=False,
                         help='check if the trained models exist')
 
+    parser.add_argument('--featureCache', action='store_true', default=False,
+                        help='train classifier-only models on cached backbone features')
+    parser.add_argument('--featureCacheViews', type=int, default=4,
+                        help='number of augmented views stored per image in the feature cache')
+    parser.add_argument('--latentCache', action='store_true', default=False,
+                        help='read frozen autoencoder latents from a per-image store instead of re-encoding')
+    parser.add_argument('--prefixCache', action='store_true', default=False,
+                        help='cache frozen prefix activations of evaluation images on disk')
+    parser.add_argument('--checkpointEverySteps', type=int, default=None,
+                        help='also write a resumable checkpoint every n optimizer steps')
+    parser.add_argument('--deltaCheckpoints', action='store_true', default=False,
+                        help='store only the weights that changed from the base model in checkpoints')
+    parser.add_argument('--deltaBase', type=str, default=None,
+                        help='checkpoint delta checkpoints are taken against (default: the freshly built model)')
+    parser.add_argument('--sharedStream', action='store_true', default=False,
+                        help='train the selected classifiers together, reading every batch once')
+    parser.add_argument('--memoryFormat', type=str, default='contiguous', choices=['contiguous', 'channels_last'],
+                        help='memory format of the model weights and inputs')
+    parser.add_argument('--compile', action='store_true', default=False,
+                        help='compile the models with torch.compile')
+    parser.add_argument('--activationCheckpointSegments', type=int, default=0,
+                        help='recompute the convolutional activations in backward, in this many blocks (0: off)')
+    parser.add_argument('--similarityMode', type=str, default='exact', choices=['reference', 'exact', 'sketch'],
+                        help='how similarity models compute their channel similarity scores')
+    parser.add_argument('--similaritySketchSize', type=int, default=1024,
+                        help='positions sampled per layer by --similarityMode sketch, larger layers only')
+    parser.add_argument('--distributed', action='store_true', default=False,
+                        help='data-parallel training on cpu across the processes started by torchrun (gloo)')
+    parser.add_argument('--resolutionSchedule', type=ResolutionSchedule, default=None,
+                        help='train at lower resolutions first, e.g. 128:10,160:20,224 (size:last epoch, final size last);'
+                            ' the batch size grows to keep memory constant and validation stays at --inputSize')
+    parser.add_argument('--asyncValidation', action='store_true', default=False,
+                        help='validate each epoch in a separate process while the next one trains (scores lag one epoch)')
+    parser.add_argument('--fastValidation', type=int, default=None,
+                        help='validate on a fixed subset of this many images per class, the full set on the last epoch'
+                            ' and before a new best checkpoint')
+    parser.add_argument('--distillStudent', type=str, default=None,
+                        choices=['vgg11_tune_all', 'vgg11_in_single_tune_all'],
+                        help='with --train, distill the trained selected models into this student instead of training them')
+    parser.add_argument('--distillTemperature', type=float, default=4.0,
+                        help='softmax temperature of the distillation loss')
+    parser.add_argument('--distillAlpha', type=float, default=0.9,
+                        help='weight of the distillation loss, the cross entropy to the labels gets the rest')
+    parser.add_argument('--importanceSampling', action='store_true', default=False,
+                        help='draw training images in proportion to their recent loss, weighting the loss back to uniform')
+    parser.add_argument('--importanceUniformFraction', type=float, default=0.2,
+                        help='share of the sampling distribution kept uniform, bounds the importance weights')
+    parser.add_argument('--importanceEpochFraction', type=float, default=1.0,
+                        help='images drawn per epoch with importance sampling, as a fraction of the training set')
+
     parser.add_argument('--model', action='append', type=str,
                         default=None,
                         help='name of model(s)')
 
     args = parser.parse_args()
 
+    if args.sharedStream and args.checkpointEverySteps:
+        parser.error('--sharedStream does not support --checkpointEverySteps')
+    if args.resolutionSchedule is not None and args.resolutionSchedule.final_size != args.inputSize:
+        parser.error('--resolutionSchedule must end at --inputSize {}'.format(args.inputSize))
+    if args.sharedStream and args.importanceSampling:
+        parser.error('--sharedStream does not support --importanceSampling')
+    if args.importanceSampling and not 0 < args.importanceUniformFraction <= 1:
+        parser.error('--importanceUniformFraction must be in (0, 1]')
+    if args.asyncValidation and (args.distributed or args.sharedStream):
+        parser.error('--asyncValidation does not support --distributed or --sharedStream')
+    if args.fastValidation is not None and (args.asyncValidation or args.sharedStream):
+        parser.error('--fastValidation does not support --asyncValidation or --sharedStream')
+    if args.distributed and (args.featureCache or args.latentCache or args.prefixCache):
+        parser.error('--distributed does not support the on-disk caches')
+
     arg_vars = vars(args)
 
     if args.torchSeed is not None:
@@ -183,7 +470,10 @@ def configuration():
     else:
         arg_vars['torchSeed'] = torch.initial_seed()
 
-    if torch.cuda.is_available() and not arg_vars['disableCuda']:
+    if arg_vars['distributed']:
+        init_distributed('gloo')
+        arg_vars['device'] = torch.device('cpu')
+    elif torch.cuda.is_available() and not arg_vars['disableCuda']:
         torch.backends.cudnn.benchmark = True
         torch.set_default_tensor_type('torch.cuda.FloatTensor')
         arg_vars['device'] = torch.device(
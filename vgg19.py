@@ -2,9 +2,12 @@ import torch
 import torchvision
 import torchvision.models as models
 from instancenormbatchswap import InstanceNormBatchSwap, InstanceNormSimilarity
-from utils import init_weights, pathJoin, convert_input
+from utils import init_weights, pathJoin, convert_input, is_frozen, run_frozen, vae_model_suffix
 import os
-from betavae import BetaVAE_H
+from betavae import BetaVAE_H, create_betavae, create_betavae_classifier
+from checkpoint import load_checkpoint_weights
+from taps import FeatureTaps, SimilarityStatistic
+from weightpool import create_architecture, pretrained_state_dict, submodule_state_dict
 
 
 def create_imagenet200_classifier(in_feature_size=25088):
@@ -20,9 +23,10 @@ def create_imagenet200_classifier(in_feature_size=25088):
 
 
 class VGG_IN(torch.nn.Module):
-    def __init__(self, layer_index, instance_normalization_function=None, affine=False, pretrained=False, filename=None):
+    def __init__(self, layer_index, instance_normalization_function=None, affine=False, pretrained=False, filename=None,
+            architecture=models.vgg19):
         super(VGG_IN, self).__init__()
-        vgg19 = models.vgg19(pretrained=pretrained)
+        vgg19 = create_architecture(architecture, pretrained)
         self.features1 = vgg19.features[:layer_index]
         if instance_normalization_function is not None:
             if filename:
@@ -32,65 +36,46 @@ class VGG_IN(torch.nn.Module):
                 self.instance_normalization = instance_normalization_function(
                     vgg19.features[layer_index].out_channels, affine=affine)
         self.features2 = vgg19.features[layer_index:]
+        # the classifier takes 7x7 maps whatever the input resolution
+        self.avgpool = vgg19.avgpool
         self.classifier = create_imagenet200_classifier()
 
-    def forward(self, x):
-        x = self.features1(x)
+    def forward(self, x, prefix=None):
+        x = self.forward_prefix(x, prefix)
         if hasattr(self, 'instance_normalization'):
             x = self.instance_normalization(x)
         x = self.features2(x)
-        x = x.view(x.size(0), -1)
+        x = self.avgpool(x)
+        x = torch.flatten(x, 1)
         x = self.classifier(x)
         return x
 
+    def forward_prefix(self, x, prefix=None):
+        if prefix is not None:
+            return prefix.to(x.dtype)
+        if is_frozen(self.features1):
+            return run_frozen(self.features1, x)
+        return self.features1(x)
+
 
 class VGG_COSINE_SIMILARITY(torch.nn.Module):
+    """VGG19 whose features are tapped for the similarity scores of layer_indices.
+
+    The features run as plain Sequentials, the scores are only computed
+    for forwards inside taps.collect(), see FeatureTaps.
+    """
+
     def __init__(self, layer_indices=[1, 6, 11, 20, 29], pretrained=False, eps=torch.tensor(1e-08)):
         super(VGG_COSINE_SIMILARITY, self).__init__()
-        self.vgg19 = models.vgg19(pretrained=pretrained)
+        self.vgg19 = create_architecture(models.vgg19, pretrained)
+        self.avgpool = self.vgg19.avgpool
         self.classifier = create_imagenet200_classifier()
         self.layer_indices = layer_indices
         self.eps = eps
 
-    def calculate_similarity_score(self, x):
-        # torch.set_printoptions(profile="full")
-        flat_x = x.view(x.size(0), x.size(1), -1)
-        similarity_matrix = self.calculate_cosine_similarity_matrix(flat_x)
-        similarity_matrix = similarity_matrix ** 2
-        # print('similarity_matrix.shape')
-        # print(similarity_matrix.shape)
-        # print(similarity_matrix)
-        similarity_score = similarity_matrix.sum(dim=1).sum(dim=1) - similarity_matrix.size(1)
-        # print('similarity_score.shape')
-        # print(similarity_score.shape)
-        # print(similarity_score)
-        # torch.set_printoptions(profile="default")
-        # raise NotImplemented
-        return similarity_score
-
-    def calculate_cosine_similarity_matrix(self, x):
-        # print('x.shape')
-        # print(x.shape)
-        # https://pytorch.org/docs/stable/nn.html#cosine_similarity
-        x_t = x.transpose(1, 2)
-        # print('x_t.shape')
-        # print(x_t.shape)
-        x_norm = torch.norm(x, dim=2, keepdim=True)
-        # print('x_norm.shape')
-        # print(x_norm.shape)
-        x_t_norm = x_norm.transpose(1, 2)
-        # print('x_t_norm.shape')
-        # print(x_t_norm.shape)
-        num = torch.matmul(x, x_t)
-        # print('num.shape')
-        # print(num.shape)
-        norm_prod = torch.matmul(x_norm, x_t_norm)
-        # print('norm_prod.shape')
-        # print(norm_prod.shape)
-        den = torch.max(norm_prod, self.eps.to(norm_prod.device))
-        # print('den.shape')
-        # print(den.shape)
-        return num / den
+    def tap_features(self, features_name):
+        self.taps = FeatureTaps(self, [ '{}.{}'.format(features_name, index) for index in self.layer_indices ],
+            SimilarityStatistic(eps=self.eps))
 
 
 class VGG_IN_SINGLE_SIMILARITY(VGG_COSINE_SIMILARITY):
@@ -102,76 +87,55 @@ class VGG_IN_SINGLE_SIMILARITY(VGG_COSINE_SIMILARITY):
             self.instance_normalization = instance_normalization_function(
                 self.vgg19.features[layer_index].out_channels, affine=affine)
         self.features2 = self.vgg19.features[layer_index:]
+        # features1 and features2 share the layers of vgg19.features
+        self.tap_features('vgg19.features')
 
     def forward(self, x):
-        similarity_scores = []
-
-        current_layer = 0
-
-        # x = self.features1(x)
-        for layer_index, layer in enumerate(self.features1):
-            x = layer(x)
-            if (current_layer in self.layer_indices):
-                similarity_scores.append(self.calculate_similarity_score(x))
-            current_layer += 1
+        x = self.features1(x)
 
         if hasattr(self, 'instance_normalization'):
             x = self.instance_normalization(x)
 
-        # x = self.features2(x)
-        for layer_index, layer in enumerate(self.features2):
-            x = layer(x)
-            if (current_layer in self.layer_indices):
-                similarity_scores.append(self.calculate_similarity_score(x))
-            current_layer += 1
+        x = self.features2(x)
 
-        x = x.view(x.size(0), -1)
+        x = self.avgpool(x)
+        x = torch.flatten(x, 1)
         x = self.classifier(x)
 
-        layer_similarity = torch.stack(similarity_scores, dim=1)
-
-        return x, layer_similarity
+        return x
 
 
 class VGG_BN_SIMILARITY(VGG_COSINE_SIMILARITY):
     def __init__(self, pretrained=False, eps=torch.tensor(1e-08), layer_indices=[2, 9, 16, 29, 42]):
         super(VGG_BN_SIMILARITY, self).__init__(pretrained=pretrained, eps=eps, layer_indices=layer_indices)
-        self.vgg19_bn = models.vgg19_bn(pretrained=pretrained)
+        self.vgg19_bn = create_architecture(models.vgg19_bn, pretrained)
         self.features = self.vgg19_bn.features
+        self.tap_features('features')
 
     def forward(self, x):
-        similarity_scores = []
-
-        for layer_index, layer in enumerate(self.features):
-            x = layer(x)
-            if (layer_index in self.layer_indices):
-                similarity_scores.append(self.calculate_similarity_score(x))
+        x = self.features(x)
 
-        x = x.view(x.size(0), -1)
+        x = self.avgpool(x)
+        x = torch.flatten(x, 1)
         x = self.classifier(x)
 
-        layer_similarity = torch.stack(similarity_scores, dim=1)
-        return x, layer_similarity
+        return x
 
 
 class VGG_VANILLA_SIMILARITY(VGG_COSINE_SIMILARITY):
     def __init__(self, pretrained=False, eps=torch.tensor(1e-08), layer_indices=[1, 6, 11, 20, 29]):
         super(VGG_VANILLA_SIMILARITY, self).__init__(pretrained=pretrained, eps=eps, layer_indices=layer_indices)
         self.features = self.vgg19.features
+        self.tap_features('features')
 
     def forward(self, x):
-        similarity_scores = []
-
-        for layer_index, layer in enumerate(self.features):
-            x = layer(x)
-            if (layer_index in self.layer_indices):
-                similarity_scores.append(self.calculate_similarity_score(x))
+        x = self.features(x)
 
-        x = x.view(x.size(0), -1)
+        x = self.avgpool(x)
+        x = torch.flatten(x, 1)
         x = self.classifier(x)
 
-        layer_similarity = torch.stack(similarity_scores, dim=1)
-        return x, layer_similarity
+        return x
 
 
 # Vanilla Models
@@ -193,7 +157,7 @@ def create_vgg19_vanilla_scratch():
 
 def create_vgg19_vanilla_tune_fc():
     # load model from pytorch
-    vgg19 = models.vgg19(pretrained=True)
+    vgg19 = create_architecture(models.vgg19, pretrained=True)
 
     # freeze cnn layers
     for param in vgg19.parameters():
@@ -211,7 +175,7 @@ def create_vgg19_vanilla_tune_fc():
 # Batch Normalization Models
 
 def create_vgg19_bn_all_tune_fc():
-    vgg19 = torchvision.models.vgg19_bn(pretrained=True)
+    vgg19 = create_architecture(models.vgg19_bn, pretrained=True)
 
     # freeze cnn layers
     for param in vgg19.features.parameters():
@@ -227,7 +191,7 @@ def create_vgg19_bn_all_tune_fc():
 
 
 def create_vgg19_bn_all_tune_all():
-    vgg19 = torchvision.models.vgg19_bn(pretrained=True)
+    vgg19 = create_architecture(models.vgg19_bn, pretrained=True)
 
     # train cnn layers
     for param in vgg19.features.parameters():
@@ -284,7 +248,8 @@ def create_vgg19_in_affine_single_tune_all():
 
 def create_vgg19_in_all_tune_all_root(instance_normalization_function=torch.nn.InstanceNorm2d):
     vgg19_in = torchvision.models.vgg19_bn(pretrained=False)
-    vgg19 = torchvision.models.vgg19(pretrained=True)
+    # only the conv weights are read, no vgg19 is built for them
+    vgg19_weights = pretrained_state_dict(models.vgg19)
 
     transfer_layer_index = 0
     for layer_index, layer in enumerate(vgg19_in.features):
@@ -294,7 +259,8 @@ def create_vgg19_in_all_tune_all_root(instance_normalization_function=torch.nn.I
     
         # transfer conv weights
         if isinstance(layer, torch.nn.Conv2d):
-            vgg19_in.features[layer_index].load_state_dict(vgg19.features[transfer_layer_index].state_dict())
+            vgg19_in.features[layer_index].load_state_dict(
+                submodule_state_dict(vgg19_weights, 'features.{}'.format(transfer_layer_index)))
 
         if (isinstance(layer, torch.nn.ReLU) or
             isinstance(layer, torch.nn.MaxPool2d) or
@@ -352,7 +318,8 @@ def create_vgg19_in_sm_all_tune_all():
 
 def create_vgg19_bn_in_single_tune_all_root(instance_normalization_function=None):
     vgg19_in = torchvision.models.vgg19_bn(pretrained=False)
-    vgg19 = torchvision.models.vgg19(pretrained=True)
+    # only the conv weights are read, no vgg19 is built for them
+    vgg19_weights = pretrained_state_dict(models.vgg19)
     replace_layers = [28]
 
     transfer_layer_index = 0
@@ -365,7 +332,8 @@ def create_vgg19_bn_in_single_tune_all_root(instance_normalization_function=None
     
         # transfer conv weights
         if isinstance(layer, torch.nn.Conv2d):
-            vgg19_in.features[layer_index].load_state_dict(vgg19.features[transfer_layer_index].state_dict())
+            vgg19_in.features[layer_index].load_state_dict(
+                submodule_state_dict(vgg19_weights, 'features.{}'.format(transfer_layer_index)))
 
         if (isinstance(layer, torch.nn.ReLU) or
             isinstance(layer, torch.nn.MaxPool2d) or
@@ -456,13 +424,18 @@ class VGG_IN_VAE(torch.nn.Module):
         self.classifier = create_imagenet200_classifier(self.feature_dim + self.z_dim)
         self.convert_input = convert_input(vae_transforms)
 
-    def forward(self, x):
+    def forward(self, x, latents=None):
         with torch.no_grad():
             features = self.get_features(x)
-            latents = self.get_latents(self.convert_input(x))
+        if latents is None:
+            latents = self.encode_latents(x)
         combined = torch.cat([features, latents], dim=1)
         output = self.classifier(combined)
         return output
+
+    def encode_latents(self, x):
+        with torch.no_grad():
+            return self.get_latents(self.convert_input(x))
     
     def create_feature_extractor(self, classification_model):
         def feature_extractor(x):
@@ -471,7 +444,8 @@ class VGG_IN_VAE(torch.nn.Module):
                 if hasattr(classification_model, 'instance_normalization'):
                     features = classification_model.instance_normalization(features)
                 features = classification_model.features2(features)
-                features = features.view(features.size(0), -1)
+                features = classification_model.avgpool(features)
+                features = torch.flatten(features, 1)
             return features
         return feature_extractor
     
@@ -489,8 +463,8 @@ def create_feature_latent_classifier(classification_modelname, autoencoder_model
         # load trained classifier
         classification_model_checkpoint_path = pathJoin(model_directory, '{}.ckpt'.format(classification_modelname))
         if os.path.isfile(classification_model_checkpoint_path):
-            classification_model.load_state_dict(
-                torch.load(classification_model_checkpoint_path, map_location=device)['weights'])
+            load_checkpoint_weights(classification_model,
+                torch.load(classification_model_checkpoint_path, map_location=device), device)
             classification_model.eval()
         else:
             raise ValueError('Classification Model not found at: {}'.format(classification_model_checkpoint_path))
@@ -498,8 +472,8 @@ def create_feature_latent_classifier(classification_modelname, autoencoder_model
         autoencoder_model_checkpoint_path = pathJoin(model_directory, '{}.ckpt'.format(autoencoder_modelname))
         autoencoder_model = BetaVAE_H(z_dim=z_dim, nc=3)
         if os.path.isfile(autoencoder_model_checkpoint_path):
-            autoencoder_model.load_state_dict(
-                torch.load(autoencoder_model_checkpoint_path, map_location=device)['weights'])
+            load_checkpoint_weights(autoencoder_model,
+                torch.load(autoencoder_model_checkpoint_path, map_location=device), device)
             autoencoder_model.eval()
         else:
             raise ValueError('Autoencoder Model not found at: {}'.format(autoencoder_model_checkpoint_path))
@@ -519,15 +493,17 @@ class VGG_IN_LATENT(VGG_IN):
         self.get_latents = self.create_latent_extractor(autoencoder_model)
         self.classifier = create_imagenet200_classifier(self.feature_dim + self.z_dim)
         self.vae_transforms = vae_transforms
+        self.convert_input = convert_input(vae_transforms)
 
-    def forward(self, x):
-        x = self.features1(x)
+    def forward(self, x, latents=None, prefix=None):
+        if latents is None:
+            latents = self.encode_latents(x)
+        x = self.forward_prefix(x, prefix)
         if hasattr(self, 'instance_normalization'):
             x = self.instance_normalization(x)
         x = self.features2(x)
-        features = x.view(x.size(0), -1)
-        with torch.no_grad():
-            latents = self.get_latents(self.convert_input(x))
+        x = self.avgpool(x)
+        features = torch.flatten(x, 1)
         combined = torch.cat([features, latents], dim=1)
         output = self.classifier(combined)
         return output
@@ -540,8 +516,10 @@ class VGG_IN_LATENT(VGG_IN):
             return encoded_x
         return latent_extractor
     
-    def convert_input(self, x):
-        return torch.stack([ self.vae_transforms(_) for _ in x.cpu() ], dim=0).cuda()
+    def encode_latents(self, x):
+        # the autoencoder sees the input image, not the VGG feature map
+        with torch.no_grad():
+            return self.get_latents(self.convert_input(x))
 
 
 def create_vgg19_in_single_tune_all_with_latent(autoencoder_model_checkpoint_path, z_dim, device, vae_transforms):
@@ -549,8 +527,8 @@ def create_vgg19_in_single_tune_all_with_latent(autoencoder_model_checkpoint_pat
         # load trained vae
         autoencoder_model = BetaVAE_H(z_dim=z_dim, nc=3)
         if os.path.isfile(autoencoder_model_checkpoint_path):
-            autoencoder_model.load_state_dict(
-                torch.load(autoencoder_model_checkpoint_path, map_location=device)['weights'])
+            load_checkpoint_weights(autoencoder_model,
+                torch.load(autoencoder_model_checkpoint_path, map_location=device), device)
             autoencoder_model.eval()
         else:
             raise ValueError('Autoencoder Model not found at: {}'.format(autoencoder_model_checkpoint_path))
@@ -563,3 +541,80 @@ def create_vgg19_in_single_tune_all_with_latent(autoencoder_model_checkpoint_pat
 
         return vgg
     return assemble_model
+
+
+def set_similarity_mode(model, similarity_mode='exact', sketch_size=1024):
+    if isinstance(model, VGG_COSINE_SIMILARITY):
+        model.taps.statistic.mode = similarity_mode
+        model.taps.statistic.sketch_size = sketch_size
+    return model
+
+
+def with_similarity_mode(create_model, similarity_mode='exact', sketch_size=1024):
+    def assemble_model():
+        return set_similarity_mode(create_model(), similarity_mode, sketch_size)
+    return assemble_model
+
+
+# Distillation Students
+
+def create_vgg11_tune_all():
+    vgg11 = create_architecture(models.vgg11, pretrained=True)
+
+    vgg11.classifier = create_imagenet200_classifier()
+
+    # train all layers
+    for param in vgg11.parameters():
+        param.requires_grad = True
+
+    return vgg11
+
+
+def create_vgg11_in_single_tune_all():
+    # layer 13 follows relu4_1 in VGG11 as layer 21 does in VGG19
+    vgg = VGG_IN(13, instance_normalization_function=torch.nn.InstanceNorm2d, pretrained=True,
+        architecture=models.vgg11)
+
+    # train all layers
+    for param in vgg.parameters():
+        param.requires_grad = True
+
+    return vgg
+
+
+def create_student_models():
+    """Constructors of the students trained by distillation, keyed by model name."""
+    return {
+        'vgg11_tune_all': create_vgg11_tune_all,
+        'vgg11_in_single_tune_all': create_vgg11_in_single_tune_all
+    }
+
+
+# Supported Models
+
+def create_supported_models(zdim, beta, gamma, vae_model_checkpoint_path, device, vae_transforms):
+    """Constructors of the models run.py trains, keyed by model name."""
+    vae_model_name = vae_model_suffix(zdim, beta, gamma)
+    return {
+        # baseline
+        'vgg19_vanilla_tune_fc': create_vgg19_vanilla_tune_fc, # Vanilla (No Norm)
+        # normalization
+        'vgg19_bn_all_tune_fc': create_vgg19_bn_all_tune_fc, # Batch Norm
+        'vgg19_bn_in_single_tune_all': create_vgg19_bn_in_single_tune_all, # Batch Norm with Single IN
+        'vgg19_in_all_tune_all': create_vgg19_in_all_tune_all, # Instance Norm
+        'vgg19_in_single_tune_all': create_vgg19_in_single_tune_all, # Single IN
+        'vgg19_in_affine_single_tune_all': create_vgg19_in_affine_single_tune_all, # Single IN with Affine
+        'vgg19_in_sm_all_tune_all': create_vgg19_in_sm_all_tune_all, # IN-SM
+        'vgg19_in_sm_single_tune_all': create_vgg19_in_sm_all_tune_all, # Single IN-SM
+        # similarity
+        'similarity_vgg19_vanilla_tune_all': create_vgg19_vanilla_similarity_tune_all,
+        'similarity_vgg19_in_single_tune_all': create_vgg19_in_single_similarity_tune_all,
+        'similarity_vgg19_bn_all_tune_fc': create_vgg19_bn_all_similarity_tune_fc,
+        # latent representation
+        'vae{}'.format(vae_model_name): create_betavae(zdim),
+        'classifier_z{}'.format(vae_model_name): create_betavae_classifier(
+            vae_model_checkpoint_path, zdim, device),
+        # train with latent
+        'latent_vgg19_in_single_tune_all': create_vgg19_in_single_tune_all_with_latent(
+            vae_model_checkpoint_path, zdim, device, vae_transforms), # Single IN with Latent
+    }
@@ -0,0 +1,77 @@
+import os
+import contextlib
+import torch
+import torchvision.models as models
+
+
+# architecture name -> state dict of its pretrained ImageNet weights
+WEIGHT_POOL = {}
+pool_enabled = True
+
+
+def weights_file(name):
+    # the file torchvision downloads for pretrained=True, in the torch hub cache
+    url = models.get_model_weights(name).DEFAULT.url
+    filename = os.path.join(torch.hub.get_dir(), 'checkpoints', os.path.basename(url))
+    if not os.path.isfile(filename):
+        os.makedirs(os.path.dirname(filename), exist_ok=True)
+        torch.hub.download_url_to_file(url, filename)
+    return filename
+
+
+def load_weights(filename):
+    try:
+        return torch.load(filename, map_location='cpu', mmap=True, weights_only=True)
+    except (RuntimeError, TypeError):
+        # files written before the zip serialization cannot be memory-mapped,
+        # torch before 2.1 cannot memory-map at all
+        return torch.load(filename, map_location='cpu', weights_only=True)
+
+
+def pretrained_state_dict(architecture):
+    """Pretrained weights of a torchvision architecture, loaded once per process.
+
+    The tensors are memory-mapped from the hub cache and shared by every
+    caller, they must only be read or copied from.
+    """
+    name = architecture.__name__
+    if name not in WEIGHT_POOL:
+        WEIGHT_POOL[name] = load_weights(weights_file(name))
+    return WEIGHT_POOL[name]
+
+
+def submodule_state_dict(state_dict, prefix):
+    prefix = prefix + '.'
+    return { key[len(prefix):]: value for key, value in state_dict.items() if key.startswith(prefix) }
+
+
+def create_architecture(architecture, pretrained=False):
+    """architecture(pretrained=pretrained) with the pretrained weights copied from the pool.
+
+    Pretrained models are built on the meta device, so neither the random
+    initialization nor the deserialization of the weights is repeated.
+    """
+    if not pretrained or not pool_enabled:
+        return architecture(pretrained=pretrained)
+    state_dict = pretrained_state_dict(architecture)
+    with torch.device('meta'):
+        model = architecture(pretrained=False)
+    # materialized where architecture() would have built it, on the default tensor type's device
+    model = model.to_empty(device=torch.empty(0).device)
+    model.load_state_dict(state_dict)
+    return model
+
+
+def clear_weight_pool():
+    WEIGHT_POOL.clear()
+
+
+@contextlib.contextmanager
+def weight_pool_disabled():
+    # models are built the way torchvision builds them, to compare against
+    global pool_enabled
+    pool_enabled = False
+    try:
+        yield
+    finally:
+        pool_enabled = True